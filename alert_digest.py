@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from datetime import datetime
+from time import monotonic
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram.helpers import escape_markdown
+
+import config
+from telegram_dispatcher import get_dispatcher, PRIORITY_ALERT
+from topic_registry import get_or_create_topic, TARGET_TIMEZONE
+
+logger = logging.getLogger(__name__)
+
+_KIND_TITLES = {
+    'lateness': ("⚠️", "Опоздания"),
+    'overdue_break': ("❗️", "Превышение перерывов"),
+}
+
+# Запас до лимита Telegram в 4096 символов: дальше сводка продолжается новым сообщением
+_MAX_TEXT_LEN = 3800
+
+
+class _Digest:
+    """Одно сообщение-сводка в чате СБ: уведомления одного вида по одной группе (город/должность)."""
+
+    __slots__ = ("kind", "group", "lines", "opened_at", "message_id", "sent_lines", "lock", "flush_task")
+
+    def __init__(self, kind: str, group: str):
+        self.kind = kind
+        self.group = group
+        self.lines: List[str] = []
+        self.opened_at = monotonic()
+        self.message_id: Optional[int] = None
+        self.sent_lines = 0
+        self.lock = asyncio.Lock()
+        self.flush_task: Optional[asyncio.Task] = None
+
+    def render(self) -> str:
+        icon, title = _KIND_TITLES.get(self.kind, ("⚠️", self.kind))
+        header = f"{icon} *{escape_markdown(title, version=2)}: {escape_markdown(self.group, version=2)}*\n"
+        return header + f"Всего: {len(self.lines)}\n\n" + "\n".join(self.lines)
+
+
+_open: Dict[Tuple[str, str], _Digest] = {}
+# Все сводки с недосланными строками, включая уже закрытые по окну (их нет в _open) — для flush_all
+_unsent: Set[_Digest] = set()
+
+
+def digest_group(emp: Dict) -> str:
+    """Группа сводки для сотрудника: значение поля ALERT_DIGEST_GROUP_BY (город или должность)."""
+    return str(emp.get(config.ALERT_DIGEST_GROUP_BY) or "Не указано")
+
+
+def add_alert(context, kind: str, group: str, line: str):
+    """
+    Добавляет уведомление в сводку группы. line — готовая строка в MarkdownV2.
+    Первое уведомление в окне уходит сразу, следующие в течение ALERT_DIGEST_EDIT_DELAY_SEC
+    дописываются в то же сообщение одним редактированием. По истечении окна
+    ALERT_DIGEST_WINDOW_SEC (или при переполнении сообщения) начинается новая сводка.
+    """
+    key = (kind, group)
+    digest = _open.get(key)
+    if (digest is None or monotonic() - digest.opened_at > config.ALERT_DIGEST_WINDOW_SEC
+            or len(digest.render()) + len(line) > _MAX_TEXT_LEN):
+        digest = _open[key] = _Digest(kind, group)
+
+    digest.lines.append(line)
+    _unsent.add(digest)
+    if digest.flush_task is None:
+        delay = 0 if digest.message_id is None and len(digest.lines) == 1 else config.ALERT_DIGEST_EDIT_DELAY_SEC
+        digest.flush_task = asyncio.create_task(_flush_later(context, digest, delay))
+
+
+async def _flush_later(context, digest: _Digest, delay: float):
+    if delay:
+        await asyncio.sleep(delay)
+    digest.flush_task = None
+    await _flush(context, digest)
+
+
+async def _flush(context, digest: _Digest):
+    async with digest.lock:
+        if digest.sent_lines == len(digest.lines):
+            return
+        lines_count = len(digest.lines)
+        text = digest.render()
+        dispatcher = get_dispatcher(context)
+        try:
+            if digest.message_id is None:
+                _, title = _KIND_TITLES.get(digest.kind, ("", digest.kind))
+                day_str = datetime.now(TARGET_TIMEZONE).strftime('%d.%m.%Y')
+                thread_id = await get_or_create_topic(
+                    context, f"digest:{digest.group}", digest.kind,
+                    f"{title}: {digest.group} {day_str}", priority=PRIORITY_ALERT
+                )
+                message = await dispatcher.send_message(
+                    chat_id=config.SECURITY_CHAT_ID, text=text, message_thread_id=thread_id,
+                    parse_mode='MarkdownV2', priority=PRIORITY_ALERT
+                )
+                digest.message_id = message.message_id
+            else:
+                await dispatcher.edit_message_text(
+                    chat_id=config.SECURITY_CHAT_ID, message_id=digest.message_id, text=text,
+                    parse_mode='MarkdownV2', priority=PRIORITY_ALERT
+                )
+            digest.sent_lines = lines_count
+            if digest.sent_lines == len(digest.lines):
+                _unsent.discard(digest)
+        except Exception as e:
+            logger.error(f"Failed to send {digest.kind} digest for '{digest.group}': {e}")
+
+    # Пока отправляли, могли прийти новые уведомления — дописываем их следующим редактированием
+    if digest.sent_lines < len(digest.lines) and digest.flush_task is None and digest.message_id is not None:
+        digest.flush_task = asyncio.create_task(_flush_later(context, digest, config.ALERT_DIGEST_EDIT_DELAY_SEC))
+
+
+async def flush_all(context):
+    """Досылает все незавершенные сводки (при остановке бота), в том числе уже закрытые по окну."""
+    for digest in list(_unsent):
+        if digest.flush_task is not None:
+            digest.flush_task.cancel()
+            digest.flush_task = None
+        await _flush(context, digest)
+    _open.clear()
+    _unsent.clear()
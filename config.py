@@ -9,18 +9,88 @@ DB_PORT = int(os.getenv("DB_PORT", 3306))
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
 DB_NAME = os.getenv("DB_NAME")
+
+# Пул соединений MySQL
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 5))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
+DB_POOL_RECYCLE_SEC = int(os.getenv("DB_POOL_RECYCLE_SEC", 3600))
+DB_POOL_ACQUIRE_TIMEOUT_SEC = float(os.getenv("DB_POOL_ACQUIRE_TIMEOUT_SEC", 10))
+
+# Реплика только для чтения (отчеты, выгрузки). Если DB_REPLICA_HOST не задан — все идет в основную БД
+DB_REPLICA_HOST = os.getenv("DB_REPLICA_HOST")
+DB_REPLICA_PORT = int(os.getenv("DB_REPLICA_PORT", DB_PORT))
+DB_REPLICA_USER = os.getenv("DB_REPLICA_USER", DB_USER)
+DB_REPLICA_PASS = os.getenv("DB_REPLICA_PASS", DB_PASS)
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", 10))
+DB_REPLICA_RETRY_SEC = float(os.getenv("DB_REPLICA_RETRY_SEC", 30))
+# Сколько секунд после записи чтения из того же обработчика идут в основную БД
+DB_REPLICA_READ_YOUR_WRITES_SEC = float(os.getenv("DB_REPLICA_READ_YOUR_WRITES_SEC", 5))
+
+# Статистика запросов и лог медленных запросов
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", 200))
+DB_SLOW_QUERY_LOG_SIZE = int(os.getenv("DB_SLOW_QUERY_LOG_SIZE", 100))
+DB_SLOW_QUERY_EXPLAIN = os.getenv("DB_SLOW_QUERY_EXPLAIN", "false").lower() in ("1", "true", "yes")
+
+# Отложенная пакетная запись employee_audit_log (выключена по умолчанию). time_log пишется
+# сразу в транзакции вместе со сменой статуса (transition_status) и через буфер не идет
+DB_WRITE_BEHIND_ENABLED = os.getenv("DB_WRITE_BEHIND_ENABLED", "false").lower() in ("1", "true", "yes")
+DB_WRITE_BEHIND_BATCH_SIZE = int(os.getenv("DB_WRITE_BEHIND_BATCH_SIZE", 200))
+DB_WRITE_BEHIND_FLUSH_INTERVAL_SEC = float(os.getenv("DB_WRITE_BEHIND_FLUSH_INTERVAL_SEC", 1.0))
+DB_WRITE_BEHIND_SPILL_PATH = os.getenv("DB_WRITE_BEHIND_SPILL_PATH", "write_behind.jsonl")
+
 SECURITY_CHAT_ID = int(os.getenv("SECURITY_CHAT_ID"))
 
+# Лимиты исходящих запросов к Telegram (telegram_dispatcher)
+TG_GLOBAL_RATE_PER_SEC = float(os.getenv("TG_GLOBAL_RATE_PER_SEC", 25))
+TG_PRIVATE_CHAT_RATE_PER_SEC = float(os.getenv("TG_PRIVATE_CHAT_RATE_PER_SEC", 1))
+TG_GROUP_CHAT_RATE_PER_MIN = float(os.getenv("TG_GROUP_CHAT_RATE_PER_MIN", 20))
+TG_TOPIC_CREATE_RATE_PER_MIN = float(os.getenv("TG_TOPIC_CREATE_RATE_PER_MIN", 10))
+TG_DISPATCH_WORKERS = int(os.getenv("TG_DISPATCH_WORKERS", 4))
+TG_DISPATCH_MAX_RETRIES = int(os.getenv("TG_DISPATCH_MAX_RETRIES", 3))
+
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# Пул соединений Redis (redis_pool): таймауты и повторы с экспоненциальной задержкой при обрывах
+REDIS_POOL_MAX_SIZE = int(os.getenv("REDIS_POOL_MAX_SIZE", 20))
+REDIS_SOCKET_TIMEOUT_SEC = float(os.getenv("REDIS_SOCKET_TIMEOUT_SEC", 2.0))
+REDIS_CONNECT_TIMEOUT_SEC = float(os.getenv("REDIS_CONNECT_TIMEOUT_SEC", 2.0))
+REDIS_RETRY_ATTEMPTS = int(os.getenv("REDIS_RETRY_ATTEMPTS", 3))
+REDIS_HEALTH_CHECK_INTERVAL_SEC = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL_SEC", 30))
 REDIS_OPERATORS_ONLINE_SET = "operators_online"
 REDIS_OPERATOR_TASK_PREFIX = "operator_task:"
+# Hash с таймерами перерывов/обедов (employee_id -> JSON), чтобы они переживали перезапуск бота
+REDIS_BREAK_TIMERS_KEY = "break_timers"
+# Реестр тем форума СБ: (сотрудник, день, вид уведомления) -> message_thread_id, плюс индекс для ночного закрытия
+REDIS_TOPIC_REGISTRY_PREFIX = "alert_topic:"
+REDIS_TOPIC_INDEX_KEY = "alert_topics"
+TOPIC_REGISTRY_TTL_SEC = int(os.getenv("TOPIC_REGISTRY_TTL_SEC", 36 * 3600))
+
+# Кэш карточек сотрудников (по id и personal_telegram_id)
+EMPLOYEE_CACHE_TTL_SEC = int(os.getenv("EMPLOYEE_CACHE_TTL_SEC", 300))
+EMPLOYEE_CACHE_MAX_SIZE = int(os.getenv("EMPLOYEE_CACHE_MAX_SIZE", 2000))
+
+# Кэш рассчитанного графика (ключ — сотрудник и дата); кэшируются только периоды не длиннее SCHEDULE_CACHE_MAX_DAYS
+SCHEDULE_CACHE_TTL_SEC = int(os.getenv("SCHEDULE_CACHE_TTL_SEC", 900))
+SCHEDULE_CACHE_MAX_SIZE = int(os.getenv("SCHEDULE_CACHE_MAX_SIZE", 50000))
+SCHEDULE_CACHE_MAX_DAYS = int(os.getenv("SCHEDULE_CACHE_MAX_DAYS", 31))
 
 BREAK_LIMIT = 8
 LUNCH_LIMIT = 1
 BREAK_DURATION_MIN = 10
 LUNCH_DURATION_MIN = 60
 LATENESS_GRACE_PERIOD_MIN = 5
+# Повторные напоминания о превышении перерыва/обеда: через сколько минут после предыдущего.
+# Последний интервал повторяется до возвращения сотрудника; пустое значение — только одно уведомление.
+OVERDUE_REMINDER_BACKOFF_MIN = [int(x) for x in os.getenv("OVERDUE_REMINDER_BACKOFF_MIN", "5,10,20,40").split(",") if x.strip()]
+# Сколько уведомлений (создание темы + сообщения + запись в БД) отправляется параллельно
+ALERT_DISPATCH_CONCURRENCY = int(os.getenv("ALERT_DISPATCH_CONCURRENCY", 5))
+# Сводки уведомлений: опоздания/превышения перерывов за окно ALERT_DIGEST_WINDOW_SEC собираются
+# в одно сообщение на город или должность (ALERT_DIGEST_GROUP_BY), которое дописывается по мере поступления.
+# Выключено по умолчанию: без флага уведомления идут, как раньше, отдельными темами по сотрудникам
+ALERT_DIGEST_ENABLED = os.getenv("ALERT_DIGEST_ENABLED", "false").lower() in ("1", "true", "yes")
+ALERT_DIGEST_WINDOW_SEC = int(os.getenv("ALERT_DIGEST_WINDOW_SEC", 180))
+ALERT_DIGEST_EDIT_DELAY_SEC = float(os.getenv("ALERT_DIGEST_EDIT_DELAY_SEC", 5))
+ALERT_DIGEST_GROUP_BY = os.getenv("ALERT_DIGEST_GROUP_BY", "city")
 
 DEFAULT_TIMEZONE = "Europe/Moscow"
 
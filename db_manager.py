@@ -1,16 +1,98 @@
 import aiomysql
+import asyncio
 import logging
-from config import DB_HOST, DB_PORT, DB_USER, DB_PASS, DB_NAME
-from typing import Optional, Dict, Any, List
-from datetime import date, timedelta, time, datetime
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import partial
+from time import monotonic
+from config import (
+    DB_HOST, DB_PORT, DB_USER, DB_PASS, DB_NAME,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_RECYCLE_SEC, DB_POOL_ACQUIRE_TIMEOUT_SEC,
+    DB_REPLICA_HOST, DB_REPLICA_PORT, DB_REPLICA_USER, DB_REPLICA_PASS,
+    DB_REPLICA_POOL_MAX_SIZE, DB_REPLICA_RETRY_SEC, DB_REPLICA_READ_YOUR_WRITES_SEC,
+    DB_SLOW_QUERY_EXPLAIN,
+    DB_WRITE_BEHIND_ENABLED, DB_WRITE_BEHIND_BATCH_SIZE, DB_WRITE_BEHIND_FLUSH_INTERVAL_SEC, DB_WRITE_BEHIND_SPILL_PATH,
+    EMPLOYEE_CACHE_TTL_SEC, EMPLOYEE_CACHE_MAX_SIZE,
+    SCHEDULE_CACHE_TTL_SEC, SCHEDULE_CACHE_MAX_SIZE, SCHEDULE_CACHE_MAX_DAYS,
+)
+from typing import Optional, Dict, Any, List, AsyncIterator, Callable, Set
+from datetime import date, timedelta, time, datetime, tzinfo
 import pytz
 import json
 from utils import get_timezone_for_city 
+from ttl_cache import TTLCache
+from write_behind import WriteBehindBuffer, has_spilled_records
+import schedule_engine
+import db_metrics
+import redis_pool
 
 TARGET_TIMEZONE = pytz.timezone('Asia/Yekaterinburg')
 logger = logging.getLogger(__name__)
 
 pool = None
+# Необязательный пул реплики для запросов только на чтение (см. DB_REPLICA_HOST)
+replica_pool = None
+
+def _new_pool_stats() -> Dict[str, Any]:
+    return {
+        'waiters': 0,
+        'acquired': 0,
+        'timeouts': 0,
+        'wait_total_sec': 0.0,
+        'wait_max_sec': 0.0,
+        'wait_last_sec': 0.0,
+    }
+
+# Метрики ожидания соединения из пула (см. get_pool_stats)
+_pool_stats = _new_pool_stats()
+_replica_stats = _new_pool_stats()
+_replica_state = {
+    'unhealthy_until': 0.0,
+    'fallbacks': 0,
+    'reads': 0,
+    'last_error': None,
+}
+
+# До какого момента (monotonic) чтения текущей задачи идут в основную БД, а не в реплику.
+# Выставляется после каждой записи и через read_your_writes(); у каждого обработчика PTB свой контекст.
+_primary_reads_until: ContextVar[float] = ContextVar('primary_reads_until', default=0.0)
+
+# Фоновые задачи EXPLAIN для медленных запросов (держим ссылки, чтобы их не собрал GC)
+_explain_tasks = set()
+
+# Кэш карточек сотрудников: строки по id + индекс personal_telegram_id -> id
+_employee_cache = TTLCache(maxsize=EMPLOYEE_CACHE_MAX_SIZE, ttl=EMPLOYEE_CACHE_TTL_SEC)
+_telegram_to_employee_id: Dict[str, int] = {}
+
+# Кэш графика: (employee_id, date) -> (версия графика сотрудника, день).
+# Версия растет при любом изменении исключений или параметров графика — старые записи просто перестают совпадать.
+_schedule_cache = TTLCache(maxsize=SCHEDULE_CACHE_MAX_SIZE, ttl=SCHEDULE_CACHE_TTL_SEC)
+_schedule_versions: Dict[int, int] = {}
+
+# Часовой пояс сотрудника, вычисленный по его городу: employee_id -> tzinfo.
+# Сбрасывается при смене города (update_employee_field) и удалении сотрудника.
+_employee_timezones: Dict[int, tzinfo] = {}
+
+# Подписчики на изменения данных: событие -> список callback(**payload).
+# События: 'status_changed' (employee_id, status), 'schedule_changed' (employee_id).
+_listeners: Dict[str, List[Callable[..., Any]]] = {}
+# Выполняющиеся асинхронные подписчики (см. _emit)
+_listener_tasks: Set[asyncio.Task] = set()
+
+# Поля карточки, от которых зависит рассчитанный график
+_SCHEDULE_FIELDS = ('schedule_pattern', 'schedule_start_date', 'hire_date', 'default_start_time', 'default_end_time')
+
+# Дневные счетчики событий: employee_id -> {'day': локальная дата, 'tz': часовой пояс, 'counts': {reason: n}}
+_daily_counters: Dict[int, Dict[str, Any]] = {}
+_daily_counter_versions: Dict[int, int] = {}
+
+# Буфер отложенной записи журналов (см. start_write_behind); None — пишем сразу
+_write_behind: Optional[WriteBehindBuffer] = None
+
+_AUDIT_LOG_INSERT = """
+    INSERT INTO employee_audit_log (admin_id, employee_id, field_changed, old_value, new_value, reason, timestamp)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
 
 async def init_pool():
     """Инициализирует ЕДИНСТВЕННЫЙ пул соединений."""
@@ -20,105 +102,647 @@ async def init_pool():
             host=DB_HOST, port=DB_PORT,
             user=DB_USER, password=DB_PASS,
             db=DB_NAME, autocommit=True,
-            cursorclass=aiomysql.DictCursor
+            cursorclass=aiomysql.DictCursor,
+            minsize=DB_POOL_MIN_SIZE, maxsize=DB_POOL_MAX_SIZE,
+            pool_recycle=DB_POOL_RECYCLE_SEC
+        )
+        await _warm_up_pool()
+        logger.info(
+            f"Database connection pool created successfully "
+            f"(min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}, recycle={DB_POOL_RECYCLE_SEC}s)."
         )
-        logger.info("Database connection pool created successfully.")
     except Exception as e:
         logger.error(f"Error creating database connection pool: {e}")
         raise
+    await _init_replica_pool()
+
+async def _init_replica_pool():
+    """Создает пул реплики, если она настроена. Ошибка не фатальна — чтения пойдут в основную БД."""
+    global replica_pool
+    if not DB_REPLICA_HOST:
+        return
+    try:
+        replica_pool = await aiomysql.create_pool(
+            host=DB_REPLICA_HOST, port=DB_REPLICA_PORT,
+            user=DB_REPLICA_USER, password=DB_REPLICA_PASS,
+            db=DB_NAME, autocommit=True,
+            cursorclass=aiomysql.DictCursor,
+            minsize=1, maxsize=DB_REPLICA_POOL_MAX_SIZE,
+            pool_recycle=DB_POOL_RECYCLE_SEC
+        )
+        logger.info(f"Read replica pool created ({DB_REPLICA_HOST}:{DB_REPLICA_PORT}, max={DB_REPLICA_POOL_MAX_SIZE}).")
+    except Exception as e:
+        replica_pool = None
+        logger.warning(f"Could not create read replica pool, reads will use the primary: {e}")
+
+async def _warm_up_pool():
+    """
+    Прогревает минимальное число соединений: одновременно берет их из пула и делает SELECT 1,
+    чтобы к первому всплеску (09:00) соединения уже были открыты и проверены.
+    """
+    async def ping():
+        async with _acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("SELECT 1")
+
+    await asyncio.gather(*(ping() for _ in range(DB_POOL_MIN_SIZE)))
 
 async def close_pool():
     """Закрывает ЕДИНСТВЕННЫЙ пул соединений."""
-    global pool
+    global pool, replica_pool
+    if replica_pool:
+        replica_pool.close()
+        await replica_pool.wait_closed()
+        replica_pool = None
     if pool:
         pool.close()
         await pool.wait_closed()
         logger.info("Database connection pool closed.")
 
-async def fetch_one(query: str, args: tuple = ()) -> Optional[Dict[str, Any]]:
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(query, args)
-            return await cursor.fetchone()
+# --- Read Replica Routing ---
+def _use_replica(read_only: bool) -> bool:
+    """Идет ли чтение в реплику: она настроена, здорова и задача недавно не писала в основную БД."""
+    if not read_only or replica_pool is None:
+        return False
+    now = monotonic()
+    return now >= _replica_state['unhealthy_until'] and now >= _primary_reads_until.get()
 
-async def fetch_all(query: str, args: tuple = ()) -> List[Dict[str, Any]]:
-    async with pool.acquire() as conn:
+def _mark_replica_unhealthy(error: Exception):
+    _replica_state['unhealthy_until'] = monotonic() + DB_REPLICA_RETRY_SEC
+    _replica_state['fallbacks'] += 1
+    _replica_state['last_error'] = str(error)
+    logger.warning(f"Read replica unavailable, using primary for {DB_REPLICA_RETRY_SEC}s: {error}")
+
+def _mark_wrote():
+    """После записи чтения этой задачи на время идут в основную БД (реплика может отставать)."""
+    if replica_pool is not None:
+        _primary_reads_until.set(monotonic() + DB_REPLICA_READ_YOUR_WRITES_SEC)
+
+@contextmanager
+def read_your_writes():
+    """Все чтения внутри блока идут в основную БД — для обработчиков, которым нужны только что записанные данные."""
+    token = _primary_reads_until.set(float('inf'))
+    try:
+        yield
+    finally:
+        _primary_reads_until.reset(token)
+
+async def _get_connection(target_pool, stats: Dict[str, Any]):
+    """Берет соединение из пула с таймаутом и учетом времени ожидания."""
+    stats['waiters'] += 1
+    started = monotonic()
+    acquire_task = asyncio.ensure_future(target_pool.acquire())
+    try:
+        conn = await asyncio.wait_for(asyncio.shield(acquire_task), timeout=DB_POOL_ACQUIRE_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        # Соединение могло выдаться уже после таймаута — вернем его в пул, чтобы не потерять
+        acquire_task.add_done_callback(lambda task: _release_late_connection(target_pool, task))
+        acquire_task.cancel()
+        stats['timeouts'] += 1
+        logger.warning(
+            f"Timed out waiting {DB_POOL_ACQUIRE_TIMEOUT_SEC}s for a DB connection "
+            f"(size={target_pool.size}, free={target_pool.freesize}, waiters={stats['waiters']})"
+        )
+        raise
+    finally:
+        stats['waiters'] -= 1
+
+    waited = monotonic() - started
+    stats['acquired'] += 1
+    stats['wait_total_sec'] += waited
+    stats['wait_last_sec'] = waited
+    stats['wait_max_sec'] = max(stats['wait_max_sec'], waited)
+    return conn
+
+@asynccontextmanager
+async def _acquire(use_replica: bool = False):
+    """
+    Берет соединение из основного пула или, для чтений, из пула реплики.
+    Если реплика не отдает соединение, помечаем ее нездоровой и берем соединение из основного пула.
+    """
+    target_pool = pool
+    if use_replica:
+        try:
+            conn = await _get_connection(replica_pool, _replica_stats)
+            target_pool = replica_pool
+            _replica_state['reads'] += 1
+        except (asyncio.TimeoutError, OSError, aiomysql.Error) as e:
+            _mark_replica_unhealthy(e)
+            use_replica = False
+    if not use_replica:
+        conn = await _get_connection(pool, _pool_stats)
+
+    try:
+        yield conn
+    finally:
+        target_pool.release(conn)
+
+def _release_late_connection(target_pool, task: asyncio.Future):
+    if not task.cancelled() and task.exception() is None:
+        target_pool.release(task.result())
+
+def _describe_pool(target_pool, stats: Dict[str, Any]) -> Dict[str, Any]:
+    acquired = stats['acquired']
+    return {
+        'size': target_pool.size,
+        'in_use': target_pool.size - target_pool.freesize,
+        'free': target_pool.freesize,
+        'minsize': target_pool.minsize,
+        'maxsize': target_pool.maxsize,
+        'waiters': stats['waiters'],
+        'acquired': acquired,
+        'timeouts': stats['timeouts'],
+        'wait_avg_ms': round(stats['wait_total_sec'] / acquired * 1000, 2) if acquired else 0.0,
+        'wait_max_ms': round(stats['wait_max_sec'] * 1000, 2),
+        'wait_last_ms': round(stats['wait_last_sec'] * 1000, 2),
+    }
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Текущее состояние пула: занятые/свободные соединения, очередь и время ожидания (и реплики, и пула Redis, если есть)."""
+    if not pool:
+        return {}
+    result = _describe_pool(pool, _pool_stats)
+    if replica_pool is not None:
+        result['replica'] = {
+            **_describe_pool(replica_pool, _replica_stats),
+            'healthy': monotonic() >= _replica_state['unhealthy_until'],
+            'reads': _replica_state['reads'],
+            'fallbacks': _replica_state['fallbacks'],
+            'last_error': _replica_state['last_error'],
+        }
+    redis_stats = redis_pool.get_pool_stats()
+    if redis_stats:
+        result['redis'] = redis_stats
+    return result
+
+def _observe_query(query: str, args: Any, started: float, rows: int, failed: bool = False):
+    """Пишет время выполнения запроса в статистику; для медленных SELECT при необходимости снимает EXPLAIN."""
+    elapsed_ms = (monotonic() - started) * 1000
+    slow_entry = db_metrics.record(query, args, elapsed_ms, rows, failed)
+    if slow_entry is not None and DB_SLOW_QUERY_EXPLAIN and query.lstrip().upper().startswith("SELECT"):
+        task = asyncio.ensure_future(_capture_explain(slow_entry, query, args))
+        _explain_tasks.add(task)
+        task.add_done_callback(_explain_tasks.discard)
+
+async def _capture_explain(slow_entry: Dict[str, Any], query: str, args: Any):
+    """Выполняет EXPLAIN для медленного запроса вне горячего пути и прикрепляет план к записи лога."""
+    try:
+        async with _acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute("EXPLAIN " + query, args)
+                slow_entry['explain'] = await cursor.fetchall()
+    except Exception as e:
+        logger.warning(f"Could not EXPLAIN slow query: {e}")
+
+def get_query_stats(sort_by: str = 'total_ms', limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Гистограммы задержек и число строк по каждому нормализованному запросу."""
+    return db_metrics.get_query_stats(sort_by, limit)
+
+def get_slow_queries() -> List[Dict[str, Any]]:
+    """Последние запросы, превысившие порог DB_SLOW_QUERY_MS."""
+    return db_metrics.get_slow_queries()
+
+async def _fetch(query: str, args: tuple, many: bool, use_replica: bool):
+    async with _acquire(use_replica) as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(query, args)
-            return await cursor.fetchall()
+            started = monotonic()
+            try:
+                await cursor.execute(query, args)
+                result = await (cursor.fetchall() if many else cursor.fetchone())
+            except Exception:
+                _observe_query(query, args, started, 0, failed=True)
+                raise
+            _observe_query(query, args, started, len(result) if many else (1 if result else 0))
+            return result
+
+async def _fetch_routed(query: str, args: tuple, many: bool, read_only: bool):
+    use_replica = _use_replica(read_only)
+    try:
+        return await _fetch(query, args, many, use_replica)
+    except aiomysql.OperationalError as e:
+        # Реплика отвалилась посреди запроса — повторяем чтение в основной БД
+        if not use_replica:
+            raise
+        _mark_replica_unhealthy(e)
+        return await _fetch(query, args, many, False)
+
+async def fetch_one(query: str, args: tuple = (), read_only: bool = False) -> Optional[Dict[str, Any]]:
+    """read_only=True разрешает выполнить запрос на реплике (если она настроена)."""
+    return await _fetch_routed(query, args, False, read_only)
+
+async def fetch_all(query: str, args: tuple = (), read_only: bool = False) -> List[Dict[str, Any]]:
+    """read_only=True разрешает выполнить запрос на реплике (если она настроена)."""
+    return await _fetch_routed(query, args, True, read_only)
 
 async def execute(query: str, args: tuple = ()) -> int:
-    async with pool.acquire() as conn:
+    async with _acquire() as conn:
         async with conn.cursor() as cursor:
-            await cursor.execute(query, args)
+            started = monotonic()
+            try:
+                await cursor.execute(query, args)
+            except Exception:
+                _observe_query(query, args, started, 0, failed=True)
+                raise
+            _observe_query(query, args, started, max(cursor.rowcount, 0))
+            _mark_wrote()
             return cursor.lastrowid
 
+@asynccontextmanager
+async def _transaction():
+    """Одна транзакция на одном соединении: COMMIT при успехе, ROLLBACK при любой ошибке."""
+    async with _acquire() as conn:
+        await conn.begin()
+        try:
+            async with conn.cursor() as cursor:
+                yield cursor
+        except BaseException:
+            await conn.rollback()
+            raise
+        await conn.commit()
+        _mark_wrote()
+
+async def _execute_in(cursor, query: str, args: tuple = ()) -> int:
+    """Выполняет запрос на курсоре открытой транзакции с учетом в статистике запросов."""
+    started = monotonic()
+    try:
+        await cursor.execute(query, args)
+    except Exception:
+        _observe_query(query, args, started, 0, failed=True)
+        raise
+    rows = max(cursor.rowcount, 0)
+    _observe_query(query, args, started, rows)
+    return rows
+
+async def _executemany_in(cursor, query: str, args_list: List[tuple]) -> int:
+    """executemany на курсоре открытой транзакции (INSERT ... VALUES склеивается драйвером в один запрос)."""
+    if not args_list:
+        return 0
+    started = monotonic()
+    try:
+        await cursor.executemany(query, args_list)
+    except Exception:
+        _observe_query(query, args_list, started, 0, failed=True)
+        raise
+    rows = max(cursor.rowcount, 0)
+    _observe_query(query, args_list, started, rows)
+    return rows
+
+async def stream_rows(query: str, args: tuple = (), batch_size: int = 500,
+                      read_only: bool = False) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Отдает строки по одной через серверный курсор (SSDictCursor), подгружая их пачками.
+    Весь результат в памяти не держится. Соединение занято, пока генератор не будет дочитан
+    или закрыт, поэтому потребитель не должен надолго задерживаться между строками.
+    """
+    async with _acquire(_use_replica(read_only)) as conn:
+        cursor = await conn.cursor(aiomysql.SSDictCursor)
+        started = monotonic()
+        rows = 0
+        failed = False
+        try:
+            await cursor.execute(query, args)
+            while True:
+                batch = await cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                for row in batch:
+                    rows += 1
+                    yield row
+        except Exception:
+            failed = True
+            raise
+        finally:
+            # Время включает обработку строк потребителем — для потоковых выгрузок это ожидаемо
+            _observe_query(query, args, started, rows, failed=failed)
+            await cursor.close()
+
+# --- Write-Behind ---
+async def start_write_behind():
+    """
+    Включает отложенную запись журналов, если она разрешена в конфиге (DB_WRITE_BEHIND_ENABLED).
+    Записи, оставшиеся на диске с прошлого запуска, досылаются в БД в любом случае —
+    даже если отложенную запись с тех пор выключили.
+    """
+    global _write_behind
+    if _write_behind is not None:
+        return
+    buffer = WriteBehindBuffer(
+        _flush_log_records, DB_WRITE_BEHIND_SPILL_PATH,
+        max_batch=DB_WRITE_BEHIND_BATCH_SIZE, flush_interval=DB_WRITE_BEHIND_FLUSH_INTERVAL_SEC
+    )
+    if not DB_WRITE_BEHIND_ENABLED:
+        if has_spilled_records(DB_WRITE_BEHIND_SPILL_PATH):
+            # start() поднимает и сбрасывает записи с диска, stop() закрывает буфер; новые записи идут сразу в БД
+            await buffer.start()
+            await buffer.stop()
+        return
+    _write_behind = buffer
+    await _write_behind.start()
+    logger.info(
+        f"Write-behind logging enabled (batch={DB_WRITE_BEHIND_BATCH_SIZE}, "
+        f"interval={DB_WRITE_BEHIND_FLUSH_INTERVAL_SEC}s, spill={DB_WRITE_BEHIND_SPILL_PATH})."
+    )
+
+async def stop_write_behind():
+    """Сбрасывает остаток буфера в БД. Вызывается до закрытия пула."""
+    global _write_behind
+    if _write_behind is not None:
+        await _write_behind.stop()
+        _write_behind = None
+
+def get_write_behind_stats() -> Dict[str, Any]:
+    return _write_behind.stats() if _write_behind else {}
+
+async def _flush_log_records(records: List[Dict[str, Any]]):
+    """Пишет пачку журнальных записей многострочным INSERT в одной транзакции."""
+    async with _transaction() as cursor:
+        # Время события хранится в UTC; в таблицу пишем во времени БД, как и NOW() в остальных запросах
+        await _execute_in(cursor, "SELECT TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW()) AS offset_sec")
+        db_offset = timedelta(seconds=(await cursor.fetchone())['offset_sec'])
+        audit_rows = [
+            (*r['values'], datetime.strptime(r['ts_utc'], '%Y-%m-%d %H:%M:%S') + db_offset)
+            for r in records if r['table'] == 'employee_audit_log'
+        ]
+        await _executemany_in(cursor, _AUDIT_LOG_INSERT, audit_rows)
+
+def _enqueue_log_record(table: str, values: list):
+    # Время фиксируем в момент события (в UTC), а не в момент сброса буфера
+    _write_behind.enqueue({
+        'table': table, 'ts_utc': datetime.now(pytz.utc).strftime('%Y-%m-%d %H:%M:%S'), 'values': values,
+    })
+
+# --- Change Events ---
+def subscribe(event: str, callback: Callable[..., Any]):
+    """
+    Подписывает callback на событие изменения данных. Callback вызывается после успешной записи;
+    если он асинхронный, корутина запускается отдельной задачей и запись не ждет ее завершения.
+    """
+    _listeners.setdefault(event, []).append(callback)
+
+def _listener_done(event: str, name: str, task: asyncio.Task):
+    _listener_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Listener {name} for '{event}' failed: {task.exception()!r}")
+
+def _emit(event: str, **payload):
+    for callback in _listeners.get(event, ()):
+        name = getattr(callback, '__name__', None) or getattr(getattr(callback, 'func', None), '__name__', callback)
+        try:
+            result = callback(**payload)
+            if asyncio.iscoroutine(result):
+                # Держим ссылку до завершения (иначе задачу может собрать GC) и логируем ошибку сразу
+                task = asyncio.ensure_future(result)
+                _listener_tasks.add(task)
+                task.add_done_callback(partial(_listener_done, event, name))
+        except Exception as e:
+            logger.error(f"Listener {name} for '{event}' failed: {e}")
+
+# --- Employee Cache ---
+def _cache_employee(employee: Dict[str, Any]):
+    _employee_cache.set(employee['id'], employee)
+    telegram_id = employee.get('personal_telegram_id')
+    if telegram_id:
+        _telegram_to_employee_id[str(telegram_id)] = employee['id']
+
+def invalidate_employee_cache(employee_id: Optional[int] = None):
+    """Сбрасывает карточку сотрудника из кэша (или весь кэш, если ID не указан)."""
+    if employee_id is None:
+        _employee_cache.clear()
+        _telegram_to_employee_id.clear()
+    else:
+        _employee_cache.pop(employee_id)
+
+def get_employee_cache_stats() -> Dict[str, Any]:
+    """Счетчики попаданий/промахов кэша карточек сотрудников."""
+    return _employee_cache.stats()
+
+def get_employee_timezone(employee: Optional[Dict[str, Any]]) -> tzinfo:
+    """Часовой пояс сотрудника (по полю city). Для None — пояс по умолчанию."""
+    if not employee:
+        return get_timezone_for_city(None)
+    tz = _employee_timezones.get(employee['id'])
+    if tz is None:
+        tz = _employee_timezones[employee['id']] = get_timezone_for_city(employee.get('city'))
+    return tz
+
+# --- Schedule Cache ---
+def bump_schedule_version(employee_id: int):
+    """Помечает закэшированный график сотрудника устаревшим и оповещает подписчиков 'schedule_changed'."""
+    _schedule_versions[employee_id] = _schedule_versions.get(employee_id, 0) + 1
+    _emit('schedule_changed', employee_id=employee_id)
+
+def get_schedule_cache_stats() -> Dict[str, Any]:
+    """Счетчики попаданий/промахов кэша графика (по дням)."""
+    return _schedule_cache.stats()
+
+def _get_cached_schedule(employee_id: int, dates: List[date]) -> Optional[List[Dict[str, Any]]]:
+    version = _schedule_versions.get(employee_id, 0)
+    days = []
+    for day_date in dates:
+        item = _schedule_cache.get((employee_id, day_date))
+        if item is None or item[0] != version:
+            return None
+        days.append(dict(item[1]))
+    return days
+
 # --- Employee Functions ---
 async def get_employee_by_id(employee_id: int) -> Optional[Dict[str, Any]]:
+    employee = _employee_cache.get(employee_id)
+    if employee is not None:
+        return dict(employee)
+
     query = "SELECT * FROM employees WHERE id = %s"
-    return await fetch_one(query, (employee_id,))
+    employee = await fetch_one(query, (employee_id,))
+    if employee:
+        _cache_employee(employee)
+        return dict(employee)
+    return None
 
 async def get_employee_by_telegram_id(telegram_id: int) -> Optional[Dict[str, Any]]:
+    employee_id = _telegram_to_employee_id.get(str(telegram_id))
+    if employee_id is not None:
+        employee = _employee_cache.get(employee_id)
+        # Индекс мог устареть (смена Telegram ID, увольнение) — проверяем саму строку
+        if (employee is not None
+                and str(employee.get('personal_telegram_id')) == str(telegram_id)
+                and employee.get('termination_date') is None):
+            return dict(employee)
+    else:
+        _employee_cache.misses += 1
+
     query = "SELECT * FROM employees WHERE personal_telegram_id = %s AND termination_date IS NULL"
-    return await fetch_one(query, (telegram_id,))
+    employee = await fetch_one(query, (telegram_id,))
+    if employee:
+        _cache_employee(employee)
+        return dict(employee)
+    return None
 
-async def update_employee_status(employee_id: int, status: str):
-    query = "UPDATE employees SET status = %s, status_change_timestamp = NOW() WHERE id = %s"
-    await execute(query, (status, employee_id))
-    
-    # Если сотрудник вернулся в онлайн, сбрасываем тему с уведомлениями
-    if status == 'online':
-        await update_employee_topic_id(employee_id, None)
+_STATUS_UPDATE_QUERY = "UPDATE employees SET status = %s, status_change_timestamp = NOW() WHERE id = %s"
+
+async def transition_status(employee_id: int, new_status: str, event_type: str, reason: Optional[str] = None,
+                            approver_id: Optional[int] = None, approval_reason: Optional[str] = None):
+    """
+    Смена статуса сотрудника вместе с записью в time_log — на одном соединении и в одной транзакции,
+    чтобы статус и журнал не могли разойтись.
+    """
+    if approver_id is None:
+        log_query = "INSERT INTO time_log (employee_id, event_type, reason, timestamp) VALUES (%s, %s, %s, NOW())"
+        log_args = (employee_id, event_type, reason)
+    else:
+        log_query = "INSERT INTO time_log (employee_id, event_type, reason, timestamp, approver_id, approval_reason) VALUES (%s, %s, %s, NOW(), %s, %s)"
+        log_args = (employee_id, event_type, reason, approver_id, approval_reason)
+
+    async with _transaction() as cursor:
+        await _execute_in(cursor, _STATUS_UPDATE_QUERY, (new_status, employee_id))
+        await _execute_in(cursor, log_query, log_args)
+
+    invalidate_employee_cache(employee_id)
+    _bump_daily_counter(employee_id, reason)
+    _emit('status_changed', employee_id=employee_id, status=new_status)
 
 async def set_totp_secret(employee_id: int, secret: str):
     await execute("UPDATE employees SET totp_secret = %s WHERE id = %s", (secret, employee_id))
+    invalidate_employee_cache(employee_id)
     
-async def update_lateness_alert_date(employee_id: int):
-    await execute("UPDATE employees SET last_lateness_alert_date = CURDATE() WHERE id = %s", (employee_id,))
+async def update_lateness_alert_date(employee_id: int, alert_date: date):
+    """alert_date — локальная дата сотрудника, за которую отправлено уведомление (не CURDATE() сервера)."""
+    await execute("UPDATE employees SET last_lateness_alert_date = %s WHERE id = %s", (alert_date, employee_id))
+    invalidate_employee_cache(employee_id)
 
-async def update_employee_topic_id(employee_id: int, topic_id: Optional[int]):
-    await execute("UPDATE employees SET current_alert_topic_id = %s WHERE id = %s", (topic_id, employee_id))
+async def record_security_alert(employee_id: int, kind: str, details: Optional[str] = None,
+                                group_key: Optional[str] = None):
+    """Записывает уведомление СБ по сотруднику (kind: 'lateness', 'overdue_break')."""
+    await execute(
+        "INSERT INTO security_alerts (employee_id, kind, group_key, details) VALUES (%s, %s, %s, %s)",
+        (employee_id, kind, group_key, details)
+    )
 
-async def reset_all_topic_ids():
-    await execute("UPDATE employees SET current_alert_topic_id = NULL WHERE current_alert_topic_id IS NOT NULL")
+# --- Daily Event Counters ---
+def _bump_daily_counter(employee_id: int, reason: Optional[str]):
+    """Учитывает новое событие в дневном счетчике сотрудника (если счетчик уже загружен и день не сменился)."""
+    _daily_counter_versions[employee_id] = _daily_counter_versions.get(employee_id, 0) + 1
+    entry = _daily_counters.get(employee_id)
+    if entry is None or not reason:
+        return
+    if datetime.now(entry['tz']).date() != entry['day']:
+        # У сотрудника наступила новая локальная дата — старые счетчики больше не актуальны
+        del _daily_counters[employee_id]
+        return
+    entry['counts'][reason] = entry['counts'].get(reason, 0) + 1
 
 # --- Time Log Functions ---
-async def log_time_event(employee_id: int, event_type: str, reason: Optional[str] = None):
-    query = "INSERT INTO time_log (employee_id, event_type, reason, timestamp) VALUES (%s, %s, %s, NOW())"
-    await execute(query, (employee_id, event_type, reason))
+# time_log пишется через NOW(), то есть во времени БД. Границы дня передаем в UTC
+# и переводим в это время на стороне MySQL, чтобы не зависеть от часового пояса хоста бота.
+_UTC_TO_DB_TIME = "(%s + INTERVAL TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW()) SECOND)"
 
-async def log_approved_time_event(employee_id: int, event_type: str, reason: str, approver_id: int, approval_reason: str):
-    query = "INSERT INTO time_log (employee_id, event_type, reason, timestamp, approver_id, approval_reason) VALUES (%s, %s, %s, NOW(), %s, %s)"
-    await execute(query, (employee_id, event_type, reason, approver_id, approval_reason))
+def _local_day_bounds_utc(day: date, tz: tzinfo):
+    """Начало и конец локального дня day в поясе tz — как naive UTC datetime."""
+    start = datetime.combine(day, time.min, tzinfo=tz).astimezone(pytz.utc).replace(tzinfo=None)
+    end = datetime.combine(day + timedelta(days=1), time.min, tzinfo=tz).astimezone(pytz.utc).replace(tzinfo=None)
+    return start, end
+
+async def get_today_event_counts(employee_id: int) -> Dict[str, int]:
+    """
+    Количество событий по каждой причине за текущий день сотрудника (по его часовому поясу).
+    Загружается одним сгруппированным запросом и дальше поддерживается в памяти
+    через transition_status; в локальную полночь сбрасывается.
+    """
+    employee = await get_employee_by_id(employee_id)
+    tz = get_employee_timezone(employee)
+    today = datetime.now(tz).date()
+
+    entry = _daily_counters.get(employee_id)
+    if entry is not None and entry['day'] == today and entry['tz'] == tz:
+        return dict(entry['counts'])
+
+    day_start, day_end = _local_day_bounds_utc(today, tz)
+
+    version = _daily_counter_versions.get(employee_id, 0)
+    query = """
+        SELECT reason, COUNT(*) as count FROM time_log
+        WHERE employee_id = %s AND timestamp >= {_UTC_TO_DB_TIME} AND timestamp < {_UTC_TO_DB_TIME}
+          AND reason IS NOT NULL
+        GROUP BY reason
+    """.format(_UTC_TO_DB_TIME=_UTC_TO_DB_TIME)
+    rows = await fetch_all(query, (employee_id, day_start, day_end))
+    counts = {row['reason']: row['count'] for row in rows}
+
+    # Если пока шел запрос было записано новое событие, не кэшируем — иначе можем его потерять
+    if _daily_counter_versions.get(employee_id, 0) == version:
+        _daily_counters[employee_id] = {'day': today, 'tz': tz, 'counts': counts}
+    return dict(counts)
 
 async def get_today_event_count(employee_id: int, reason: str) -> int:
-    query = "SELECT COUNT(*) as count FROM time_log WHERE employee_id = %s AND reason = %s AND DATE(timestamp) = CURDATE()"
-    result = await fetch_one(query, (employee_id, reason))
-    return result['count'] if result else 0
+    counts = await get_today_event_counts(employee_id)
+    return counts.get(reason, 0)
 
 async def has_clocked_in_today(employee_id: int) -> bool:
-    query = "SELECT 1 FROM time_log WHERE employee_id = %s AND event_type = 'clock_in' AND DATE(timestamp) = CURDATE()"
-    return await fetch_one(query, (employee_id,)) is not None
+    """Был ли вход на смену в текущий день сотрудника (тот же локальный день, что и в get_today_event_counts)."""
+    employee = await get_employee_by_id(employee_id)
+    tz = get_employee_timezone(employee)
+    day_start, day_end = _local_day_bounds_utc(datetime.now(tz).date(), tz)
+    query = """
+        SELECT 1 FROM time_log
+        WHERE employee_id = %s AND event_type = 'clock_in'
+          AND timestamp >= {_UTC_TO_DB_TIME} AND timestamp < {_UTC_TO_DB_TIME}
+        LIMIT 1
+    """.format(_UTC_TO_DB_TIME=_UTC_TO_DB_TIME)
+    return await fetch_one(query, (employee_id, day_start, day_end)) is not None
 
 # --- Schedule Functions ---
-async def get_employees_for_lateness_check() -> List[Dict[str, Any]]:
+def db_time_to_utc(value: Optional[datetime], db_utc_offset_sec: int) -> Optional[datetime]:
+    """Naive время из БД (записанное через NOW()) -> aware UTC по смещению часового пояса БД."""
+    if value is None:
+        return None
+    return (value - timedelta(seconds=db_utc_offset_sec)).replace(tzinfo=pytz.utc)
+
+async def get_employees_on_break() -> List[Dict[str, Any]]:
+    """
+    Сотрудники на перерыве/обеде. status_changed_at — момент смены статуса в UTC:
+    status_change_timestamp пишется через NOW() во времени БД, и на хосте бота его нельзя читать как местное.
+    """
     query = """
-        SELECT e.id, e.full_name, e.position, e.default_start_time, e.status, so.start_time AS override_start_time, so.is_day_off
-        FROM employees e
-        LEFT JOIN schedule_overrides so ON e.id = so.employee_id AND so.work_date = CURDATE()
-        WHERE e.termination_date IS NULL
-        AND (e.last_lateness_alert_date IS NULL OR e.last_lateness_alert_date != CURDATE())
-        AND e.status = 'offline'
+        SELECT id, full_name, personal_telegram_id, status, status_change_timestamp,
+               TIMESTAMPDIFF(SECOND, UTC_TIMESTAMP(), NOW()) AS db_utc_offset_sec
+        FROM employees WHERE status IN ('on_break', 'on_lunch')
     """
-    return await fetch_all(query)
+    rows = await fetch_all(query)
+    for row in rows:
+        row['status_changed_at'] = db_time_to_utc(row['status_change_timestamp'], row.pop('db_utc_offset_sec'))
+    return rows
 
-async def get_employees_on_break() -> List[Dict[str, Any]]:
-    # --- ИСПРАВЛЕНИЕ: Добавляем current_alert_topic_id ---
-    query = "SELECT id, full_name, personal_telegram_id, status, status_change_timestamp, current_alert_topic_id FROM employees WHERE status IN ('on_break', 'on_lunch')"
-    return await fetch_all(query)
+async def auto_clock_out_all(reason: str) -> Dict[str, Any]:
+    """
+    Выводит с линии всех активных сотрудников одним набором запросов в одной транзакции:
+    блокируем строки, одним INSERT ... SELECT пишем clock_out в time_log и одним UPDATE меняем статусы.
+    Возвращает сводку: сколько и кого вывели (с прежними статусами).
+    """
+    async with _transaction() as cursor:
+        await _execute_in(cursor, """
+            SELECT id, full_name, status FROM employees
+            WHERE status != 'offline' AND termination_date IS NULL
+            FOR UPDATE
+        """)
+        employees = await cursor.fetchall()
+        if not employees:
+            return {'count': 0, 'employees': []}
+
+        ids = [emp['id'] for emp in employees]
+        placeholders = ", ".join(["%s"] * len(ids))
+        await _execute_in(cursor, f"""
+            INSERT INTO time_log (employee_id, event_type, reason, timestamp)
+            SELECT id, 'clock_out', %s, NOW() FROM employees WHERE id IN ({placeholders})
+        """, (reason, *ids))
+        await _execute_in(cursor, f"""
+            UPDATE employees SET status = 'offline', status_change_timestamp = NOW()
+            WHERE id IN ({placeholders})
+        """, tuple(ids))
 
-async def get_active_employees_for_reset() -> List[Dict[str, Any]]:
-    return await fetch_all("SELECT id FROM employees WHERE status != 'offline' AND termination_date IS NULL")
+    for employee_id in ids:
+        invalidate_employee_cache(employee_id)
+        _bump_daily_counter(employee_id, reason)
+        _emit('status_changed', employee_id=employee_id, status='offline')
+    return {'count': len(employees), 'employees': employees}
 
 # --- Deals Table Functions ---
 async def check_conflicting_deals(employee_id: int, time_window_minutes: int) -> List[Dict[str, Any]]:
@@ -130,10 +754,7 @@ async def check_conflicting_deals(employee_id: int, time_window_minutes: int) ->
           AND datetime_meeting BETWEEN NOW() AND NOW() + INTERVAL %s MINUTE
     """
 
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.execute(query, (employee_id, time_window_minutes))
-            return await cursor.fetchall()
+    return await fetch_all(query, (employee_id, time_window_minutes))
         
 async def add_employee(employee_data: dict) -> int:
     """Гибко добавляет нового сотрудника, включая необязательные поля."""
@@ -199,6 +820,11 @@ async def update_employee_field(employee_id: int, field: str, value: Any):
 
     query = f"UPDATE employees SET `{field}` = %s WHERE id = %s"
     await execute(query, (value, employee_id))
+    invalidate_employee_cache(employee_id)
+    if field == 'city':
+        _employee_timezones.pop(employee_id, None)
+    if field in _SCHEDULE_FIELDS:
+        bump_schedule_version(employee_id)
 
 async def sync_employee_full_name(employee_id: int):
     """
@@ -211,6 +837,7 @@ async def sync_employee_full_name(employee_id: int):
         WHERE id = %s
     """
     await execute(query, (employee_id,))
+    invalidate_employee_cache(employee_id)
 
 async def find_employee_by_field(field: str, value: Any) -> Optional[Dict[str, Any]]:
     """
@@ -226,24 +853,42 @@ async def find_employee_by_field(field: str, value: Any) -> Optional[Dict[str, A
     query = f"SELECT id, full_name FROM employees WHERE `{field}` = %s AND termination_date IS NULL"
     return await fetch_one(query, (value,))
 
+_ALL_EMPLOYEES_QUERY = "SELECT id, full_name, position, city FROM employees WHERE termination_date IS NULL ORDER BY full_name"
+
 async def get_all_employees() -> List[Dict[str, Any]]:
     """Возвращает список всех не уволенных сотрудников с деталями."""
 
-    query = "SELECT id, full_name, position, city FROM employees WHERE termination_date IS NULL ORDER BY full_name"
-    return await fetch_all(query)
+    return await fetch_all(_ALL_EMPLOYEES_QUERY)
 
-async def set_schedule_override(employee_id: int, work_date: str, is_day_off: bool, start_time: str = None, end_time: str = None):
-    """Устанавливает или обновляет исключение в графике."""
-    # --- ИСПРАВЛЕНИЕ: VALUES() заменено на современный синтаксис с псевдонимом ---
-    query = """
-        INSERT INTO schedule_overrides (employee_id, work_date, is_day_off, start_time, end_time)
-        VALUES (%s, %s, %s, %s, %s) AS new_values
-        ON DUPLICATE KEY UPDATE
-        is_day_off = new_values.is_day_off, 
-        start_time = new_values.start_time, 
-        end_time = new_values.end_time
+async def iter_employee_pages(page_size: int) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    То же, что get_all_employees, но страницами по page_size (по ФИО, затем id; без ФИО — в начале). Каждая страница —
+    отдельный короткий запрос, поэтому между страницами соединение свободно и потребитель может
+    выполнять свои запросы (в отличие от stream_rows, где соединение занято до конца чтения).
     """
-    await execute(query, (employee_id, work_date, is_day_off, start_time, end_time))
+    # NULL в full_name не проходит сравнение с ключом страницы — сортируем и листаем по COALESCE
+    base = "SELECT id, full_name, position, city FROM employees WHERE termination_date IS NULL"
+    order = "ORDER BY COALESCE(full_name, ''), id LIMIT %s"
+    last = None
+    while True:
+        if last is None:
+            page = await fetch_all(f"{base} {order}", (page_size,), read_only=True)
+        else:
+            last_name = last['full_name'] or ''
+            page = await fetch_all(
+                f"{base} AND (COALESCE(full_name, '') > %s OR (COALESCE(full_name, '') = %s AND id > %s)) {order}",
+                (last_name, last_name, last['id'], page_size), read_only=True
+            )
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        last = page[-1]
+
+async def set_schedule_override(employee_id: int, work_date: str, is_day_off: bool, start_time: str = None, end_time: str = None):
+    """Устанавливает или обновляет исключение в графике на один день."""
+    await set_schedule_override_for_period(employee_id, work_date, work_date, is_day_off, start_time, end_time)
 
 async def log_employee_change(admin_id: int, employee_id: int, field: str, old_value: Any, new_value: Any, reason: str):
     """Записывает изменение данных сотрудника в лог аудита."""
@@ -254,51 +899,209 @@ async def log_employee_change(admin_id: int, employee_id: int, field: str, old_v
     # Преобразуем значения в строки для универсального хранения
     old_value_str = str(old_value) if old_value is not None else 'NULL'
     new_value_str = str(new_value) if new_value is not None else 'NULL'
-    
+
+    if _write_behind is not None:
+        _enqueue_log_record('employee_audit_log', [admin_id, employee_id, field, old_value_str, new_value_str, reason])
+        return
     await execute(query, (admin_id, employee_id, field, old_value_str, new_value_str, reason))
 
+def _time_key(value: Any) -> Optional[str]:
+    """Приводит время из БД (timedelta) или из кода ('HH:MM', time) к 'HH:MM' для сравнения."""
+    minutes = schedule_engine.to_minutes(value)
+    return schedule_engine.format_minutes(minutes) if minutes is not None else None
+
+def _override_key(row: Dict[str, Any]) -> tuple:
+    """Параметры исключения без дат: одинаковые соседние диапазоны можно склеить."""
+    return (
+        bool(row['is_day_off']), _time_key(row['start_time']), _time_key(row['end_time']),
+        row.get('comment') or None, row.get('segments') or None,
+    )
+
+_OVERRIDE_INSERT = """
+    INSERT INTO schedule_overrides (employee_id, work_date, end_date, is_day_off, start_time, end_time, comment, segments)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+def _subtract_dates(row: Dict[str, Any], entries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Части диапазона row, не покрытые новыми записями entries (отсортированы и не пересекаются)."""
+    pieces = []
+    cursor_date = row['work_date']
+    for entry in entries:
+        if entry['end_date'] < cursor_date or entry['work_date'] > row['end_date']:
+            continue
+        if entry['work_date'] > cursor_date:
+            pieces.append({**row, 'work_date': cursor_date, 'end_date': entry['work_date'] - timedelta(days=1)})
+        cursor_date = entry['end_date'] + timedelta(days=1)
+    if cursor_date <= row['end_date']:
+        pieces.append({**row, 'work_date': cursor_date, 'end_date': row['end_date']})
+    return pieces
+
+async def write_schedule_overrides(employee_id: int, entries: List[Dict[str, Any]]):
+    """
+    Записывает набор исключений сотрудника одной транзакцией: один SELECT ... FOR UPDATE,
+    один DELETE и один многострочный INSERT, сколько бы дней ни затрагивалось.
+    entries — словари с work_date, end_date (date), is_day_off, start_time, end_time, comment, segments;
+    диапазоны не должны пересекаться. Старые диапазоны обрезаются/разрезаются,
+    соседние с одинаковыми параметрами склеиваются.
+    """
+    if not entries:
+        return
+    entries = sorted(entries, key=lambda e: e['work_date'])
+
+    async with _transaction() as cursor:
+        # Берем все диапазоны, пересекающие или вплотную прилегающие к затрагиваемому периоду
+        await _execute_in(cursor, """
+            SELECT * FROM schedule_overrides
+            WHERE employee_id = %s AND work_date <= %s AND end_date >= %s
+            ORDER BY work_date
+            FOR UPDATE
+        """, (employee_id, entries[-1]['end_date'] + timedelta(days=1), entries[0]['work_date'] - timedelta(days=1)))
+        existing = await cursor.fetchall()
+
+        pieces = list(entries)
+        for row in existing:
+            pieces.extend(_subtract_dates(row, entries))
+        pieces.sort(key=lambda p: p['work_date'])
+
+        merged = []
+        for piece in pieces:
+            prev = merged[-1] if merged else None
+            if (prev is not None
+                    and prev['end_date'] + timedelta(days=1) == piece['work_date']
+                    and _override_key(prev) == _override_key(piece)):
+                prev['end_date'] = piece['end_date']
+            else:
+                merged.append(dict(piece))
+
+        if existing:
+            placeholders = ", ".join(["%s"] * len(existing))
+            await _execute_in(
+                cursor,
+                f"DELETE FROM schedule_overrides WHERE employee_id = %s AND work_date IN ({placeholders})",
+                (employee_id, *[row['work_date'] for row in existing])
+            )
+        await _executemany_in(cursor, _OVERRIDE_INSERT, [
+            (employee_id, r['work_date'], r['end_date'], r['is_day_off'],
+             r['start_time'], r['end_time'], r.get('comment'), r.get('segments'))
+            for r in merged
+        ])
+    bump_schedule_version(employee_id)
+
 async def set_schedule_override_for_period(employee_id: int, start_date_str: str, end_date_str: str, is_day_off: bool, start_time: str = None, end_time: str = None, comment: str = None):
-    """Устанавливает или обновляет исключения в графике для целого периода дат."""
-    
-    start_date = date.fromisoformat(start_date_str)
-    end_date = date.fromisoformat(end_date_str)
-    delta = end_date - start_date
-    
-    dates_to_update = [(start_date + timedelta(days=i)).isoformat() for i in range(delta.days + 1)]
-    
-    # Добавили поле comment
-    query = """
-        INSERT INTO schedule_overrides (employee_id, work_date, is_day_off, start_time, end_time, comment)
-        VALUES (%s, %s, %s, %s, %s, %s) AS new_values
-        ON DUPLICATE KEY UPDATE
-        is_day_off = new_values.is_day_off, 
-        start_time = new_values.start_time, 
-        end_time = new_values.end_time,
-        comment = new_values.comment
     """
-    
-    args_list = [
-        (employee_id, d, is_day_off, start_time, end_time, comment) for d in dates_to_update
-    ]
-    
-    async with pool.acquire() as conn:
-        async with conn.cursor() as cursor:
-            await cursor.executemany(query, args_list)
+    Устанавливает исключение в графике на период — одной строкой-диапазоном [work_date, end_date].
+    Пересекающиеся диапазоны обрезаются (или разрезаются на два), соседние с теми же параметрами склеиваются.
+    """
+    await write_schedule_overrides(employee_id, [{
+        'work_date': date.fromisoformat(start_date_str), 'end_date': date.fromisoformat(end_date_str),
+        'is_day_off': is_day_off, 'start_time': start_time, 'end_time': end_time,
+        'comment': comment, 'segments': None,
+    }])
 
-async def get_employee_schedule_for_period(employee_id: int, start_date: date, end_date: date) -> List[Dict[str, Any]]:
+async def apply_absence_to_schedule(employee_id: int, start_date: date, end_date: date, absence_start: str, absence_end: str) -> int:
     """
-    Собирает полный график сотрудника на заданный период.
+    Вычитает отсутствие [absence_start, absence_end) из рабочего времени каждого дня периода.
+    График за весь период читается одним запросом, результат пишется одной пачкой.
+    Отсутствие посередине смены дает разорванную смену: start_time/end_time — внешние границы,
+    segments — рабочие куски ('09:00-11:00,12:00-18:00').
+    Возвращает число измененных дней.
     """
-    employee = await get_employee_by_id(employee_id)
-    if not employee:
-        return []
+    absence = schedule_engine.day_interval(absence_start, absence_end)
+    if absence is None:
+        return 0
+    schedule = await get_employee_schedule_for_period(employee_id, start_date, end_date)
+
+    entries = []
+    for day in schedule:
+        if day['status'] != 'Работа' or not day['start_time'] or not day['end_time']:
+            continue
+        work_segments = schedule_engine.parse_segments(day.get('segments')) \
+            or [schedule_engine.day_interval(day['start_time'], day['end_time'])]
+        remaining = schedule_engine.subtract_absence(work_segments, absence)
+        if remaining == work_segments:
+            continue
+
+        entry = {'work_date': day['date'], 'end_date': day['date'], 'segments': None}
+        if not remaining:
+            entry.update(is_day_off=True, start_time=None, end_time=None, comment="Отсутствие весь день")
+        else:
+            new_start, new_end = remaining[0][0], remaining[-1][1]
+            entry.update(
+                is_day_off=False,
+                start_time=schedule_engine.format_minutes(new_start),
+                end_time=schedule_engine.format_minutes(new_end),
+            )
+            if len(remaining) > 1:
+                entry['segments'] = schedule_engine.format_segments(remaining)
+                entry['comment'] = f"Отсутствие {absence_start}-{absence_end}"
+            elif new_end < work_segments[-1][1]:
+                entry['comment'] = f"Уход раньше ({entry['end_time']})"
+            else:
+                entry['comment'] = f"Поздний приход (с {entry['start_time']})"
+        entries.append(entry)
+
+    await write_schedule_overrides(employee_id, entries)
+    return len(entries)
+
+async def compact_schedule_overrides(employee_id: Optional[int] = None) -> Dict[str, int]:
+    """
+    Склеивает соседние исключения с одинаковыми параметрами в один диапазон
+    (в первую очередь — старые построчные записи "один день — одна строка").
+    Каждый сотрудник обрабатывается в своей транзакции.
+    """
+    if employee_id is None:
+        rows = await fetch_all("SELECT DISTINCT employee_id FROM schedule_overrides")
+        employee_ids = [row['employee_id'] for row in rows]
+    else:
+        employee_ids = [employee_id]
+
+    result = {'employees': 0, 'ranges_extended': 0, 'rows_removed': 0}
+    for emp_id in employee_ids:
+        async with _transaction() as cursor:
+            await _execute_in(
+                cursor,
+                "SELECT * FROM schedule_overrides WHERE employee_id = %s ORDER BY work_date FOR UPDATE",
+                (emp_id,)
+            )
+            rows = await cursor.fetchall()
 
-    # Получаем исключения включая комментарий
-    query = "SELECT * FROM schedule_overrides WHERE employee_id = %s AND work_date BETWEEN %s AND %s"
-    overrides_list = await fetch_all(query, (employee_id, start_date, end_date))
-    overrides = {ov['work_date'].isoformat(): ov for ov in overrides_list}
+            extended = []   # (новый end_date, work_date первой строки группы)
+            to_delete = []
+            current = None
+            current_end = None
+            for row in rows:
+                if (current is not None
+                        and row['work_date'] == current_end + timedelta(days=1)
+                        and _override_key(row) == _override_key(current)):
+                    current_end = row['end_date']
+                    to_delete.append(row['work_date'])
+                    continue
+                if current is not None and current_end != current['end_date']:
+                    extended.append((current_end, current['work_date']))
+                current, current_end = row, row['end_date']
+            if current is not None and current_end != current['end_date']:
+                extended.append((current_end, current['work_date']))
 
-    schedule_pattern = employee.get('schedule_pattern', '5/2')
+            if not to_delete:
+                continue
+            placeholders = ", ".join(["%s"] * len(to_delete))
+            await _execute_in(
+                cursor,
+                f"DELETE FROM schedule_overrides WHERE employee_id = %s AND work_date IN ({placeholders})",
+                (emp_id, *to_delete)
+            )
+            await _executemany_in(
+                cursor,
+                "UPDATE schedule_overrides SET end_date = %s WHERE employee_id = %s AND work_date = %s",
+                [(new_end, emp_id, work_date) for new_end, work_date in extended]
+            )
+        result['employees'] += 1
+        result['ranges_extended'] += len(extended)
+        result['rows_removed'] += len(to_delete)
+    return result
+
+def _schedule_anchor(employee: Dict[str, Any], start_date: date) -> date:
+    """Дата, от которой отсчитывается цикл графика: начало графика, иначе дата найма, иначе начало периода."""
     anchor_date = employee.get('schedule_start_date')
     if not anchor_date:
         hire = employee.get('hire_date')
@@ -306,60 +1109,123 @@ async def get_employee_schedule_for_period(employee_id: int, start_date: date, e
         anchor_date = hire if hire else start_date
     elif isinstance(anchor_date, str):
         anchor_date = date.fromisoformat(anchor_date)
+    return anchor_date
 
-    final_schedule = []
-    current_date = start_date
-    
-    while current_date <= end_date:
-        day_info = {'date': current_date, 'comment': None} # Добавили поле comment по умолчанию
-        date_str = current_date.isoformat()
-        
-        is_default_weekend = False
-        
-        # --- ЛОГИКА ГРАФИКОВ (остается без изменений, сокращено для краткости) ---
-        if schedule_pattern == '2/2':
-            days_diff = (current_date - anchor_date).days
-            cycle_day = days_diff % 4 
-            if cycle_day >= 2: is_default_weekend = True
-        elif schedule_pattern == '6/1':
-            if current_date.weekday() == 6: is_default_weekend = True
-        elif schedule_pattern == '7/0':
-            is_default_weekend = False
-        else: # 5/2
-            if current_date.weekday() in [5, 6]: is_default_weekend = True
-
-        # 3. Применяем исключения
-        if date_str in overrides:
-            override = overrides[date_str]
-            day_info['comment'] = override.get('comment') # Заполняем комментарий
-            
-            if override['is_day_off']:
-                day_info['status'] = 'Отгул/Больничный'
-                day_info['start_time'] = None
-                day_info['end_time'] = None
-            else:
-                day_info['status'] = 'Работа'
-                day_info['start_time'] = override['start_time']
-                day_info['end_time'] = override['end_time']
+def _build_schedules(employees: List[Dict[str, Any]], overrides: List[Dict[str, Any]], start_date: date, end_date: date) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Строит графики сотрудников в памяти по их карточкам и исключениям (диапазонам [work_date, end_date]).
+    Рабочие/выходные дни и наложение исключений считает schedule_engine сразу для всех; здесь — только сборка дней.
+    """
+    row_of = {emp['id']: row for row, emp in enumerate(employees)}
+    overrides = [ov for ov in overrides if ov['employee_id'] in row_of]
+
+    masks = schedule_engine.work_masks(
+        [emp.get('schedule_pattern') for emp in employees],
+        [_schedule_anchor(emp, start_date) for emp in employees],
+        start_date, end_date
+    )
+    sources = schedule_engine.override_index(
+        len(employees), start_date, end_date,
+        [row_of[ov['employee_id']] for ov in overrides],
+        [ov['work_date'] for ov in overrides],
+        [ov['end_date'] for ov in overrides]
+    )
+    dates = [start_date + timedelta(days=i) for i in range(masks.shape[1])]
+
+    # Дни-исключения одинаковы для всех дат диапазона — готовим их заранее, в цикле только копируем
+    # Время приводится к DayTime здесь, один раз на шаблон, — дальше по коду его не нужно разбирать
+    day_time = schedule_engine.DayTime.parse
+    override_days = []
+    for override in overrides:
+        if override['is_day_off']:
+            override_days.append({'status': 'Отгул/Больничный', 'start_time': None, 'end_time': None, 'comment': override.get('comment'), 'segments': None})
         else:
-            if is_default_weekend:
-                day_info['status'] = 'Выходной'
-                day_info['start_time'] = None
-                day_info['end_time'] = None
+            override_days.append({'status': 'Работа', 'start_time': day_time(override['start_time']), 'end_time': day_time(override['end_time']), 'comment': override.get('comment'), 'segments': override.get('segments')})
+
+    result = {}
+    for row, employee in enumerate(employees):
+        work_day = {'status': 'Работа', 'start_time': day_time(employee['default_start_time']), 'end_time': day_time(employee['default_end_time']), 'comment': None, 'segments': None}
+        day_off = {'status': 'Выходной', 'start_time': None, 'end_time': None, 'comment': None, 'segments': None}
+        final_schedule = []
+        for current_date, is_work_day, source in zip(dates, masks[row].tolist(), sources[row].tolist()):
+            # Исключения важнее базового графика
+            if source >= 0:
+                template = override_days[source]
             else:
-                day_info['status'] = 'Работа'
-                day_info['start_time'] = employee['default_start_time']
-                day_info['end_time'] = employee['default_end_time']
-        
-        final_schedule.append(day_info)
-        current_date += timedelta(days=1)
-        
-    return final_schedule
+                template = work_day if is_work_day else day_off
+            final_schedule.append({'date': current_date, **template})
+        result[employee['id']] = final_schedule
+    return result
+
+async def get_schedules_for_employees(employee_ids: List[int], start_date: date, end_date: date,
+                                     read_only: bool = False) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Собирает графики сразу для нескольких сотрудников за период.
+    Периоды до SCHEDULE_CACHE_MAX_DAYS дней отдаются из кэша; для остальных сотрудников —
+    два запроса (карточки + исключения за период), дальше всё считается в памяти.
+    Возвращает словарь {employee_id: список дней}. Несуществующие ID в результат не попадают.
+    read_only=True — для отчетов: запросы можно выполнить на реплике.
+    """
+    ids = list(dict.fromkeys(employee_ids))
+    if not ids:
+        return {}
+
+    # Короткие периоды (день, неделя, месяц) берем из кэша; считаем только тех, кого в нем нет
+    cacheable = (end_date - start_date).days + 1 <= SCHEDULE_CACHE_MAX_DAYS
+    result: Dict[int, List[Dict[str, Any]]] = {}
+    if cacheable:
+        dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        for employee_id in ids:
+            cached = _get_cached_schedule(employee_id, dates)
+            if cached is not None:
+                result[employee_id] = cached
+        ids = [employee_id for employee_id in ids if employee_id not in result]
+        if not ids:
+            return result
+
+    # Версии фиксируем до чтения: если график поменяется во время запроса, записанное в кэш сразу устареет.
+    # Данные с реплики в кэш не кладем — она может отставать от только что сделанной записи.
+    versions = {employee_id: _schedule_versions.get(employee_id, 0) for employee_id in ids}
+    store = cacheable and not _use_replica(read_only)
+
+    loaded = await _load_schedules(ids, start_date, end_date, read_only)
+    for employee_id, days in loaded.items():
+        if store:
+            for day in days:
+                _schedule_cache.set((employee_id, day['date']), (versions[employee_id], dict(day)))
+        result[employee_id] = days
+    return result
+
+async def _load_schedules(ids: List[int], start_date: date, end_date: date, read_only: bool) -> Dict[int, List[Dict[str, Any]]]:
+    """Два запроса (карточки + исключения за период) и расчет графиков в памяти."""
+    placeholders = ", ".join(["%s"] * len(ids))
+    employees = await fetch_all(f"SELECT * FROM employees WHERE id IN ({placeholders})", tuple(ids), read_only=read_only)
+    if not employees:
+        return {}
+
+    # Получаем исключения (диапазоны, пересекающие период) включая комментарий
+    query = f"""
+        SELECT * FROM schedule_overrides
+        WHERE employee_id IN ({placeholders}) AND work_date <= %s AND end_date >= %s
+        ORDER BY employee_id, work_date
+    """
+    overrides_list = await fetch_all(query, (*ids, end_date, start_date), read_only=read_only)
+
+    return _build_schedules(employees, overrides_list, start_date, end_date)
+
+async def get_employee_schedule_for_period(employee_id: int, start_date: date, end_date: date,
+                                           read_only: bool = False) -> List[Dict[str, Any]]:
+    """
+    Собирает полный график сотрудника на заданный период.
+    """
+    schedules = await get_schedules_for_employees([employee_id], start_date, end_date, read_only=read_only)
+    return schedules.get(employee_id, [])
 
 async def get_all_schedule_overrides_for_period(start_date: date, end_date: date) -> List[Dict[str, Any]]:
     query = """
         SELECT 
             so.work_date,
+            so.end_date,
             so.is_day_off,
             so.start_time,
             so.end_time,
@@ -367,10 +1233,14 @@ async def get_all_schedule_overrides_for_period(start_date: date, end_date: date
             e.full_name
         FROM schedule_overrides so
         JOIN employees e ON so.employee_id = e.id
-        WHERE so.work_date BETWEEN %s AND %s
+        WHERE so.work_date <= %s AND so.end_date >= %s
         ORDER BY e.full_name, so.work_date
     """
-    return await fetch_all(query, (start_date, end_date))
+    rows = await fetch_all(query, (end_date, start_date), read_only=True)
+    for row in rows:
+        row['start_time'] = schedule_engine.DayTime.parse(row['start_time'])
+        row['end_time'] = schedule_engine.DayTime.parse(row['end_time'])
+    return rows
 
 async def find_conflicting_deals_for_schedule(employee_id: int, start_date_str: str, end_date_str: str, work_start_time_str: str = None, work_end_time_str: str = None) -> List[Dict[str, Any]]:
     """
@@ -378,6 +1248,8 @@ async def find_conflicting_deals_for_schedule(employee_id: int, start_date_str:
     Если время не указано, ищет любые сделки в эти дни (т.к. они считаются выходными).
     """
     
+    # Диапазон дат — полуоткрытый интервал по самому столбцу, чтобы работал индекс
+    # (employee_id, status, datetime_meeting); TIME() остается лишь фильтром по уже отобранным строкам.
     # Если время указано, ищем сделки, которые находятся ВНЕ этого рабочего интервала
     if work_start_time_str and work_end_time_str:
         time_condition = "AND (TIME(datetime_meeting) < %s OR TIME(datetime_meeting) > %s)"
@@ -391,12 +1263,12 @@ async def find_conflicting_deals_for_schedule(employee_id: int, start_date_str:
         FROM CryptoDeals
         WHERE employee_id = %s
           AND status != 'closed'
-          AND DATE(datetime_meeting) BETWEEN %s AND %s
+          AND datetime_meeting >= %s AND datetime_meeting < DATE_ADD(%s, INTERVAL 1 DAY)
           {time_condition}
         ORDER BY datetime_meeting
     """
 
-    return await fetch_all(query, args)
+    return await fetch_all(query, args, read_only=True)
 
 async def add_relative(employee_id: int, relative_data: dict):
     """Добавляет родственника в отдельную таблицу."""
@@ -440,6 +1312,7 @@ async def fire_employee(employee_id: int):
     """
     query = "UPDATE employees SET termination_date = CURDATE(), status = 'offline' WHERE id = %s"
     await execute(query, (employee_id,))
+    invalidate_employee_cache(employee_id)
 
 async def delete_employee_permanently(employee_id: int):
     """
@@ -450,6 +1323,9 @@ async def delete_employee_permanently(employee_id: int):
     await execute("DELETE FROM schedule_overrides WHERE employee_id = %s", (employee_id,))
     
     await execute("DELETE FROM employees WHERE id = %s", (employee_id,))
+    invalidate_employee_cache(employee_id)
+    _employee_timezones.pop(employee_id, None)
+    bump_schedule_version(employee_id)
 
 async def get_unique_positions() -> List[str]:
     """Возвращает список уникальных должностей, исключая пустые."""
@@ -480,7 +1356,7 @@ async def get_today_schedule(employee_id: int) -> Optional[Dict[str, Any]]:
         return None
         
     # 2. Определяем часовой пояс и текущую дату для этого сотрудника
-    tz = get_timezone_for_city(employee.get('city'))
+    tz = get_employee_timezone(employee)
     employee_now = datetime.now(tz)
     today_date = employee_now.date()
     
@@ -518,27 +1394,32 @@ async def find_deals_inside_interval(employee_id: int, start_date_str: str, end_
         FROM CryptoDeals
         WHERE employee_id = %s
           AND status != 'closed'
-          AND DATE(datetime_meeting) BETWEEN %s AND %s
-          AND TIME(datetime_meeting) >= %s 
+          AND datetime_meeting >= %s AND datetime_meeting < DATE_ADD(%s, INTERVAL 1 DAY)
+          AND TIME(datetime_meeting) >= %s
           AND TIME(datetime_meeting) <= %s
         ORDER BY datetime_meeting
     """
-    return await fetch_all(query, (employee_id, start_date_str, end_date_str, interval_start_str, interval_end_str))
+    return await fetch_all(query, (employee_id, start_date_str, end_date_str, interval_start_str, interval_end_str), read_only=True)
+
+# Выбираем все поля, кроме технических (токенов)
+_ALL_EMPLOYEES_FULL_QUERY = """
+    SELECT 
+        id, full_name, position, city, role, 
+        personal_phone, work_phone, personal_telegram_id, personal_telegram_username,
+        schedule_pattern, schedule_start_date, default_start_time, default_end_time,
+        birth_date, hire_date, 
+        passport_data, passport_issued_by, passport_dept_code,
+        registration_address, living_address,
+        status
+    FROM employees 
+    WHERE termination_date IS NULL 
+    ORDER BY full_name
+"""
 
 async def get_all_employees_full() -> List[Dict[str, Any]]:
     """Возвращает ПОЛНЫЕ данные всех сотрудников (включая уволенных, если нужно, но пока берем активных)."""
-    # Выбираем все поля, кроме технических (токенов)
-    query = """
-        SELECT 
-            id, full_name, position, city, role, 
-            personal_phone, work_phone, personal_telegram_id, personal_telegram_username,
-            schedule_pattern, schedule_start_date, default_start_time, default_end_time,
-            birth_date, hire_date, 
-            passport_data, passport_issued_by, passport_dept_code,
-            registration_address, living_address,
-            status
-        FROM employees 
-        WHERE termination_date IS NULL 
-        ORDER BY full_name
-    """
-    return await fetch_all(query)
\ No newline at end of file
+    return await fetch_all(_ALL_EMPLOYEES_FULL_QUERY, read_only=True)
+
+def iter_all_employees_full() -> AsyncIterator[Dict[str, Any]]:
+    """То же, что get_all_employees_full, но построчно через серверный курсор (для выгрузок)."""
+    return stream_rows(_ALL_EMPLOYEES_FULL_QUERY, read_only=True)
\ No newline at end of file
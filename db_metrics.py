@@ -0,0 +1,148 @@
+import logging
+import re
+from collections import deque
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from config import DB_SLOW_QUERY_MS, DB_SLOW_QUERY_LOG_SIZE
+
+slow_logger = logging.getLogger("db_manager.slow_queries")
+
+# Верхние границы корзин гистограммы задержек (мс); последняя корзина — всё, что больше
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_WHITESPACE_RE = re.compile(r"\s+")
+_IN_LIST_RE = re.compile(r"IN \((?:%s, )*%s\)", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def normalize_query(query: str) -> str:
+    """
+    Приводит запрос к общему виду для группировки статистики:
+    схлопывает пробелы и списки `IN (%s, %s, ...)` любой длины.
+    """
+    normalized = _WHITESPACE_RE.sub(" ", query).strip()
+    return _IN_LIST_RE.sub("IN (%s...)", normalized)
+
+
+def args_shape(args: Any) -> str:
+    """Описывает форму аргументов запроса без самих значений (они могут быть персональными данными)."""
+    if not args:
+        return "()"
+    if isinstance(args, list) and isinstance(args[0], (list, tuple, dict)):
+        # executemany: описываем пачку по первой строке
+        return f"{len(args)} x {args_shape(args[0])}"
+    if isinstance(args, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in args.items()) + "}"
+    parts = []
+    for value in args:
+        if isinstance(value, (list, tuple)):
+            parts.append(f"{type(value).__name__}[{len(value)}]")
+        else:
+            parts.append(type(value).__name__)
+    return "(" + ", ".join(parts) + ")"
+
+
+class QueryStats:
+    """Накопленная статистика по одному нормализованному запросу."""
+
+    __slots__ = ("count", "errors", "total_ms", "max_ms", "rows_total", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows_total = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def observe(self, elapsed_ms: float, rows: int, failed: bool):
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+        self.rows_total += rows
+        if failed:
+            self.errors += 1
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, p: float) -> float:
+        """Оценка перцентиля по гистограмме (верхняя граница корзины)."""
+        if not self.count:
+            return 0.0
+        threshold = self.count * p
+        seen = 0
+        for i, bucket_count in enumerate(self.buckets):
+            seen += bucket_count
+            if seen >= threshold:
+                return float(LATENCY_BUCKETS_MS[i]) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def as_dict(self) -> Dict[str, Any]:
+        labels = [f"<={b}ms" for b in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}ms"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "total_ms": round(self.total_ms, 2),
+            "avg_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "rows_total": self.rows_total,
+            "avg_rows": round(self.rows_total / self.count, 2) if self.count else 0.0,
+            "histogram": dict(zip(labels, self.buckets)),
+        }
+
+
+_stats: Dict[str, QueryStats] = {}
+_slow_queries: deque = deque(maxlen=DB_SLOW_QUERY_LOG_SIZE)
+
+
+def record(query: str, args: Any, elapsed_ms: float, rows: int, failed: bool = False) -> Optional[Dict[str, Any]]:
+    """
+    Учитывает выполнение запроса. Если запрос медленнее порога,
+    пишет его в лог медленных запросов и возвращает созданную запись.
+    """
+    key = normalize_query(query)
+    stats = _stats.get(key)
+    if stats is None:
+        stats = _stats[key] = QueryStats()
+    stats.observe(elapsed_ms, rows, failed)
+
+    if elapsed_ms < DB_SLOW_QUERY_MS:
+        return None
+
+    entry = {
+        "at": datetime.now().isoformat(timespec="seconds"),
+        "query": key,
+        "args_shape": args_shape(args),
+        "elapsed_ms": round(elapsed_ms, 2),
+        "rows": rows,
+        "failed": failed,
+        "explain": None,
+    }
+    _slow_queries.append(entry)
+    slow_logger.warning(f"Slow query {entry['elapsed_ms']}ms rows={rows} args={entry['args_shape']}: {key}")
+    return entry
+
+
+def get_query_stats(sort_by: str = "total_ms", limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Статистика по запросам, отсортированная по убыванию выбранной метрики."""
+    result = [{"query": query, **stats.as_dict()} for query, stats in _stats.items()]
+    result.sort(key=lambda item: item.get(sort_by, 0), reverse=True)
+    return result[:limit] if limit else result
+
+
+def get_slow_queries() -> List[Dict[str, Any]]:
+    """Последние медленные запросы (новые в конце)."""
+    return list(_slow_queries)
+
+
+def reset():
+    _stats.clear()
+    _slow_queries.clear()
@@ -0,0 +1,165 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+Callback = Callable[[], Awaitable[None]]
+
+# Дольше этого не спим даже при далеком дедлайне: переживаем перевод системных часов
+_MAX_SLEEP_SEC = 60.0
+
+
+class DeadlineScheduler:
+    """
+    Таймеры "сработать ровно в момент X" для множества ключей (например, ('lateness', employee_id)).
+
+    Дедлайны лежат в куче по времени (UTC timestamp), одна фоновая задача спит до ближайшего.
+    У каждого ключа не больше одного активного таймера: повторный schedule() заменяет старый,
+    cancel() отменяет. Отмена ленивая — запись в куче остается, но ее токен больше не совпадает
+    с актуальным, и при извлечении она просто отбрасывается.
+
+    Таймеры, наступившие одновременно (например, у сорока сотрудников смена с 09:00), выполняются
+    одной пачкой параллельно, но не более max_concurrency одновременно; ошибки собираются по каждому.
+    """
+
+    def __init__(self, max_concurrency: int = 10):
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        # Ключ -> (токен, время, callback) актуального таймера
+        self._active: Dict[Hashable, Tuple[int, float, Callback]] = {}
+        self._tokens = itertools.count(1)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Выполняющиеся пачки: храним ссылки, чтобы задачи не собрал GC и их можно было дождаться в stop()
+        self._batches: Set[asyncio.Task] = set()
+        self._slots = asyncio.Semaphore(max_concurrency)
+
+        self.fired = 0
+        self.cancelled = 0
+        self.errors = 0
+        self.recent_errors: deque = deque(maxlen=50)
+
+    # --- Жизненный цикл ---
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float = 10.0):
+        """Останавливает цикл и дожидается выполняющихся пачек (не дольше timeout, затем отменяет их)."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._batches:
+            _, pending = await asyncio.wait(self._batches, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    # --- Таймеры ---
+    def schedule(self, key: Hashable, when: datetime, callback: Callback) -> int:
+        """
+        Ставит (или переставляет) таймер ключа на момент when (aware datetime).
+        Момент в прошлом — срабатывает сразу. Возвращает токен таймера.
+        """
+        token = next(self._tokens)
+        at = when.timestamp()
+        self._active[key] = (token, at, callback)
+        heapq.heappush(self._heap, (at, token, key))
+        # Будим цикл, только если новый дедлайн стал ближайшим
+        if self._heap[0][1] == token:
+            self._wakeup.set()
+        return token
+
+    def cancel(self, key: Hashable, token: Optional[int] = None) -> bool:
+        """Отменяет таймер ключа (если задан token — только если это все еще тот же таймер)."""
+        current = self._active.get(key)
+        if current is None or (token is not None and current[0] != token):
+            return False
+        del self._active[key]
+        self.cancelled += 1
+        return True
+
+    def cancel_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Отменяет все таймеры, ключи которых подходят под условие."""
+        keys = [key for key in self._active if predicate(key)]
+        for key in keys:
+            self.cancel(key)
+        return len(keys)
+
+    def deadline(self, key: Hashable) -> Optional[float]:
+        current = self._active.get(key)
+        return current[1] if current else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'active': len(self._active),
+            'heap_size': len(self._heap),
+            'fired': self.fired,
+            'cancelled': self.cancelled,
+            'errors': self.errors,
+            'recent_errors': list(self.recent_errors),
+        }
+
+    # --- Внутреннее ---
+    def _pop_due(self, now: float) -> List[Tuple[Hashable, Callback]]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, token, key = heapq.heappop(self._heap)
+            current = self._active.get(key)
+            if current is None or current[0] != token:
+                continue  # таймер отменен или переставлен
+            del self._active[key]
+            due.append((key, current[2]))
+        # Отмененные записи в голове кучи не должны определять время сна
+        while self._heap and self._active.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+        return due
+
+    async def _fire(self, key: Hashable, callback: Callback) -> bool:
+        async with self._slots:
+            try:
+                await callback()
+                self.fired += 1
+                return True
+            except Exception as e:
+                self.errors += 1
+                self.recent_errors.append({
+                    'at': datetime.now().isoformat(timespec='seconds'), 'key': repr(key), 'error': repr(e),
+                })
+                logger.error(f"Deadline callback for {key} failed: {e}")
+                return False
+
+    async def _fire_batch(self, due: List[Tuple[Hashable, Callback]]):
+        results = await asyncio.gather(*(self._fire(key, callback) for key, callback in due))
+        failed = [key for (key, _), ok in zip(due, results) if not ok]
+        if failed:
+            logger.warning(f"Deadlines fired: {len(due)}, failed: {len(failed)} ({failed})")
+        elif len(due) > 1:
+            logger.info(f"Deadlines fired: {len(due)}")
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due(time.time())
+            if due:
+                # Пачку выполняем отдельной задачей: цикл продолжает следить за новыми дедлайнами
+                batch = asyncio.create_task(self._fire_batch(due))
+                self._batches.add(batch)
+                batch.add_done_callback(self._batches.discard)
+
+            timeout = _MAX_SLEEP_SEC
+            if self._heap:
+                timeout = min(max(self._heap[0][0] - time.time(), 0.0), _MAX_SLEEP_SEC)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
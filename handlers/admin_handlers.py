@@ -8,14 +8,13 @@ from telegram.ext import (
     MessageHandler,
     filters,
 )
-from utils import security_required, verify_totp, get_main_keyboard, generate_table_image
+from utils import security_required, verify_totp, get_main_keyboard, generate_table_image, SpooledCsvWriter
+from telegram_dispatcher import get_dispatcher, reply_text, edit_query_text, PRIORITY_APPROVAL
 import db_manager as db_manager
 from telegram.helpers import escape_markdown
 import calendar_helper
-from datetime import date, timedelta,datetime, time
+from datetime import date, timedelta
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove
-import csv
-import io
 import json
 from telegram.error import BadRequest 
 
@@ -96,7 +95,7 @@ EDITABLE_FIELDS = {
 
 async def remove_reply_keyboard(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
     """Отправляет сообщение с удалением кастомной клавиатуры."""
-    await update.message.reply_text(text, reply_markup=ReplyKeyboardRemove())
+    await reply_text(context, update.message, text, reply_markup=ReplyKeyboardRemove())
 
 # ========== ГЛАВНОЕ АДМИН-МЕНЮ ==========
 @security_required
@@ -108,12 +107,12 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     if update.message:
-        msg = await update.message.reply_text("Панель администратора:", reply_markup=reply_markup)
+        msg = await reply_text(context, update.message, "Панель администратора:", reply_markup=reply_markup)
         context.user_data['admin_menu_message_id'] = msg.message_id
         
     elif update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text("Панель администратора:", reply_markup=reply_markup)
+        await edit_query_text(context, update.callback_query, "Панель администратора:", reply_markup=reply_markup)
         context.user_data['admin_menu_message_id'] = update.callback_query.message.message_id
         
     return ADMIN_MAIN_MENU
@@ -129,7 +128,7 @@ async def show_employee_card_menu(update: Update, context: ContextTypes.DEFAULT_
         [InlineKeyboardButton("📂 Просмотр данных", callback_data='admin_view_card_start')], 
         [InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_admin_panel')],
     ]
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         "Меню: Карточка сотрудника",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -146,7 +145,7 @@ async def show_view_card_options(update: Update, context: ContextTypes.DEFAULT_T
         [InlineKeyboardButton("⬅️ Назад", callback_data='go_to_employee_card_menu')],
     ]
     
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         "Как вы хотите просмотреть данные?",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -164,7 +163,7 @@ async def show_schedule_main_menu(update: Update, context: ContextTypes.DEFAULT_
         [InlineKeyboardButton("🗓️ Посмотреть отгулы/больничные", callback_data='view_absences_start')],
         [InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_admin_panel')],
     ]
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         "Меню: Рабочий график",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -187,7 +186,7 @@ async def admin_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
     context.user_data.clear()
     
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "❌ Действие отменено. Вы вернулись в главное меню.", 
         reply_markup=get_main_keyboard(role)
     )
@@ -220,7 +219,7 @@ async def start_select_position(update: Update, context: ContextTypes.DEFAULT_TY
     positions = await db_manager.get_unique_positions()
     
     if not positions:
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             "В базе нет сотрудников с указанными должностями.", 
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data='back_to_admin_panel')]])
         )
@@ -249,7 +248,7 @@ async def start_select_position(update: Update, context: ContextTypes.DEFAULT_TY
         'view_card_details': "Просмотр карточки"
     }
     
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         f"*{titles.get(action_type, 'Выбор')}*\nВыберите должность:",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='Markdown'
@@ -273,7 +272,7 @@ async def select_employee_by_position(update: Update, context: ContextTypes.DEFA
 
     # Если бот перезагрузился и память очистилась, отправляем назад
     if not position:
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             "⚠️ Данные устарели. Пожалуйста, начните выбор сначала.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔄 В начало", callback_data='back_to_admin_panel')]])
         )
@@ -293,7 +292,7 @@ async def select_employee_by_position(update: Update, context: ContextTypes.DEFA
     # Экранируем название должности для Markdown, чтобы не ломалось на символах вроде "-", "."
     safe_position = escape_markdown(position, version=1)
 
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         f"Сотрудники в должности *{safe_position}*:",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='Markdown'
@@ -336,7 +335,7 @@ async def route_selected_employee(update: Update, context: ContextTypes.DEFAULT_
             [InlineKeyboardButton("⬅️ Назад к выбору должности", callback_data='back_to_positions')],
         ]
         
-        await query.edit_message_text("Выберите период для просмотра:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_query_text(context, query, "Выберите период для просмотра:", reply_markup=InlineKeyboardMarkup(keyboard))
         return VIEW_SCHEDULE_SELECT_PERIOD
         
     elif action_type == 'edit_schedule':
@@ -379,11 +378,11 @@ async def route_selected_employee(update: Update, context: ContextTypes.DEFAULT_
         ]
         
         # ВАЖНО: меняем parse_mode на 'HTML'
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+        await edit_query_text(context, query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
         return SELECT_EMPLOYEE_FROM_LIST
         
     else:
-        await query.edit_message_text("Ошибка: неизвестное действие.")
+        await edit_query_text(context, query, "Ошибка: неизвестное действие.")
         return ADMIN_MAIN_MENU
     
 async def generate_all_employees_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -391,53 +390,49 @@ async def generate_all_employees_report(update: Update, context: ContextTypes.DE
     query = update.callback_query
     await query.answer("Генерация файла...")
     
-    employees = await db_manager.get_all_employees_full()
-    
-    if not employees:
-        await query.edit_message_text("Нет сотрудников в базе.")
-        return VIEW_CARD_OPTIONS
-
-    output = io.StringIO()
     # Используем запятую или точку с запятой в зависимости от предпочтений Excel
-    writer = csv.writer(output, delimiter=';')
-    
-    # Заголовки
-    headers = [
-        'ID', 'ФИО', 'Должность', 'Город', 'Роль', 'Статус',
-        'Личный телефон', 'Рабочий телефон', 'Telegram ID', 'Username',
-        'График', 'Дата начала', 'Начало (чч:мм)', 'Конец (чч:мм)',
-        'Дата рождения', 'Дата найма',
-        'Паспорт', 'Кем выдан', 'Код подр.',
-        'Адрес регистрации', 'Адрес проживания'
-    ]
-    writer.writerow(headers)
-    
-    for emp in employees:
-        row = [
-            emp.get('id'), emp.get('full_name'), emp.get('position'), emp.get('city'), emp.get('role'), emp.get('status'),
-            emp.get('personal_phone'), emp.get('work_phone'), emp.get('personal_telegram_id'), emp.get('personal_telegram_username'),
-            emp.get('schedule_pattern'), emp.get('schedule_start_date'), emp.get('default_start_time'), emp.get('default_end_time'),
-            emp.get('birth_date'), emp.get('hire_date'),
-            emp.get('passport_data'), emp.get('passport_issued_by'), emp.get('passport_dept_code'),
-            emp.get('registration_address'), emp.get('living_address')
+    # utf-8-sig (BOM) — для корректного отображения кириллицы в Excel
+    with SpooledCsvWriter(delimiter=';') as writer:
+        # Заголовки
+        headers = [
+            'ID', 'ФИО', 'Должность', 'Город', 'Роль', 'Статус',
+            'Личный телефон', 'Рабочий телефон', 'Telegram ID', 'Username',
+            'График', 'Дата начала', 'Начало (чч:мм)', 'Конец (чч:мм)',
+            'Дата рождения', 'Дата найма',
+            'Паспорт', 'Кем выдан', 'Код подр.',
+            'Адрес регистрации', 'Адрес проживания'
         ]
-        # Заменяем None на пустую строку
-        row = [str(x) if x is not None else "" for x in row]
-        writer.writerow(row)
-        
-    output.seek(0)
-    # Используем utf-8-sig для корректного отображения кириллицы в Excel
-    bio = io.BytesIO(output.getvalue().encode('utf-8-sig'))
-    bio.name = f"All_Employees_Data_{date.today()}.csv"
-    
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=bio,
-        caption=f"📂 Полная выгрузка данных сотрудников ({len(employees)} чел.)"
-    )
+        writer.writerow(headers)
+
+        # Строки идут из БД потоком и сразу пишутся в файл — весь список в памяти не собирается
+        employees_count = 0
+        async for emp in db_manager.iter_all_employees_full():
+            row = [
+                emp.get('id'), emp.get('full_name'), emp.get('position'), emp.get('city'), emp.get('role'), emp.get('status'),
+                emp.get('personal_phone'), emp.get('work_phone'), emp.get('personal_telegram_id'), emp.get('personal_telegram_username'),
+                emp.get('schedule_pattern'), emp.get('schedule_start_date'), emp.get('default_start_time'), emp.get('default_end_time'),
+                emp.get('birth_date'), emp.get('hire_date'),
+                emp.get('passport_data'), emp.get('passport_issued_by'), emp.get('passport_dept_code'),
+                emp.get('registration_address'), emp.get('living_address')
+            ]
+            # Заменяем None на пустую строку
+            row = [str(x) if x is not None else "" for x in row]
+            writer.writerow(row)
+            employees_count += 1
+
+        if not employees_count:
+            await edit_query_text(context, query, "Нет сотрудников в базе.")
+            return VIEW_CARD_OPTIONS
+
+        await get_dispatcher(context).send_document(
+            chat_id=update.effective_chat.id,
+            document=writer.getfile(),
+            filename=f"All_Employees_Data_{date.today()}.csv",
+            caption=f"📂 Полная выгрузка данных сотрудников ({employees_count} чел.)"
+        )
     
     keyboard = [[InlineKeyboardButton("⬅️ Назад", callback_data='go_to_employee_card_menu')]]
-    await query.edit_message_text("Файл отправлен.", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Файл отправлен.", reply_markup=InlineKeyboardMarkup(keyboard))
     return VIEW_CARD_OPTIONS
     
 async def start_add_employee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -450,17 +445,17 @@ async def start_add_employee(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data['new_employee'] = {}
     cancel_kb = ReplyKeyboardMarkup([[KeyboardButton("❌ Отмена")]], resize_keyboard=True)
     
-    await query.message.reply_text("Начинаем добавление нового сотрудника.\nВведите **Фамилию** (или нажмите '❌ Отмена' для выхода):", reply_markup=cancel_kb, parse_mode='Markdown')
+    await reply_text(context, query.message, "Начинаем добавление нового сотрудника.\nВведите **Фамилию** (или нажмите '❌ Отмена' для выхода):", reply_markup=cancel_kb, parse_mode='Markdown')
     return ADD_LAST_NAME
 
 async def get_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_employee']['last_name'] = update.message.text.strip()
-    await update.message.reply_text("Отлично. Теперь введите **Имя**:", parse_mode='Markdown')
+    await reply_text(context, update.message, "Отлично. Теперь введите **Имя**:", parse_mode='Markdown')
     return ADD_FIRST_NAME
 
 async def get_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_employee']['first_name'] = update.message.text.strip()
-    await update.message.reply_text("Хорошо. Введите **Отчество** (если нет, поставьте прочерк '-'):", parse_mode='Markdown')
+    await reply_text(context, update.message, "Хорошо. Введите **Отчество** (если нет, поставьте прочерк '-'):", parse_mode='Markdown')
     return ADD_MIDDLE_NAME
 
 async def get_middle_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -470,14 +465,14 @@ async def get_middle_name(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         context.user_data['new_employee']['middle_name'] = text
 
-    await update.message.reply_text("Принято. Введите **Город** проживания сотрудника:", parse_mode='Markdown')
+    await reply_text(context, update.message, "Принято. Введите **Город** проживания сотрудника:", parse_mode='Markdown')
     return ADD_CITY
 
 async def get_city(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     city = update.message.text.strip()
     context.user_data['new_employee']['city'] = city
     
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Город сохранен.\n\n"
         "Введите **Личный номер телефона** (текстом, например: +79990001122):", 
         parse_mode='Markdown'
@@ -493,7 +488,7 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     keyboard_rows = [buttons[i:i+2] for i in range(0, len(buttons), 2)]
     reply_markup = InlineKeyboardMarkup(keyboard_rows)
     
-    await update.message.reply_text("Телефон сохранен. Выберите **Должность**:", reply_markup=reply_markup, parse_mode='Markdown')
+    await reply_text(context, update.message, "Телефон сохранен. Выберите **Должность**:", reply_markup=reply_markup, parse_mode='Markdown')
     return ADD_POSITION
 
 async def get_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -501,7 +496,7 @@ async def get_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     await query.answer()
     position = query.data.split('_', 1)[1]
     context.user_data['new_employee']['position'] = position
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         f"Должность '{position}' установлена.\n\n"
         "Теперь, пожалуйста, **отправьте контакт сотрудника**. Для этого нажмите на 📎 (скрепку), выберите 'Контакт' и найдите нужного пользователя в списке."
     )
@@ -510,7 +505,7 @@ async def get_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     contact = update.message.contact
     if not contact or not contact.user_id:
-        await update.message.reply_text("❌ **Ошибка.** Пожалуйста, отправьте именно контакт пользователя Telegram.")
+        await reply_text(context, update.message, "❌ **Ошибка.** Пожалуйста, отправьте именно контакт пользователя Telegram.")
         return AWAITING_CONTACT
 
     telegram_id = contact.user_id
@@ -522,7 +517,7 @@ async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
 
     existing_employee = await db_manager.get_employee_by_telegram_id(telegram_id)
     if existing_employee:
-        await update.message.reply_text(
+        await reply_text(context, update.message,
             f"❌ **Дубликат!** Сотрудник с таким Telegram ID ({telegram_id}) уже существует: *{existing_employee['full_name']}*.\n\n"
             "Пожалуйста, отправьте контакт другого пользователя."
         )
@@ -540,24 +535,24 @@ async def get_contact(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
             InlineKeyboardButton("7/0", callback_data='sched_7/0')
         ]
     ]
-    await update.message.reply_text("✅ ID получен. Теперь выберите стандартный график работы:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await reply_text(context, update.message, "✅ ID получен. Теперь выберите стандартный график работы:", reply_markup=InlineKeyboardMarkup(keyboard))
     return ADD_SCHEDULE_PATTERN
 
 async def wrong_input_in_contact_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Пожалуйста, не отправляйте текст. Мне нужен именно **контакт** сотрудника.\nНажмите на 📎 и выберите 'Контакт'.")
+    await reply_text(context, update.message, "Пожалуйста, не отправляйте текст. Мне нужен именно **контакт** сотрудника.\nНажмите на 📎 и выберите 'Контакт'.")
 
 async def get_schedule_anchor(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     date_text = update.message.text.strip()
     import re
     if not re.match(r'^\d{4}-\d{2}-\d{2}$', date_text):
-        await update.message.reply_text("❌ Неверный формат даты. Пожалуйста, введите дату в формате *ГГГГ-ММ-ДД* (например, *2024-01-31*) или нажмите '❌ Отмена'.", parse_mode='Markdown')
+        await reply_text(context, update.message, "❌ Неверный формат даты. Пожалуйста, введите дату в формате *ГГГГ-ММ-ДД* (например, *2024-01-31*) или нажмите '❌ Отмена'.", parse_mode='Markdown')
 
         return ADD_SCHEDULE_ANCHOR
         
     context.user_data['new_employee']['schedule_start_date'] = date_text
     
     # Убираем клавиатуру отмены
-    await update.message.reply_text("Дата отсчета сохранена.", reply_markup=ReplyKeyboardRemove())
+    await reply_text(context, update.message, "Дата отсчета сохранена.", reply_markup=ReplyKeyboardRemove())
     
     # Переходим к выбору роли
     return await ask_role_step(update, context)
@@ -578,7 +573,7 @@ async def get_schedule_pattern(update: Update, context: ContextTypes.DEFAULT_TYP
         except:
             pass
             
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
             chat_id=update.effective_chat.id,
             text=f"Выбран график 2/2.\n\nВведите **Дату первой рабочей смены** (точку отсчета) в формате ГГГГ-ММ-ДД (например, {date.today()}):",
             reply_markup=cancel_kb,
@@ -604,10 +599,10 @@ async def ask_role_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Если мы пришли из функции get_schedule_pattern (где был query), редактируем сообщение
     # Если из get_schedule_anchor (где был текст), отправляем новое
     if update.callback_query:
-        await update.callback_query.edit_message_text("График установлен. Выберите роль:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await edit_query_text(context, update.callback_query, "График установлен. Выберите роль:", reply_markup=InlineKeyboardMarkup(keyboard))
     else:
         # Сохраняем ID меню, чтобы потом удалить при отмене
-        msg = await update.message.reply_text("График установлен. Выберите роль:", reply_markup=InlineKeyboardMarkup(keyboard))
+        msg = await reply_text(context, update.message, "График установлен. Выберите роль:", reply_markup=InlineKeyboardMarkup(keyboard))
         context.user_data['admin_menu_message_id'] = msg.message_id
     
     return ADD_ROLE
@@ -619,12 +614,12 @@ async def get_role(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     reply_keyboard = [["09:00", "10:00", "11:00", "12:00", "13:00"]]
 
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         "Роль установлена. Выберите или введите стандартное время начала работы:",
         reply_markup=InlineKeyboardMarkup([]) # Убираем старые инлайн-кнопки
     )
     # Отправляем новое сообщение с обычной клавиатурой
-    await query.message.reply_text(
+    await reply_text(context, query.message,
         "Варианты времени:",
         reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
     )
@@ -638,7 +633,7 @@ async def get_start_time(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     await remove_reply_keyboard(update, context, "Время начала сохранено.")
     
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Теперь выберите или введите стандартное время окончания работы:",
         reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
     )
@@ -648,7 +643,7 @@ async def get_start_time(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def get_end_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_employee']['default_end_time'] = update.message.text
     
-    await update.message.reply_text("Время окончания сохранено.", reply_markup=ReplyKeyboardRemove())
+    await reply_text(context, update.message, "Время окончания сохранено.", reply_markup=ReplyKeyboardRemove())
     return await show_add_employee_menu(update, context)
 
 async def show_add_employee_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -677,13 +672,13 @@ async def show_add_employee_menu(update: Update, context: ContextTypes.DEFAULT_T
     
     try:
         if update.callback_query:
-            await update.callback_query.edit_message_text(
+            await edit_query_text(context, update.callback_query,
                 text, 
                 reply_markup=reply_markup, 
                 parse_mode='Markdown'
             )
         else:
-            await update.message.reply_text(
+            await reply_text(context, update.message,
                 text, 
                 reply_markup=reply_markup, 
                 parse_mode='Markdown'
@@ -694,9 +689,9 @@ async def show_add_employee_menu(update: Update, context: ContextTypes.DEFAULT_T
         # Если вдруг Markdown все равно сломался, отправляем без него
         text_no_md = text.replace('*', '')
         if update.callback_query:
-            await update.callback_query.edit_message_text(text_no_md, reply_markup=reply_markup)
+            await edit_query_text(context, update.callback_query, text_no_md, reply_markup=reply_markup)
         else:
-            await update.message.reply_text(text_no_md, reply_markup=reply_markup)
+            await reply_text(context, update.message, text_no_md, reply_markup=reply_markup)
 
     return ADD_EMPLOYEE_MENU
 
@@ -705,7 +700,7 @@ async def select_field_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await query.answer()
     buttons = [[InlineKeyboardButton(name, callback_data=f"field_{field}")] for field, name in EDITABLE_FIELDS.items()]
     buttons.append([InlineKeyboardButton("⬅️ Назад", callback_data='back_to_menu')])
-    await query.edit_message_text("Выберите поле для изменения:", reply_markup=InlineKeyboardMarkup(buttons))
+    await edit_query_text(context, query, "Выберите поле для изменения:", reply_markup=InlineKeyboardMarkup(buttons))
     return SELECT_FIELD
 
 async def request_field_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -722,9 +717,9 @@ async def request_field_value(update: Update, context: ContextTypes.DEFAULT_TYPE
     elif field == 'default_end_time':
         reply_keyboard = [["18:00", "20:00", "21:00", "22:00", "23:00"]]
         
-    await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup([]))
+    await edit_query_text(context, query, message_text, reply_markup=InlineKeyboardMarkup([]))
     if reply_keyboard:
-        await query.message.reply_text(
+        await reply_text(context, query.message,
             "Варианты:",
             reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
         )
@@ -738,20 +733,20 @@ async def get_field_value(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if field in unique_fields:
         existing_employee = await db_manager.find_employee_by_field(field, value)
         if existing_employee:
-            await update.message.reply_text(f"❌ **Дубликат!** ...\nВведите другое.")
+            await reply_text(context, update.message, f"❌ **Дубликат!** ...\nВведите другое.")
             return GET_FIELD_VALUE
             
     context.user_data.pop('current_field')
     context.user_data['new_employee'][field] = value
     
-    await update.message.reply_text("Значение сохранено.", reply_markup=ReplyKeyboardRemove())
+    await reply_text(context, update.message, "Значение сохранено.", reply_markup=ReplyKeyboardRemove())
     
     return await show_add_employee_menu(update, context)
 
 async def confirm_add_employee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Для подтверждения добавления введите ваш код 2FA.")
+    await edit_query_text(context, query, "Для подтверждения добавления введите ваш код 2FA.")
     return AWAITING_ADD_EMPLOYEE_2FA
 
 async def finalize_add_employee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -770,7 +765,7 @@ async def finalize_add_employee(update: Update, context: ContextTypes.DEFAULT_TY
 
         try:
             await db_manager.add_employee(employee_data)
-            await update.message.reply_text(f"✅ Сотрудник {full_name} успешно добавлен!", reply_markup=get_main_keyboard(role))
+            await reply_text(context, update.message, f"✅ Сотрудник {full_name} успешно добавлен!", reply_markup=get_main_keyboard(role))
 
             admin_msg_id = context.user_data.get('admin_menu_message_id')
             if admin_msg_id:
@@ -780,9 +775,9 @@ async def finalize_add_employee(update: Update, context: ContextTypes.DEFAULT_TY
                     pass
 
         except Exception as e:
-            await update.message.reply_text(f"❌ Произошла ошибка при добавлении в базу данных: {e}")
+            await reply_text(context, update.message, f"❌ Произошла ошибка при добавлении в базу данных: {e}")
     else:
-        await update.message.reply_text("❌ Неверный код 2FA. Операция отменена.", reply_markup=get_main_keyboard(role))
+        await reply_text(context, update.message, "❌ Неверный код 2FA. Операция отменена.", reply_markup=get_main_keyboard(role))
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -795,13 +790,13 @@ async def edit_schedule_start_select_employee(update: Update, context: ContextTy
     
     employees = await db_manager.get_all_employees()
     if not employees:
-        await query.edit_message_text("В системе нет сотрудников.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data='go_to_schedule_menu')]]))
+        await edit_query_text(context, query, "В системе нет сотрудников.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data='go_to_schedule_menu')]]))
         return SELECT_EMPLOYEE_TO_EDIT # Можно использовать это состояние
         
     keyboard = [[InlineKeyboardButton(f"{emp['full_name']}", callback_data=f"edit_sched_emp_{emp['id']}")] for emp in employees]
     keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data='go_to_schedule_menu')])
     
-    await query.edit_message_text("Выберите сотрудника для изменения графика:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Выберите сотрудника для изменения графика:", reply_markup=InlineKeyboardMarkup(keyboard))
     return SELECT_EMPLOYEE_TO_EDIT
 
 async def edit_schedule_selected_employee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -820,13 +815,13 @@ async def start_edit_employee(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     employees = await db_manager.get_all_employees()
     if not employees:
-        await query.edit_message_text("В системе нет сотрудников для редактирования.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data='back_to_admin_panel')]]))
+        await edit_query_text(context, query, "В системе нет сотрудников для редактирования.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data='back_to_admin_panel')]]))
         return SELECT_EMPLOYEE_TO_EDIT
         
     keyboard = [[InlineKeyboardButton(f"{emp['full_name']} ({emp.get('position', 'N/A')})", callback_data=f"edit_emp_{emp['id']}")] for emp in employees]
     keyboard.append([InlineKeyboardButton("⬅️ Назад в админ-панель", callback_data='back_to_admin_panel')])
     
-    await query.edit_message_text("Выберите сотрудника для редактирования:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Выберите сотрудника для редактирования:", reply_markup=InlineKeyboardMarkup(keyboard))
     return SELECT_EMPLOYEE_TO_EDIT
 
 async def show_employee_edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -852,12 +847,12 @@ async def show_employee_edit_menu(update: Update, context: ContextTypes.DEFAULT_
         employee_id = context.user_data.get('employee_to_edit_id')
 
     if not employee_id:
-        await context.bot.send_message(chat_id=user_id, text="Ошибка: ID сотрудника не найден.")
+        await get_dispatcher(context).send_message(chat_id=user_id, text="Ошибка: ID сотрудника не найден.")
         return await start_edit_employee(update, context)
 
     target_employee = await db_manager.get_employee_by_id(employee_id)
     if not target_employee:
-        await context.bot.send_message(chat_id=user_id, text="Ошибка: сотрудник не найден.")
+        await get_dispatcher(context).send_message(chat_id=user_id, text="Ошибка: сотрудник не найден.")
         return await start_edit_employee(update, context)
 
     admin_employee = await db_manager.get_employee_by_telegram_id(user_id)
@@ -882,10 +877,10 @@ async def show_employee_edit_menu(update: Update, context: ContextTypes.DEFAULT_
     if query:
         # === ЗАЩИТА ОТ ОШИБКИ "Message to edit not found" ===
         try:
-            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+            await edit_query_text(context, query, text, reply_markup=reply_markup, parse_mode='Markdown')
         except BadRequest:
             # Если сообщение было удалено, отправляем новое
-            msg = await context.bot.send_message(
+            msg = await get_dispatcher(context).send_message(
                 chat_id=query.message.chat.id,
                 text=text,
                 reply_markup=reply_markup,
@@ -893,7 +888,7 @@ async def show_employee_edit_menu(update: Update, context: ContextTypes.DEFAULT_
             )
             context.user_data['admin_menu_message_id'] = msg.message_id
     else:
-        msg = await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        msg = await reply_text(context, update.message, text, reply_markup=reply_markup, parse_mode='Markdown')
         context.user_data['admin_menu_message_id'] = msg.message_id
         
     return EDIT_MAIN_MENU
@@ -924,7 +919,7 @@ async def show_relatives_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     keyboard.append([InlineKeyboardButton("➕ Добавить родственника", callback_data='add_new_relative')])
     keyboard.append([InlineKeyboardButton("⬅️ Назад к полям", callback_data='back_to_fields')])
     
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await edit_query_text(context, query, text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     return RELATIVES_MENU
 
 # --- ЦЕПОЧКА ДОБАВЛЕНИЯ ---
@@ -941,7 +936,7 @@ async def start_add_relative(update: Update, context: ContextTypes.DEFAULT_TYPE)
         [InlineKeyboardButton("Сын", callback_data="rel_type_Сын"), InlineKeyboardButton("Дочь", callback_data="rel_type_Дочь")],
         [InlineKeyboardButton("Брат", callback_data="rel_type_Брат"), InlineKeyboardButton("Сестра", callback_data="rel_type_Сестра")],
     ]
-    await query.edit_message_text("Кем приходится этот человек сотруднику?", reply_markup=InlineKeyboardMarkup(buttons))
+    await edit_query_text(context, query, "Кем приходится этот человек сотруднику?", reply_markup=InlineKeyboardMarkup(buttons))
     return REL_ADD_TYPE
 
 async def get_rel_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -950,56 +945,56 @@ async def get_rel_type(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     rel_type = query.data.split('_')[2]
     context.user_data['new_relative']['relationship_type'] = rel_type
     
-    await query.edit_message_text(f"Выбрано: {rel_type}.\n\nВведите **Фамилию** родственника:", parse_mode='Markdown')
+    await edit_query_text(context, query, f"Выбрано: {rel_type}.\n\nВведите **Фамилию** родственника:", parse_mode='Markdown')
     return REL_ADD_LAST_NAME
 
 async def get_rel_last_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_relative']['last_name'] = update.message.text
-    await update.message.reply_text("Введите **Имя** родственника:")
+    await reply_text(context, update.message, "Введите **Имя** родственника:")
     return REL_ADD_FIRST_NAME
 
 async def get_rel_first_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_relative']['first_name'] = update.message.text
-    await update.message.reply_text("Введите **Отчество** (или '-' если нет):")
+    await reply_text(context, update.message, "Введите **Отчество** (или '-' если нет):")
     return REL_ADD_MIDDLE_NAME
 
 async def get_rel_middle_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     text = update.message.text
     context.user_data['new_relative']['middle_name'] = "" if text == '-' else text
-    await update.message.reply_text("Введите **Номер телефона** родственника:")
+    await reply_text(context, update.message, "Введите **Номер телефона** родственника:")
     return REL_ADD_PHONE
 
 async def get_rel_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_relative']['phone_number'] = update.message.text
-    await update.message.reply_text("Введите **Дату рождения** (формат ГГГГ-ММ-ДД, например 1975-05-20):")
+    await reply_text(context, update.message, "Введите **Дату рождения** (формат ГГГГ-ММ-ДД, например 1975-05-20):")
     return REL_ADD_BIRTH_DATE
 
 async def get_rel_birth_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     import re
     date_text = update.message.text
     if not re.match(r'^\d{4}-\d{2}-\d{2}$', date_text):
-        await update.message.reply_text("❌ Неверный формат. Попробуйте еще раз (ГГГГ-ММ-ДД):")
+        await reply_text(context, update.message, "❌ Неверный формат. Попробуйте еще раз (ГГГГ-ММ-ДД):")
         return REL_ADD_BIRTH_DATE
         
     context.user_data['new_relative']['birth_date'] = date_text
-    await update.message.reply_text("Введите **Место работы** (Название компании):")
+    await reply_text(context, update.message, "Введите **Место работы** (Название компании):")
     return REL_ADD_WORKPLACE
 
 async def get_rel_workplace(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_relative']['workplace'] = update.message.text
-    await update.message.reply_text("Введите **Должность**:")
+    await reply_text(context, update.message, "Введите **Должность**:")
     return REL_ADD_POSITION
 
 async def get_rel_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_relative']['position'] = update.message.text
-    await update.message.reply_text("Введите **Адрес регистрации** (по прописке):")
+    await reply_text(context, update.message, "Введите **Адрес регистрации** (по прописке):")
     return REL_ADD_REG_ADDRESS
 
 async def get_rel_reg_address(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['new_relative']['registration_address'] = update.message.text
     
     keyboard = [[InlineKeyboardButton("Совпадает с регистрацией", callback_data="same_address")]]
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Введите **Адрес проживания** (фактический):\n(Или нажмите кнопку, если совпадает)", 
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -1012,7 +1007,7 @@ async def get_rel_liv_address(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Копируем адрес регистрации
         context.user_data['new_relative']['living_address'] = context.user_data['new_relative']['registration_address']
         # Т.к. это callback, нам нужно отправить новое сообщение для финала или отредактировать старое
-        await update.callback_query.edit_message_text("Адрес скопирован.") 
+        await edit_query_text(context, update.callback_query, "Адрес скопирован.") 
     else:
         context.user_data['new_relative']['living_address'] = update.message.text
 
@@ -1032,7 +1027,7 @@ async def get_rel_liv_address(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Если нажали кнопку "Совпадает", мы уже ответили, шлем новое меню
         pass 
     else:
-        await update.message.reply_text(success_text)
+        await reply_text(context, update.message, success_text)
         
     # Возвращаемся в меню родственников (нужно обновить update для вызова функции или отправить сообщение вручную)
     # Проще вызвать функцию меню, но нужно подготовить dummy update или просто отправить текст с кнопками.
@@ -1041,9 +1036,9 @@ async def get_rel_liv_address(update: Update, context: ContextTypes.DEFAULT_TYPE
     keyboard = [[InlineKeyboardButton("🔙 К списку родственников", callback_data='manage_relatives')]]
     # Если это было текстовое сообщение
     if not update.callback_query:
-        await update.message.reply_text("Готово.", reply_markup=InlineKeyboardMarkup(keyboard))
+        await reply_text(context, update.message, "Готово.", reply_markup=InlineKeyboardMarkup(keyboard))
     else:
-         await update.callback_query.message.reply_text("Готово.", reply_markup=InlineKeyboardMarkup(keyboard))
+         await reply_text(context, update.callback_query.message, "Готово.", reply_markup=InlineKeyboardMarkup(keyboard))
          
     return RELATIVES_MENU
 
@@ -1070,10 +1065,10 @@ async def start_edit_data(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     reply_markup = InlineKeyboardMarkup(buttons)
 
     if query:
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        await edit_query_text(context, query, text, reply_markup=reply_markup, parse_mode='Markdown')
     else:
         # Если вызов после текстового сообщения (например, после успешного сохранения)
-        msg = await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        msg = await reply_text(context, update.message, text, reply_markup=reply_markup, parse_mode='Markdown')
         # ВАЖНО: Запоминаем ID этого нового сообщения меню!
         context.user_data['admin_menu_message_id'] = msg.message_id
 
@@ -1110,8 +1105,8 @@ async def request_edit_data_value(update: Update, context: ContextTypes.DEFAULT_
     else:
         reply_keyboard = [["❌ Отмена"]]
 
-    await query.edit_message_text(f"Редактирование поля: {EDITABLE_FIELDS.get(field, field)}", reply_markup=InlineKeyboardMarkup([]))
-    await query.message.reply_text(
+    await edit_query_text(context, query, f"Редактирование поля: {EDITABLE_FIELDS.get(field, field)}", reply_markup=InlineKeyboardMarkup([]))
+    await reply_text(context, query.message,
         message_text,
         reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True),
         parse_mode='Markdown'
@@ -1128,17 +1123,17 @@ async def get_edited_data_value(update: Update, context: ContextTypes.DEFAULT_TY
 
     if update.message.contact:
         if field != 'personal_telegram_id':
-             await update.message.reply_text("❌ Для этого поля ввод контактом не поддерживается. Введите текст.")
+             await reply_text(context, update.message, "❌ Для этого поля ввод контактом не поддерживается. Введите текст.")
              return EDIT_DATA_GET_VALUE
         
         contact = update.message.contact
         if not contact.user_id:
-             await update.message.reply_text("❌ В этом контакте нет Telegram ID. Попробуйте другой.")
+             await reply_text(context, update.message, "❌ В этом контакте нет Telegram ID. Попробуйте другой.")
              return EDIT_DATA_GET_VALUE
              
         existing = await db_manager.find_employee_by_field('personal_telegram_id', contact.user_id)
         if existing and existing['id'] != employee_id:
-            await update.message.reply_text(
+            await reply_text(context, update.message,
                 f"❌ Дубликат! Этот Telegram ID уже привязан к сотруднику: {existing['full_name']}.",
                 reply_markup=ReplyKeyboardRemove()
             )
@@ -1158,16 +1153,16 @@ async def get_edited_data_value(update: Update, context: ContextTypes.DEFAULT_TY
         
         if field == 'personal_telegram_id':
              if not value.isdigit():
-                 await update.message.reply_text("❌ ID должен состоять только из цифр. Лучше отправьте контакт через скрепку.")
+                 await reply_text(context, update.message, "❌ ID должен состоять только из цифр. Лучше отправьте контакт через скрепку.")
                  return EDIT_DATA_GET_VALUE
     else:
-        await update.message.reply_text("❌ Непонятный формат данных.")
+        await reply_text(context, update.message, "❌ Непонятный формат данных.")
         return EDIT_DATA_GET_VALUE
 
     if 'date' in field:
         import re
         if not re.match(r'^\d{4}-\d{2}-\d{2}$', value):
-            await update.message.reply_text(
+            await reply_text(context, update.message,
                 "❌ Неверный формат даты. Пожалуйста, введите дату в формате *ГГГГ-ММ-ДД* (например, *2024-01-31*) или нажмите '❌ Отмена'.",
                 parse_mode='Markdown'
             )
@@ -1177,7 +1172,7 @@ async def get_edited_data_value(update: Update, context: ContextTypes.DEFAULT_TY
     if field in unique_fields:
         existing_employee = await db_manager.find_employee_by_field(field, value)
         if existing_employee and existing_employee['id'] != employee_id:
-            await update.message.reply_text(f"❌ *Дубликат!* Такой номер уже есть в базе у сотрудника {existing_employee['full_name']}.\nВведите другое значение или нажмите '❌ Отмена'.",
+            await reply_text(context, update.message, f"❌ *Дубликат!* Такой номер уже есть в базе у сотрудника {existing_employee['full_name']}.\nВведите другое значение или нажмите '❌ Отмена'.",
                 parse_mode='Markdown')
             return EDIT_DATA_GET_VALUE
     
@@ -1185,7 +1180,7 @@ async def get_edited_data_value(update: Update, context: ContextTypes.DEFAULT_TY
     
     cancel_kb = ReplyKeyboardMarkup([["❌ Отмена"]], resize_keyboard=True)
     
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Значение принято. Теперь введите *краткую причину* изменения (например, 'Ошибка при вводе').",
         reply_markup=cancel_kb,
         parse_mode='Markdown'
@@ -1234,14 +1229,14 @@ async def save_data_with_reason(update: Update, context: ContextTypes.DEFAULT_TY
                 pass
 
         # 2. Успех: Отправляем сообщение и ВОССТАНАВЛИВАЕМ ГЛАВНУЮ КЛАВИАТУРУ
-        await update.message.reply_text(
+        await reply_text(context, update.message,
             f"✅ Поле '{EDITABLE_FIELDS.get(field, field)}' успешно обновлено.", 
             reply_markup=get_main_keyboard(role)
         )
 
     except Exception as e:
         logger.error(f"Edit error: {e}")
-        await update.message.reply_text(
+        await reply_text(context, update.message,
             f"❌ Ошибка при сохранении: {e}", 
             reply_markup=get_main_keyboard(role)
         )
@@ -1262,7 +1257,7 @@ async def schedule_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         [InlineKeyboardButton("Период дат", callback_data='sched_mode_period')],
         [InlineKeyboardButton("⬅️ Назад", callback_data='back_to_edit_menu')],
     ]
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         "Выберите режим изменения графика:",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -1278,7 +1273,7 @@ async def schedule_select_mode(update: Update, context: ContextTypes.DEFAULT_TYP
     
     message = "Выберите дату:" if mode == 'single' else "Выберите ДАТУ НАЧАЛА периода:"
     
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         text=message,
         reply_markup=calendar_helper.create_calendar()
     )
@@ -1292,7 +1287,7 @@ async def schedule_select_date_1(update: Update, context: ContextTypes.DEFAULT_T
     # Обработка навигации по календарю
     if not query.data.startswith('cal_day_'):
         year, month = calendar_helper.process_calendar_selection(update)
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             text=query.message.text,
             reply_markup=calendar_helper.create_calendar(year, month)
         )
@@ -1304,7 +1299,7 @@ async def schedule_select_date_1(update: Update, context: ContextTypes.DEFAULT_T
     
     mode = context.user_data['schedule_edit_mode']
     if mode == 'period':
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             text=f"Дата начала: {selected_date}. Теперь выберите ДАТУ ОКОНЧАНИЯ периода:",
             reply_markup=calendar_helper.create_calendar()
         )
@@ -1319,7 +1314,7 @@ async def schedule_select_date_2(update: Update, context: ContextTypes.DEFAULT_T
 
     if not query.data.startswith('cal_day_'):
         year, month = calendar_helper.process_calendar_selection(update)
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             text=query.message.text,
             reply_markup=calendar_helper.create_calendar(year, month)
         )
@@ -1347,7 +1342,7 @@ async def schedule_show_type_selector(update: Update, context: ContextTypes.DEFA
     date2 = context.user_data.get('schedule_date_2')
     period_text = f"c {date1} по {date2}" if date2 else f"на {date1}"
 
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         f"Вы выбрали период {period_text}.\n\nКакое изменение применить?",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -1372,9 +1367,9 @@ async def show_deal_conflict_confirmation(update: Update, context: ContextTypes.
 
     # Определяем, как отправить сообщение (отредактировать или отправить новое)
     if update.callback_query:
-        await update.callback_query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        await edit_query_text(context, update.callback_query, text, reply_markup=reply_markup, parse_mode='Markdown')
     else:
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+        await reply_text(context, update.message, text, reply_markup=reply_markup, parse_mode='Markdown')
         
     return SCHEDULE_CONFIRM_DEAL_MOVE
 
@@ -1421,64 +1416,17 @@ async def save_schedule_changes(update: Update, context: ContextTypes.DEFAULT_TY
 
         # === ВАРИАНТ 2: Режим "ОТСУТСТВИЕ" ===
         elif time_mode == 'absence':
-            curr_date = date.fromisoformat(date1_str)
-            end_date_obj = date.fromisoformat(date2_str)
-            
-            def parse_time(t_str):
-                return datetime.strptime(t_str, '%H:%M').time()
-            
-            abs_start = parse_time(input_start)
-            abs_end = parse_time(input_end)
-
-            while curr_date <= end_date_obj:
-                base_schedule_list = await db_manager.get_employee_schedule_for_period(employee_id, curr_date, curr_date)
-                
-                if base_schedule_list:
-                    day_sched = base_schedule_list[0]
-                    if day_sched['status'] == 'Работа' and day_sched['start_time'] and day_sched['end_time']:
-                        
-                        def to_time(val):
-                            if isinstance(val, str): 
-                                try: return datetime.strptime(val, '%H:%M:%S').time()
-                                except: return datetime.strptime(val, '%H:%M').time()
-                            if isinstance(val, timedelta): return (datetime.min + val).time()
-                            if isinstance(val, time): return val
-                            return None
-
-                        ws = to_time(day_sched['start_time'])
-                        we = to_time(day_sched['end_time'])
-                        
-                        if ws and we:
-                            new_start = ws
-                            new_end = we
-                            is_day_off = False
-                            comment = f"Отсутствие {input_start}-{input_end}"
-
-                            if abs_start <= ws and abs_end >= we:
-                                is_day_off = True
-                                comment = "Отсутствие весь день"
-                            elif abs_start > ws and abs_start < we and abs_end >= we:
-                                new_end = abs_start
-                                comment = f"Уход раньше ({input_start})"
-                            elif abs_start <= ws and abs_end > ws and abs_end < we:
-                                new_start = abs_end
-                                comment = f"Поздний приход ({input_end})"
-                            elif abs_start > ws and abs_end < we:
-                                comment = f"Отсутствие {input_start}-{input_end}"
-
-                            await db_manager.set_schedule_override_for_period(
-                                employee_id=employee_id,
-                                start_date_str=curr_date.isoformat(),
-                                end_date_str=curr_date.isoformat(),
-                                is_day_off=is_day_off,
-                                start_time=new_start.strftime('%H:%M'),
-                                end_time=new_end.strftime('%H:%M'),
-                                comment=comment
-                            )
-                curr_date += timedelta(days=1)
+            # Вычитаем отсутствие из рабочего времени всех дней периода: одно чтение графика, одна запись
+            await db_manager.apply_absence_to_schedule(
+                employee_id,
+                date.fromisoformat(date1_str),
+                date.fromisoformat(date2_str),
+                input_start,
+                input_end
+            )
 
         # 1. ОТПРАВЛЯЕМ СООБЩЕНИЕ С ГЛАВНОЙ КЛАВИАТУРОЙ (ВОССТАНОВЛЕНИЕ КНОПОК)
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
             chat_id=update.effective_chat.id,
             text=f"✅ График успешно изменен ({date1_str} - {date2_str}).",
             reply_markup=get_main_keyboard(role)
@@ -1486,7 +1434,7 @@ async def save_schedule_changes(update: Update, context: ContextTypes.DEFAULT_TY
             
     except Exception as e:
         logger.error(f"Error in save_schedule_changes: {e}")
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
             chat_id=update.effective_chat.id,
             text=f"❌ Произошла ошибка при сохранении: {e}",
             reply_markup=get_main_keyboard(role)
@@ -1505,7 +1453,7 @@ async def save_schedule_changes(update: Update, context: ContextTypes.DEFAULT_TY
         [InlineKeyboardButton("🗓️ Посмотреть отгулы/больничные", callback_data='view_absences_start')],
         [InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_admin_panel')],
     ]
-    await context.bot.send_message(
+    await get_dispatcher(context).send_message(
         chat_id=update.effective_chat.id,
         text="Меню: Рабочий график",
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -1523,9 +1471,9 @@ async def handle_deal_move_confirmation(update: Update, context: ContextTypes.DE
     if decision == 'yes':
         # Отправляем уведомление и сохраняем
         # Редактируем сообщение с предупреждением
-        await query.edit_message_text("Сохраняю изменения... Вам придет уведомление о необходимости переноса сделок.")
+        await edit_query_text(context, query, "Сохраняю изменения... Вам придет уведомление о необходимости переноса сделок.")
         
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
             chat_id=query.from_user.id,
             text="❗️*Напоминание:*\nНе забудьте перенести сделки, которые конфликтуют с новым графиком сотрудника.",
             parse_mode='Markdown'
@@ -1538,10 +1486,10 @@ async def handle_deal_move_confirmation(update: Update, context: ContextTypes.DE
         role = admin_emp.get('role', 'employee') if admin_emp else 'employee'
 
         # Удаляем или редактируем сообщение с вопросом
-        await query.edit_message_text("❌ Изменение графика отменено.")
+        await edit_query_text(context, query, "❌ Изменение графика отменено.")
 
         # ВОССТАНАВЛИВАЕМ КЛАВИАТУРУ
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
             chat_id=update.effective_chat.id,
             text="Вы вернулись в меню графиков.",
             reply_markup=get_main_keyboard(role)
@@ -1555,7 +1503,7 @@ async def handle_deal_move_confirmation(update: Update, context: ContextTypes.DE
             [InlineKeyboardButton("🗓️ Посмотреть отгулы/больничные", callback_data='view_absences_start')],
             [InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_admin_panel')],
         ]
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
             chat_id=update.effective_chat.id,
             text="Меню: Рабочий график",
             reply_markup=InlineKeyboardMarkup(keyboard)
@@ -1583,11 +1531,11 @@ async def schedule_process_type(update: Update, context: ContextTypes.DEFAULT_TY
             context.user_data['schedule_time_mode'] = 'work'
             msg_text = "Введите новое время НАЧАЛА РАБОТЫ (когда сотрудник должен прийти):"
 
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             f"{msg_text}\n(в формате ЧЧ:ММ)",
             reply_markup=InlineKeyboardMarkup([])
         )
-        await query.message.reply_text(
+        await reply_text(context, query.message,
             "Варианты:",
             reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
         )
@@ -1624,7 +1572,7 @@ async def schedule_get_start_time(update: Update, context: ContextTypes.DEFAULT_
     else:
         msg_text = "Теперь введите время ОКОНЧАНИЯ РАБОТЫ:"
 
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         f"{msg_text}\n(в формате ЧЧ:ММ)",
         reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
     )
@@ -1642,7 +1590,7 @@ async def schedule_finalize_work_time(update: Update, context: ContextTypes.DEFA
     
     mode = context.user_data.get('schedule_time_mode', 'work')
 
-    await update.message.reply_text("Проверяю конфликты со сделками...", reply_markup=ReplyKeyboardRemove())
+    await reply_text(context, update.message, "Проверяю конфликты со сделками...", reply_markup=ReplyKeyboardRemove())
 
     conflicting_deals = []
 
@@ -1681,7 +1629,7 @@ async def start_reset_2fa_confirm(update: Update, context: ContextTypes.DEFAULT_
         [InlineKeyboardButton("Да, сбросить 2FA", callback_data='confirm_reset_yes')],
         [InlineKeyboardButton("Нет, отмена", callback_data='back_to_edit_menu')],
     ]
-    await query.edit_message_text(f"Вы уверены, что хотите сбросить 2FA для *{employee['full_name']}*?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await edit_query_text(context, query, f"Вы уверены, что хотите сбросить 2FA для *{employee['full_name']}*?", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
     return AWAITING_RESET_2FA_CONFIRM
 
 async def finalize_reset_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1706,6 +1654,8 @@ async def finalize_reset_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ========== ЛОГИКА ПРОСМОТРА ГРАФИКА ==========
 # Словарь для дней недели
 WEEKDAY_NAMES_RU = {0: "ПН", 1: "ВТ", 2: "СР", 3: "ЧТ", 4: "ПТ", 5: "СБ", 6: "ВС"}
+# Сколько сотрудников обрабатываем за раз при выгрузке графика в CSV
+SCHEDULE_EXPORT_CHUNK_SIZE = 200
 
 async def view_schedule_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало диалога просмотра: выбор сотрудника."""
@@ -1714,13 +1664,13 @@ async def view_schedule_start(update: Update, context: ContextTypes.DEFAULT_TYPE
     
     employees = await db_manager.get_all_employees()
     if not employees:
-        await query.edit_message_text("В системе нет сотрудников.")
+        await edit_query_text(context, query, "В системе нет сотрудников.")
         return ConversationHandler.END
         
     keyboard = [[InlineKeyboardButton(f"{emp['full_name']}", callback_data=f"view_emp_{emp['id']}")] for emp in employees]
     keyboard.append([InlineKeyboardButton("⬅️ Назад в админ-панель", callback_data='back_to_admin_panel')])
     
-    await query.edit_message_text("Выберите сотрудника для просмотра графика:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Выберите сотрудника для просмотра графика:", reply_markup=InlineKeyboardMarkup(keyboard))
     return VIEW_SCHEDULE_SELECT_EMPLOYEE
 
 async def view_schedule_back_to_period_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1735,7 +1685,7 @@ async def view_schedule_back_to_period_select(update: Update, context: ContextTy
         [InlineKeyboardButton("Текущий квартал", callback_data='view_period_quarter')],
         [InlineKeyboardButton("⬅️ Назад к выбору сотрудника", callback_data='back_to_view_list')],
     ]
-    await query.edit_message_text("Выберите период для просмотра:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Выберите период для просмотра:", reply_markup=InlineKeyboardMarkup(keyboard))
     return VIEW_SCHEDULE_SELECT_PERIOD # Возвращаемся в состояние выбора периода
 
 async def view_schedule_select_employee(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1752,7 +1702,7 @@ async def view_schedule_select_employee(update: Update, context: ContextTypes.DE
         [InlineKeyboardButton("Текущий квартал", callback_data='view_period_quarter')],
         [InlineKeyboardButton("⬅️ Назад к выбору сотрудника", callback_data='back_to_view_list')],
     ]
-    await query.edit_message_text("Выберите период для просмотра:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Выберите период для просмотра:", reply_markup=InlineKeyboardMarkup(keyboard))
     return VIEW_SCHEDULE_SELECT_PERIOD
 
 # --- ОТЧЕТ ПО ВСЕМ СОТРУДНИКАМ ---
@@ -1768,12 +1718,43 @@ async def view_all_schedule_start(update: Update, context: ContextTypes.DEFAULT_
         [InlineKeyboardButton("Текущий квартал", callback_data='all_period_quarter')],
         [InlineKeyboardButton("⬅️ Назад", callback_data='go_to_schedule_menu')],
     ]
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         "Выберите период для выгрузки общего графика (CSV):", 
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     return VIEW_ALL_SCHEDULE_SELECT_PERIOD
 
+async def _write_schedule_chunk(writer: SpooledCsvWriter, employees: list, start_date: date, end_date: date):
+    """Дописывает в CSV графики пачки сотрудников (2 запроса на пачку)."""
+    schedules = await db_manager.get_schedules_for_employees(
+        [emp['id'] for emp in employees], start_date, end_date, read_only=True
+    )
+
+    for emp in employees:
+        schedule = schedules.get(emp['id'], [])
+
+        for day in schedule:
+            dt = day['date']
+            date_str = dt.strftime('%d.%m.%Y')
+            weekday_str = WEEKDAY_NAMES_RU[dt.weekday()]
+            
+            # Время уже DayTime и печатается как 'HH:MM'
+            start_t = day['start_time']
+            end_t = day['end_time']
+            time_str = f"{start_t}-{end_t}" if start_t and end_t else "-"
+            comment = day.get('comment', '') or ""
+                
+            writer.writerow([
+                emp.get('city', '-'),
+                emp.get('position', '-'),
+                emp['full_name'],
+                date_str,
+                weekday_str,
+                time_str,
+                day['status'],
+                comment # Записываем комментарий
+            ])
+
 async def view_all_schedule_generate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Генерирует CSV файл с графиком всех сотрудников и отправляет его."""
     query = update.callback_query
@@ -1797,55 +1778,24 @@ async def view_all_schedule_generate(update: Update, context: ContextTypes.DEFAU
         next_q = date(today.year, end_month, 28) + timedelta(days=4)
         end_date = next_q - timedelta(days=next_q.day)
 
-    employees = await db_manager.get_all_employees()
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=';')
-    
-    # ДОБАВИЛИ КОЛОНКУ 'Комментарий'
-    writer.writerow(['Город', 'Должность', 'ФИО', 'Дата', 'День недели', 'Время работы', 'Статус', 'Комментарий'])
-    
-    for emp in employees:
-        schedule = await db_manager.get_employee_schedule_for_period(emp['id'], start_date, end_date)
-        
-        for day in schedule:
-            dt = day['date']
-            date_str = dt.strftime('%d.%m.%Y')
-            weekday_str = WEEKDAY_NAMES_RU[dt.weekday()]
-            
-            # Безопасное форматирование времени (локально, чтобы не зависеть от user_handlers)
-            start_t = day['start_time']
-            end_t = day['end_time']
-            s_str = ""
-            e_str = ""
-            if start_t: s_str = str(start_t)[:5]
-            if end_t: e_str = str(end_t)[:5]
+    with SpooledCsvWriter(delimiter=';') as writer:
+        # ДОБАВИЛИ КОЛОНКУ 'Комментарий'
+        writer.writerow(['Город', 'Должность', 'ФИО', 'Дата', 'День недели', 'Время работы', 'Статус', 'Комментарий'])
 
-            time_str = f"{s_str}-{e_str}" if s_str and e_str else "-"
-            comment = day.get('comment', '') or ""
-                
-            writer.writerow([
-                emp.get('city', '-'),
-                emp.get('position', '-'),
-                emp['full_name'],
-                date_str,
-                weekday_str,
-                time_str,
-                day['status'],
-                comment # Записываем комментарий
-            ])
-            
-    output.seek(0)
-    bio = io.BytesIO(output.getvalue().encode('utf-8-sig'))
-    bio.name = f"Schedule_{period}_{today.strftime('%Y%m%d')}.csv"
-    
-    await context.bot.send_document(
-        chat_id=update.effective_chat.id,
-        document=bio,
-        caption=f"📅 График всех сотрудников за период: {start_date.strftime('%d.%m')} - {end_date.strftime('%d.%m')}"
-    )
+        # Сотрудники идут страницами, графики считаем на страницу — в памяти только одна пачка,
+        # и соединение не держится открытым под курсором, пока идут запросы графиков
+        async for chunk in db_manager.iter_employee_pages(SCHEDULE_EXPORT_CHUNK_SIZE):
+            await _write_schedule_chunk(writer, chunk, start_date, end_date)
+
+        await get_dispatcher(context).send_document(
+            chat_id=update.effective_chat.id,
+            document=writer.getfile(),
+            filename=f"Schedule_{period}_{today.strftime('%Y%m%d')}.csv",
+            caption=f"📅 График всех сотрудников за период: {start_date.strftime('%d.%m')} - {end_date.strftime('%d.%m')}"
+        )
     
     keyboard = [[InlineKeyboardButton("⬅️ Назад в меню графиков", callback_data='go_to_schedule_menu')]]
-    await query.edit_message_text("Файл сформирован и отправлен.", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Файл сформирован и отправлен.", reply_markup=InlineKeyboardMarkup(keyboard))
     return VIEW_ALL_SCHEDULE_SELECT_PERIOD
 
 async def view_schedule_generate_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1873,14 +1823,12 @@ async def view_schedule_generate_report(update: Update, context: ContextTypes.DE
         next_q = date(today.year, end_month, 28) + timedelta(days=4)
         end_date = next_q - timedelta(days=next_q.day)
         
-    schedule_data = await db_manager.get_employee_schedule_for_period(employee_id, start_date, end_date)
+    schedule_data = await db_manager.get_employee_schedule_for_period(employee_id, start_date, end_date, read_only=True)
     
     # Готовим данные для таблицы
     headers = ['Дата', 'День', 'Время', 'Статус', 'Комментарий']
     rows = []
     
-    def safe_fmt(val): return str(val)[:5] if val else "-"
-
     for day in schedule_data:
         dt = day['date']
         date_str = dt.strftime('%d.%m')
@@ -1891,7 +1839,7 @@ async def view_schedule_generate_report(update: Update, context: ContextTypes.DE
         comment = day.get('comment') or ""
 
         if start_t and end_t:
-            time_str = f"{safe_fmt(start_t)}-{safe_fmt(end_t)}"
+            time_str = f"{start_t}-{end_t}"
         else:
             time_str = "-"
             
@@ -1912,7 +1860,7 @@ async def view_schedule_generate_report(update: Update, context: ContextTypes.DE
     except:
         pass
 
-    await context.bot.send_photo(
+    await get_dispatcher(context).send_photo(
         chat_id=update.effective_chat.id,
         photo=image_bio,
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -1946,7 +1894,7 @@ async def sb_approval_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
         'original_reason': original_reason # 'inkas', 'break', 'lunch' и т.д.
     }
     
-    await query.edit_message_text(f"Для согласования заявки ({original_reason}) введите ваш код 2FA.")
+    await edit_query_text(context, query, f"Для согласования заявки ({original_reason}) введите ваш код 2FA.")
     return AWAITING_SB_2FA
 
 async def sb_approval_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -1955,14 +1903,14 @@ async def sb_approval_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     sb_employee = await db_manager.get_employee_by_telegram_id(sb_user_id)
     
     if not sb_employee or sb_employee['role'].lower() not in ['security', 'admin']:
-        await update.message.reply_text(f"У вас нет прав для выполнения этого действия. Роль:{sb_employee['role'].lower()}")
+        await reply_text(context, update.message, f"У вас нет прав для выполнения этого действия. Роль:{sb_employee['role'].lower()}")
         return ConversationHandler.END
 
     code = update.message.text.strip()
     approval_data = context.user_data.get('sb_approval')
 
     if not approval_data:
-        await update.message.reply_text("Ошибка: не найдены данные для согласования.")
+        await reply_text(context, update.message, "Ошибка: не найдены данные для согласования.")
         return ConversationHandler.END
 
     if sb_employee['totp_secret'] and verify_totp(sb_employee['totp_secret'], code):
@@ -1972,7 +1920,7 @@ async def sb_approval_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         target_employee = await db_manager.get_employee_by_id(target_employee_id)
         if not target_employee:
-            await update.message.reply_text("Ошибка: целевой сотрудник не найден.")
+            await reply_text(context, update.message, "Ошибка: целевой сотрудник не найден.")
             context.user_data.clear()
             return ConversationHandler.END
 
@@ -1982,17 +1930,16 @@ async def sb_approval_2fa(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         }
         final_status, final_reason, approval_reason_log = reason_map[approval_type]
 
-        await db_manager.update_employee_status(target_employee_id, final_status)
-        await db_manager.log_approved_time_event(
-            employee_id=target_employee_id, event_type='clock_out', reason=final_reason,
+        await db_manager.transition_status(
+            employee_id=target_employee_id, new_status=final_status, event_type='clock_out', reason=final_reason,
             approver_id=sb_employee['id'], approval_reason=approval_reason_log
         )
         
-        await update.message.reply_text(f"✅ Вы согласовали '{final_reason}' для {target_employee['full_name']}.")
-        await context.bot.send_message(target_employee['personal_telegram_id'], f"✅ Ваша заявка на '{final_reason}' согласована.")
+        await reply_text(context, update.message, f"✅ Вы согласовали '{final_reason}' для {target_employee['full_name']}.")
+        await get_dispatcher(context).send_message(target_employee['personal_telegram_id'], f"✅ Ваша заявка на '{final_reason}' согласована.", priority=PRIORITY_APPROVAL)
         
     else:
-        await update.message.reply_text("❌ Неверный код 2FA. Попробуйте еще раз.")
+        await reply_text(context, update.message, "❌ Неверный код 2FA. Попробуйте еще раз.")
         return AWAITING_SB_2FA
 
     context.user_data.clear()
@@ -2017,11 +1964,12 @@ async def sb_reject_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
         sb_name_escaped = escape_markdown(sb_employee['full_name'], version=2)
         sb_user_link = f"[{sb_name_escaped}](tg://user?id={sb_employee['personal_telegram_id']})"
         message = f"❌ Ваша заявка была отклонена сотрудником СБ\\. Для уточнений свяжитесь с {sb_user_link}\\."
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
+            priority=PRIORITY_APPROVAL,
             chat_id=target_employee['personal_telegram_id'], text=message, parse_mode='MarkdownV2'
         )
     
-    await query.edit_message_text(f"Вы отклонили заявку сотрудника {target_employee.get('full_name', 'Неизвестно')}.")
+    await edit_query_text(context, query, f"Вы отклонили заявку сотрудника {target_employee.get('full_name', 'Неизвестно')}.")
 
 # Файл: handlers/admin_handlers.py
 
@@ -2040,7 +1988,7 @@ async def view_absences_start(update: Update, context: ContextTypes.DEFAULT_TYPE
         [InlineKeyboardButton("Текущий квартал", callback_data='abs_period_quarter')],
         [InlineKeyboardButton("⬅️ Назад", callback_data='go_to_schedule_menu')],
     ]
-    await query.edit_message_text("Выберите период для просмотра отгулов/изменений графика:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Выберите период для просмотра отгулов/изменений графика:", reply_markup=InlineKeyboardMarkup(keyboard))
     return VIEW_ABSENCES_SELECT_PERIOD
 
 async def view_absences_generate_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -2069,7 +2017,7 @@ async def view_absences_generate_report(update: Update, context: ContextTypes.DE
     overrides_data = await db_manager.get_all_schedule_overrides_for_period(start_date, end_date)
     
     if not overrides_data:
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             f"За период {start_date.strftime('%d.%m')} - {end_date.strftime('%d.%m')} изменений нет.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад", callback_data='go_to_schedule_menu')]])
         )
@@ -2080,8 +2028,6 @@ async def view_absences_generate_report(update: Update, context: ContextTypes.DE
     headers = ['Сотрудник', 'Дата', 'Статус/Время', 'Комментарий']
     rows = []
     
-    def safe_fmt(val): return str(val)[:5] if val else ""
-
     for record in overrides_data:
         # Фамилия и инициалы (чтобы влезло)
         full_name = record['full_name']
@@ -2090,16 +2036,17 @@ async def view_absences_generate_report(update: Update, context: ContextTypes.DE
         if len(parts) >= 2:
             short_name = f"{parts[0]} {parts[1][0]}."
         
+        # Исключение хранится диапазоном — показываем его целиком
         dt = record['work_date']
         date_str = dt.strftime('%d.%m')
+        if record['end_date'] != dt:
+            date_str += f"-{record['end_date'].strftime('%d.%m')}"
         comment = record.get('comment') or ""
 
         if record['is_day_off']:
             info_str = "Отгул"
         else:
-            start_t = safe_fmt(record['start_time'])
-            end_t = safe_fmt(record['end_time'])
-            info_str = f"{start_t}-{end_t}"
+            info_str = f"{record['start_time'] or ''}-{record['end_time'] or ''}"
             
         rows.append([short_name, date_str, info_str, comment])
 
@@ -2113,7 +2060,7 @@ async def view_absences_generate_report(update: Update, context: ContextTypes.DE
     except:
         pass
 
-    await context.bot.send_photo(
+    await get_dispatcher(context).send_photo(
         chat_id=update.effective_chat.id,
         photo=image_bio,
         reply_markup=InlineKeyboardMarkup(keyboard)
@@ -2129,7 +2076,7 @@ async def start_fire_employee(update: Update, context: ContextTypes.DEFAULT_TYPE
     employee_id = context.user_data['employee_to_edit_id']
     employee = await db_manager.get_employee_by_id(employee_id)
     
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         f"⚠️ Вы собираетесь **УВОЛИТЬ** сотрудника *{employee['full_name']}*.\n"
         f"Статус сменится на 'Уволен', доступ к боту будет закрыт.\n\n"
         f"Введите ваш код 2FA для подтверждения:",
@@ -2149,7 +2096,7 @@ async def finalize_fire_employee(update: Update, context: ContextTypes.DEFAULT_T
         
         try:
             await db_manager.fire_employee(employee_id)
-            await update.message.reply_text(f"✅ Сотрудник *{target_employee['full_name']}* успешно уволен.", parse_mode='Markdown', reply_markup=get_main_keyboard(role))
+            await reply_text(context, update.message, f"✅ Сотрудник *{target_employee['full_name']}* успешно уволен.", parse_mode='Markdown', reply_markup=get_main_keyboard(role))
             
             admin_msg_id = context.user_data.get('admin_menu_message_id')
             if admin_msg_id:
@@ -2167,12 +2114,12 @@ async def finalize_fire_employee(update: Update, context: ContextTypes.DEFAULT_T
                 reason="Admin panel fire action"
             )
         except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка при увольнении: {e}", reply_markup=get_main_keyboard(role))
+            await reply_text(context, update.message, f"❌ Ошибка при увольнении: {e}", reply_markup=get_main_keyboard(role))
             
         context.user_data.clear()
         return ConversationHandler.END
     else:
-        await update.message.reply_text("❌ Неверный код 2FA. Попробуйте снова", reply_markup=get_main_keyboard(role))
+        await reply_text(context, update.message, "❌ Неверный код 2FA. Попробуйте снова", reply_markup=get_main_keyboard(role))
         return AWAITING_FIRE_EMPLOYEE_2FA
 
 # --- ЛОГИКА УДАЛЕНИЯ ---
@@ -2186,7 +2133,7 @@ async def start_delete_employee(update: Update, context: ContextTypes.DEFAULT_TY
     employee_id = context.user_data['employee_to_edit_id']
     employee = await db_manager.get_employee_by_id(employee_id)
     
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         f"⛔️☢️ **ВНИМАНИЕ! УДАЛЕНИЕ!** ☢️⛔️\n\n"
         f"Вы собираетесь **ПОЛНОСТЬЮ УДАЛИТЬ** сотрудника *{employee['full_name']}* из базы данных.\n"
         f"История смен, график, родственники — всё будет удалено безвозвратно.\n\n"
@@ -2206,7 +2153,7 @@ async def finalize_delete_employee(update: Update, context: ContextTypes.DEFAULT
         
         try:
             await db_manager.delete_employee_permanently(employee_id)
-            await update.message.reply_text(f"🗑 Сотрудник *{target_employee['full_name']}* был полностью удален из БД.", parse_mode='Markdown', reply_markup=get_main_keyboard(role))
+            await reply_text(context, update.message, f"🗑 Сотрудник *{target_employee['full_name']}* был полностью удален из БД.", parse_mode='Markdown', reply_markup=get_main_keyboard(role))
             admin_msg_id = context.user_data.get('admin_menu_message_id')
             if admin_msg_id:
                 try:
@@ -2214,12 +2161,12 @@ async def finalize_delete_employee(update: Update, context: ContextTypes.DEFAULT
                 except Exception:
                     pass
         except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка БД при удалении: {e}", reply_markup=get_main_keyboard(role))
+            await reply_text(context, update.message, f"❌ Ошибка БД при удалении: {e}", reply_markup=get_main_keyboard(role))
             
         context.user_data.clear()
         return ConversationHandler.END
     else:
-        await update.message.reply_text("❌ Неверный код 2FA. Попробуйте снова.", reply_markup=get_main_keyboard(role))
+        await reply_text(context, update.message, "❌ Неверный код 2FA. Попробуйте снова.", reply_markup=get_main_keyboard(role))
         return AWAITING_DELETE_EMPLOYEE_2FA
 
 
@@ -2242,9 +2189,7 @@ async def sb_approve_early_leave(update: Update, context: ContextTypes.DEFAULT_T
     # 1. Получаем заявку
     request = await db_manager.get_last_pending_request(employee_id, 'early_leave')
     
-    # 2. Выпускаем сотрудника (меняем статус)
-    await db_manager.update_employee_status(employee_id, 'offline')
-    
+    # 2. Сотрудника выпускаем в конце, одной транзакцией вместе с записью в журнал
     log_reason = 'Ранний уход (согласовано)'
     schedule_change_info = ""
 
@@ -2269,96 +2214,27 @@ async def sb_approve_early_leave(update: Update, context: ContextTypes.DEFAULT_T
             leave_start_time_str = data.get('time_start') # "11:00"
             leave_end_time_str = data.get('time_end')     # "12:00"
 
-        # Проходим по дням периода
-        curr_date = req_date_start
-        while curr_date <= req_date_end:
-            # 1. Получаем текущий (базовый) график сотрудника на этот день
-            # get_employee_schedule_for_period вернет массив из 1 дня с учетом дефолтов
-            base_schedule_list = await db_manager.get_employee_schedule_for_period(employee_id, curr_date, curr_date)
-            
-            if base_schedule_list:
-                day_sched = base_schedule_list[0]
-                
-                # Если это рабочий день и есть время начала/конца
-                if day_sched['status'] == 'Работа' and day_sched['start_time'] and day_sched['end_time']:
-                    # Базовые границы рабочего дня
-                    work_start = day_sched['start_time'] # timedelta или time
-                    work_end = day_sched['end_time']     # timedelta или time
-
-                    # Приводим к типу datetime.time для сравнения
-                    def to_time(val):
-                        if isinstance(val, str): 
-                            try: return datetime.strptime(val, '%H:%M:%S').time()
-                            except: return datetime.strptime(val, '%H:%M').time()
-                        if isinstance(val, timedelta): return (datetime.min + val).time()
-                        return val
-
-                    ws = to_time(work_start)
-                    we = to_time(work_end)
-                    ls = to_time(leave_start_time_str)
-                    le = to_time(leave_end_time_str)
-                    
-                    new_start = ws
-                    new_end = we
-                    comment = None
-                    is_day_off = False
-
-                    # ЛОГИКА ПЕРЕСЕЧЕНИЙ
-                    
-                    # 1. Отсутствие перекрывает ВЕСЬ день (или больше)
-                    if ls <= ws and le >= we:
-                        is_day_off = True
-                        comment = "Отгул на весь день"
-
-                    # 2. Ранний уход (Early Leave): Отсутствие начинается внутри дня и идет до конца
-                    # Пример: Работа 09-18, Ушел в 17:00 (Absence 17:00-18:00)
-                    elif ls > ws and ls < we and le >= we:
-                        new_end = ls # Конец работы теперь равен началу отсутствия
-                        comment = f"Уход раньше ({ls.strftime('%H:%M')})"
-
-                    # 3. Опоздание/Поздний приход: Отсутствие начинается до работы и заканчивается внутри
-                    # Пример: Работа 09-18, Пришел в 10:00 (Absence 09:00-10:00)
-                    elif ls <= ws and le > ws and le < we:
-                        new_start = le # Начало работы теперь равно концу отсутствия
-                        comment = f"Поздний приход (с {le.strftime('%H:%M')})"
-
-                    # 4. Отсутствие в середине (Split shift)
-                    # Пример: Работа 09-18, Отсутствие 11-12
-                    elif ls > ws and le < we:
-                        # Мы не можем разделить start/end в БД, поэтому оставляем границы 09-18
-                        # НО пишем специальный комментарий для отчета
-                        # new_start и new_end остаются прежними (ws, we)
-                        comment = f"Отсутствие {ls.strftime('%H:%M')}-{le.strftime('%H:%M')}"
-
-                    # Применяем изменение в БД
-                    # Важно: преобразуем time обратно в строку
-                    await db_manager.set_schedule_override_for_period(
-                        employee_id, 
-                        curr_date.isoformat(), 
-                        curr_date.isoformat(),
-                        is_day_off=is_day_off,
-                        start_time=new_start.strftime('%H:%M'),
-                        end_time=new_end.strftime('%H:%M'),
-                        comment=comment
-                    )
-                    schedule_change_info = "(График обновлен)"
-
-            curr_date += timedelta(days=1)
+        # Вычитаем отсутствие из графика за весь период (разорванная смена тоже сохраняется)
+        changed_days = await db_manager.apply_absence_to_schedule(
+            employee_id, req_date_start, req_date_end, leave_start_time_str, leave_end_time_str
+        )
+        if changed_days:
+            schedule_change_info = "(График обновлен)"
         
         await db_manager.update_request_status(request['id'], 'approved')
 
-    # 4. Логируем
-    await db_manager.log_approved_time_event(
-        employee_id=employee_id, event_type='clock_out', reason=log_reason,
+    # 4. Выпускаем сотрудника (меняем статус) и логируем
+    await db_manager.transition_status(
+        employee_id=employee_id, new_status='offline', event_type='clock_out', reason=log_reason,
         approver_id=sb_employee['id'], approval_reason=f'Согласование СБ {schedule_change_info}'
     )
     
-    await query.edit_message_text(f"✅ Заявка согласована (СБ: {sb_employee['full_name']}).\nСотрудник отпущен. {schedule_change_info}")
+    await edit_query_text(context, query, f"✅ Заявка согласована (СБ: {sb_employee['full_name']}).\nСотрудник отпущен. {schedule_change_info}")
     
     target_emp = await db_manager.get_employee_by_id(employee_id)
     if target_emp:
         try:
-            await context.bot.send_message(target_emp['personal_telegram_id'], f"✅ Ваш запрос согласован. График скорректирован.")
+            await get_dispatcher(context).send_message(target_emp['personal_telegram_id'], f"✅ Ваш запрос согласован. График скорректирован.", priority=PRIORITY_APPROVAL)
         except: pass
 
 async def sb_reject_early_leave(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2379,12 +2255,12 @@ async def sb_reject_early_leave(update: Update, context: ContextTypes.DEFAULT_TY
     if request:
         await db_manager.update_request_status(request['id'], 'rejected')
 
-    await query.edit_message_text(f"❌ Заявка отклонена (СБ: {sb_employee['full_name']}).")
+    await edit_query_text(context, query, f"❌ Заявка отклонена (СБ: {sb_employee['full_name']}).")
     
     target_emp = await db_manager.get_employee_by_id(employee_id)
     if target_emp:
         try:
-            await context.bot.send_message(target_emp['personal_telegram_id'], "❌ Ваш запрос отклонен.")
+            await get_dispatcher(context).send_message(target_emp['personal_telegram_id'], "❌ Ваш запрос отклонен.", priority=PRIORITY_APPROVAL)
         except: pass
 
 # --- ЛОГИКА "ИЗМЕНИТЬ ВРЕМЯ" (Для СБ) ---
@@ -2409,7 +2285,7 @@ async def sb_change_time_start(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # Спрашиваем СБ
     # Мы используем force_reply, чтобы ответ СБ пришел именно сюда (если это супергруппа)
-    await context.bot.send_message(
+    await get_dispatcher(context).send_message(
         chat_id=query.message.chat.id,
         text=f"✏️ Введите новые параметры (даты/время) и комментарий для сотрудника.\nНапример: 'Разрешено уйти в 17:00, завтра отработать час'.",
         reply_to_message_id=query.message.message_id
@@ -2424,15 +2300,12 @@ async def sb_change_time_save(update: Update, context: ContextTypes.DEFAULT_TYPE
     sb_employee = await db_manager.get_employee_by_telegram_id(sb_user_id)
     
     if not employee_id:
-        await update.message.reply_text("Ошибка контекста.")
+        await reply_text(context, update.message, "Ошибка контекста.")
         return ConversationHandler.END
 
-    # 1. Выпускаем сотрудника (так как СБ разрешил, но с условиями)
-    await db_manager.update_employee_status(employee_id, 'offline')
-    
-    # 2. Логируем с комментарием СБ
-    await db_manager.log_approved_time_event(
-        employee_id=employee_id, event_type='clock_out', reason='Изменено СБ',
+    # 1-2. Выпускаем сотрудника (так как СБ разрешил, но с условиями) и логируем с комментарием СБ
+    await db_manager.transition_status(
+        employee_id=employee_id, new_status='offline', event_type='clock_out', reason='Изменено СБ',
         approver_id=sb_employee['id'], approval_reason=f"СБ изменил: {text}"
     )
     
@@ -2443,20 +2316,22 @@ async def sb_change_time_save(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # 4. Обновляем исходное сообщение в топике
     try:
-        await context.bot.edit_message_text(
+        await get_dispatcher(context).edit_message_text(
+            priority=PRIORITY_APPROVAL,
             chat_id=context.user_data['sb_chat_id'],
             message_id=context.user_data['sb_msg_id'],
             text=f"✏️ Условия изменены СБ ({sb_employee['full_name']}).\nКомментарий: {text}\nСотрудник отпущен."
         )
     except: pass
     
-    await update.message.reply_text("✅ Изменения приняты, сотрудник уведомлен.")
+    await reply_text(context, update.message, "✅ Изменения приняты, сотрудник уведомлен.")
 
     # 5. Уведомляем сотрудника
     target_emp = await db_manager.get_employee_by_id(employee_id)
     if target_emp:
         try:
-            await context.bot.send_message(
+            await get_dispatcher(context).send_message(
+                priority=PRIORITY_APPROVAL,
                 chat_id=target_emp['personal_telegram_id'], 
                 text=f"⚠️ Ваша заявка изменена СБ.\nКомментарий: {text}\nСмена завершена."
             )
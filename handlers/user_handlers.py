@@ -1,16 +1,20 @@
 import logging
-from datetime import datetime,date, timedelta, time
+from datetime import datetime,date, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from telegram.helpers import escape_markdown
 from telegram.ext import ContextTypes, ConversationHandler
 from .auth_handlers import VERIFY_2FA_SETUP_CODE, AWAITING_ACTION_TOTP, start_2fa_setup
 import db_manager, config
+import redis_pool
+from redis.exceptions import RedisError
 import json
-from config import REDIS_OPERATORS_ONLINE_SET, REDIS_OPERATOR_TASK_PREFIX
+from config import REDIS_OPERATORS_ONLINE_SET
 from utils import generate_totp_qr_code, verify_totp, get_main_keyboard
 import pytz
 import calendar_helper 
-from utils import generate_table_image, get_timezone_for_city
+from utils import generate_table_image
+from telegram_dispatcher import get_dispatcher, reply_text, edit_query_text, PRIORITY_APPROVAL
+from topic_registry import get_or_create_topic
 
 logger = logging.getLogger(__name__)
 
@@ -36,7 +40,7 @@ async def my_schedule_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     user_id = update.effective_user.id
     employee = await db_manager.get_employee_by_telegram_id(user_id)
     if not employee:
-        await update.message.reply_text("Ваш профиль не найден.")
+        await reply_text(context, update.message, "Ваш профиль не найден.")
         return ConversationHandler.END
 
     # Сохраняем ID сотрудника (себя)
@@ -51,7 +55,7 @@ async def my_schedule_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Отправляем сообщение с инлайн-кнопками. 
     # Основная клавиатура (внизу) остается, так как мы не делаем ReplyKeyboardRemove
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Выберите период для просмотра вашего графика:", 
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -82,19 +86,12 @@ async def my_schedule_generate(update: Update, context: ContextTypes.DEFAULT_TYP
         next_q = date(today.year, end_month, 28) + timedelta(days=4)
         end_date = next_q - timedelta(days=next_q.day)
         
-    schedule_data = await db_manager.get_employee_schedule_for_period(employee_id, start_date, end_date)
+    schedule_data = await db_manager.get_employee_schedule_for_period(employee_id, start_date, end_date, read_only=True)
     
     # Подготовка данных для таблицы
     headers = ['Дата', 'День', 'Время', 'Статус', 'Комментарий']
     rows = []
     
-    def safe_fmt(val):
-        if not val: return "-"
-        if isinstance(val, str): return val[:5]
-        if isinstance(val, timedelta): return str(val)[:5]
-        if isinstance(val, (time, datetime)): return val.strftime('%H:%M')
-        return str(val)[:5]
-
     for day in schedule_data:
         dt = day['date']
         date_str = dt.strftime('%d.%m')
@@ -106,7 +103,7 @@ async def my_schedule_generate(update: Update, context: ContextTypes.DEFAULT_TYP
         comment = day.get('comment') or ""
         
         if start_t and end_t:
-            time_str = f"{safe_fmt(start_t)}-{safe_fmt(end_t)}"
+            time_str = f"{start_t}-{end_t}"
         else:
             time_str = "-"
             
@@ -128,7 +125,7 @@ async def my_schedule_generate(update: Update, context: ContextTypes.DEFAULT_TYP
     except:
         pass # Если не удалось удалить, не страшно
 
-    await context.bot.send_photo(
+    await get_dispatcher(context).send_photo(
         chat_id=update.effective_chat.id,
         photo=image_bio,
         caption=f"Ваш график за период {start_date.strftime('%d.%m')} - {end_date.strftime('%d.%m')}",
@@ -148,7 +145,7 @@ async def my_schedule_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         [InlineKeyboardButton("Текущий квартал", callback_data='my_period_quarter')],
         [InlineKeyboardButton("❌ Закрыть", callback_data='my_report_close')],
     ]
-    await query.edit_message_text("Выберите период для просмотра вашего графика:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await edit_query_text(context, query, "Выберите период для просмотра вашего графика:", reply_markup=InlineKeyboardMarkup(keyboard))
     return USER_REPORT_SELECT_PERIOD
 
 async def my_schedule_close(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -199,7 +196,7 @@ async def clock_in(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     employee = await db_manager.get_employee_by_telegram_id(user_id)
     if not employee:
-        await update.message.reply_text("Ваш профиль не найден в системе.")
+        await reply_text(context, update.message, "Ваш профиль не найден в системе.")
         return ConversationHandler.END
 
     if employee.get('position', '').strip().lower() == 'оператор':
@@ -211,16 +208,15 @@ async def clock_in(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return await start_2fa_setup(update, context)
     
     if employee['status'] == 'online':
-        await update.message.reply_text("Вы уже на линии.", reply_markup=get_main_keyboard(employee.get('role', 'employee')))
+        await reply_text(context, update.message, "Вы уже на линии.", reply_markup=get_main_keyboard(employee.get('role', 'employee')))
         return ConversationHandler.END
     
     if not await db_manager.has_clocked_in_today(employee['id']):
         context.user_data['pending_action'] = {'type': 'clock_in'}
-        await update.message.reply_text("Это ваш первый вход сегодня. Пожалуйста, введите код 2FA для подтверждения.")
+        await reply_text(context, update.message, "Это ваш первый вход сегодня. Пожалуйста, введите код 2FA для подтверждения.")
         return AWAITING_ACTION_TOTP
-    await db_manager.update_employee_status(employee['id'], 'online')
-    await db_manager.log_time_event(employee['id'], 'clock_in')
-    await update.message.reply_text("✅ Вы снова на линии!")
+    await db_manager.transition_status(employee['id'], 'online', 'clock_in')
+    await reply_text(context, update.message, "✅ Вы снова на линии!")
     return ConversationHandler.END
 
 
@@ -229,7 +225,7 @@ async def clock_out_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = update.effective_user.id
     employee = await db_manager.get_employee_by_telegram_id(user_id)
     if not employee:
-        await update.message.reply_text("Ваш профиль не найден в системе.")
+        await reply_text(context, update.message, "Ваш профиль не найден в системе.")
         return ConversationHandler.END
 
     if employee.get('position', '').strip().lower() == 'оператор':
@@ -241,11 +237,12 @@ async def clock_out_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context.user_data['original_update'] = update
         return await start_2fa_setup(update, context)
     if employee['status'] == 'offline':
-        await update.message.reply_text("Вы не на линии.")
+        await reply_text(context, update.message, "Вы не на линии.")
         return ConversationHandler.END
         
-    breaks_taken = await db_manager.get_today_event_count(employee['id'], 'Перерыв')
-    lunches_taken = await db_manager.get_today_event_count(employee['id'], 'Обед')
+    event_counts = await db_manager.get_today_event_counts(employee['id'])
+    breaks_taken = event_counts.get('Перерыв', 0)
+    lunches_taken = event_counts.get('Обед', 0)
     breaks_left = max(0, config.BREAK_LIMIT - breaks_taken)
     lunches_left = max(0, config.LUNCH_LIMIT - lunches_taken)
     
@@ -256,7 +253,7 @@ async def clock_out_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         [InlineKeyboardButton("Завершение дня", callback_data='off_reason_endday')],
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Выберите причину выхода из линии:", reply_markup=reply_markup)
+    await reply_text(context, update.message, "Выберите причину выхода из линии:", reply_markup=reply_markup)
     return 'AWAITING_REASON'
 
 async def clock_out_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -277,7 +274,7 @@ async def clock_out_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     # Распаковываем все 4 значения
     if query.data not in reason_map:
-        await query.edit_message_text("Ошибка: Неизвестная причина.")
+        await edit_query_text(context, query, "Ошибка: Неизвестная причина.")
         return ConversationHandler.END
 
     new_status, reason, limit, time_window = reason_map[query.data]
@@ -286,7 +283,7 @@ async def clock_out_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if limit != float('inf'):
         count = await db_manager.get_today_event_count(employee['id'], reason)
         if count >= limit:
-            await query.edit_message_text(f"Вы уже использовали все попытки для '{reason}' на сегодня.")
+            await edit_query_text(context, query, f"Вы уже использовали все попытки для '{reason}' на сегодня.")
             return ConversationHandler.END
 
     # 2. Проверка сделок для Кассира
@@ -302,23 +299,24 @@ async def clock_out_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
             callback_data = f"request_deal_approval_{employee['id']}_{query.data.split('_')[-1]}"
             keyboard = [[InlineKeyboardButton("Согласовать с СБ", callback_data=callback_data)]]
-            await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='MarkdownV2')
+            await edit_query_text(context, query, message, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='MarkdownV2')
             return 'AWAITING_REASON'
 
     # 3. Запрос на согласование инкассации
     if reason == 'Инкассация':
-        await query.edit_message_text("Для выхода на инкассацию требуется подтверждение от СБ. Запрос отправлен.")
+        await edit_query_text(context, query, "Для выхода на инкассацию требуется подтверждение от СБ. Запрос отправлен.")
         
         topic_name = f"Согласование Инкассации: {employee['full_name']} {datetime.now().strftime('%d.%m %H:%M')}"
-        topic = await context.bot.create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name)
+        thread_id = await get_or_create_topic(context, employee['id'], 'collection', topic_name, priority=PRIORITY_APPROVAL)
         
         keyboard = [[
             InlineKeyboardButton("✅ Согласовать", callback_data=f"approve_sb_inkas_{employee['id']}"),
             InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_sb_inkas_{employee['id']}")
         ]]
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
+            priority=PRIORITY_APPROVAL,
             chat_id=config.SECURITY_CHAT_ID,
-            message_thread_id=topic.message_thread_id,
+            message_thread_id=thread_id,
             text=f"Требуется согласование выхода на инкассацию.\n\n*Сотрудник:* {employee['full_name']}\n*Должность:* {employee['position']}",
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='Markdown'
@@ -335,30 +333,11 @@ async def clock_out_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             end_time_val = today_schedule['end_time']
             
             # 1. Определяем ЛОКАЛЬНОЕ время сотрудника
-            tz = get_timezone_for_city(employee.get('city'))
+            tz = db_manager.get_employee_timezone(employee)
             emp_now = datetime.now(tz)
             
-            planned_end_dt = None
-            
-            if end_time_val:
-                # Преобразуем end_time_val в time
-                et = None
-                if isinstance(end_time_val, str):
-                    try: et = datetime.strptime(end_time_val, '%H:%M:%S').time()
-                    except: 
-                        try: et = datetime.strptime(end_time_val, '%H:%M').time()
-                        except: pass
-                elif isinstance(end_time_val, timedelta):
-                    total_seconds = int(end_time_val.total_seconds())
-                    hours = total_seconds // 3600
-                    minutes = (total_seconds % 3600) // 60
-                    et = time(hour=hours, minute=minutes)
-                elif isinstance(end_time_val, time):
-                     et = end_time_val
-
-                if et:
-                    # Создаем datetime с правильной датой и таймзоной
-                    planned_end_dt = emp_now.replace(hour=et.hour, minute=et.minute, second=0, microsecond=0)
+            # Время в графике уже DayTime: переносим его на текущий день сотрудника
+            planned_end_dt = end_time_val.on(emp_now) if end_time_val is not None else None
             
             # Если плановое время определено и сейчас (у сотрудника) РАНЬШЕ (с запасом 5 минут)
             if planned_end_dt:
@@ -369,7 +348,7 @@ async def clock_out_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
                         'actual_end': emp_now.strftime('%H:%M')
                     }
                     
-                    await query.edit_message_text(
+                    await edit_query_text(context, query,
                         f"⚠️ В вашем городе ({employee.get('city', 'не указан')}) сейчас {emp_now.strftime('%H:%M')}.\n"
                         f"Вы завершаете смену раньше времени (план: {end_time_val}).\n\n"
                         f"Пожалуйста, укажите **причину раннего ухода** (отправьте текстовое сообщение):",
@@ -379,7 +358,7 @@ async def clock_out_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # 4. Если все проверки пройдены - запрашиваем 2FA у сотрудника
     context.user_data['pending_action'] = {'type': 'clock_out', 'status': new_status, 'reason': reason}
-    await query.edit_message_text("Для подтверждения действия введите 6-значный код из Authenticator.")
+    await edit_query_text(context, query, "Для подтверждения действия введите 6-значный код из Authenticator.")
 
     return AWAITING_ACTION_TOTP
 
@@ -391,7 +370,7 @@ async def get_early_leave_reason(update: Update, context: ContextTypes.DEFAULT_T
         [InlineKeyboardButton("Сегодня до конца смены", callback_data='leave_type_today_end')],
         [InlineKeyboardButton("Выбрать другое время/дату", callback_data='leave_type_custom')],
     ]
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Как вы планируете отсутствовать?",
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
@@ -410,7 +389,7 @@ async def select_leave_type(update: Update, context: ContextTypes.DEFAULT_TYPE)
         
     else: # custom
         context.user_data['early_leave_data']['mode'] = 'custom'
-        await query.edit_message_text(
+        await edit_query_text(context, query,
             "Выберите ДАТУ начала отсутствия:",
             reply_markup=calendar_helper.create_calendar()
         )
@@ -423,7 +402,7 @@ async def leave_date_start_callback(update: Update, context: ContextTypes.DEFAUL
     # Обработка навигации календаря
     if not query.data.startswith('cal_day_'):
         year, month = calendar_helper.process_calendar_selection(update)
-        await query.edit_message_text(text=query.message.text, reply_markup=calendar_helper.create_calendar(year, month))
+        await edit_query_text(context, query, text=query.message.text, reply_markup=calendar_helper.create_calendar(year, month))
         return SELECT_LEAVE_DATE_START
 
     selected_date = query.data.split('_')[2]
@@ -431,7 +410,7 @@ async def leave_date_start_callback(update: Update, context: ContextTypes.DEFAUL
     
     # Спрашиваем: это один день или период?
     # Для простоты давайте сразу спросим дату конца (если один день - выберет ту же)
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         f"Начало: {selected_date}\nТеперь выберите ДАТУ ОКОНЧАНИЯ (если один день — выберите ту же):",
         reply_markup=calendar_helper.create_calendar()
     )
@@ -444,14 +423,14 @@ async def leave_date_end_callback(update: Update, context: ContextTypes.DEFAULT_
     # Обработка навигации календаря
     if not query.data.startswith('cal_day_'):
         year, month = calendar_helper.process_calendar_selection(update)
-        await query.edit_message_text(text=query.message.text, reply_markup=calendar_helper.create_calendar(year, month))
+        await edit_query_text(context, query, text=query.message.text, reply_markup=calendar_helper.create_calendar(year, month))
         return SELECT_LEAVE_DATE_END
 
     selected_date = query.data.split('_')[2]
     context.user_data['early_leave_data']['date_end'] = selected_date
     
     # Теперь время начала отсутствия
-    await query.edit_message_text(
+    await edit_query_text(context, query,
         "Введите ВРЕМЯ НАЧАЛА отсутствия (в формате ЧЧ:ММ, например 11:00):"
     )
     return GET_LEAVE_TIME_START
@@ -462,12 +441,12 @@ async def get_leave_time_start(update: Update, context: ContextTypes.DEFAULT_TYP
     # Простая валидация времени
     import re
     if not re.match(r'^\d{2}:\d{2}$', time_str):
-        await update.message.reply_text("❌ Неверный формат времени. Введите в формате ЧЧ:ММ (например 11:00).")
+        await reply_text(context, update.message, "❌ Неверный формат времени. Введите в формате ЧЧ:ММ (например 11:00).")
         return GET_LEAVE_TIME_START
         
     context.user_data['early_leave_data']['time_start'] = time_str
     
-    await update.message.reply_text("Введите ВРЕМЯ ОКОНЧАНИЯ отсутствия (например 12:00):")
+    await reply_text(context, update.message, "Введите ВРЕМЯ ОКОНЧАНИЯ отсутствия (например 12:00):")
     return GET_LEAVE_TIME_END
 
 async def get_leave_time_end(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -476,7 +455,7 @@ async def get_leave_time_end(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Простая валидация
     import re
     if not re.match(r'^\d{2}:\d{2}$', time_str):
-        await update.message.reply_text("❌ Неверный формат времени. Введите в формате ЧЧ:ММ (например 18:00).")
+        await reply_text(context, update.message, "❌ Неверный формат времени. Введите в формате ЧЧ:ММ (например 18:00).")
         return GET_LEAVE_TIME_END
         
     context.user_data['early_leave_data']['time_end'] = time_str
@@ -506,14 +485,14 @@ async def send_early_leave_request_to_sb(update: Update, context: ContextTypes.D
     
     if update.callback_query:
         await update.callback_query.answer()
-        await update.callback_query.edit_message_text(user_response_text)
+        await edit_query_text(context, update.callback_query, user_response_text)
     else:
-        await update.message.reply_text(user_response_text)
+        await reply_text(context, update.message, user_response_text)
     
     # 5. Отправляем сообщение в чат СБ
     try:
         topic_name = f"Ранний уход: {employee['full_name']} {datetime.now().strftime('%d.%m')}"
-        topic = await context.bot.create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name)
+        topic = await get_dispatcher(context).create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name, priority=PRIORITY_APPROVAL)
         thread_id = topic.message_thread_id
     except Exception as e:
         logger.error(f"Error creating topic for early leave: {e}")
@@ -539,7 +518,8 @@ async def send_early_leave_request_to_sb(update: Update, context: ContextTypes.D
         f"*Запрашиваемый период:* {esc(period_str)}"
     )
     
-    await context.bot.send_message(
+    await get_dispatcher(context).send_message(
+        priority=PRIORITY_APPROVAL,
         chat_id=config.SECURITY_CHAT_ID,
         message_thread_id=thread_id,
         text=msg_text,
@@ -559,11 +539,11 @@ async def get_early_leave_period(update: Update, context: ContextTypes.DEFAULT_T
     employee = await db_manager.get_employee_by_telegram_id(user_id)
     
     # Формируем заявку для СБ
-    await update.message.reply_text("Заявка на ранний уход отправлена в СБ. Ожидайте решения.")
+    await reply_text(context, update.message, "Заявка на ранний уход отправлена в СБ. Ожидайте решения.")
     
     # Отправляем в СБ
     topic_name = f"Ранний уход: {employee['full_name']} {datetime.now().strftime('%d.%m')}"
-    topic = await context.bot.create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name)
+    topic = await get_dispatcher(context).create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name, priority=PRIORITY_APPROVAL)
     
     # Кнопки для СБ
     # approve_early_{emp_id}
@@ -585,7 +565,8 @@ async def get_early_leave_period(update: Update, context: ContextTypes.DEFAULT_T
         f"*Запрашиваемый период:* {escape_markdown(period_text, version=2)}"
     )
     
-    await context.bot.send_message(
+    await get_dispatcher(context).send_message(
+        priority=PRIORITY_APPROVAL,
         chat_id=config.SECURITY_CHAT_ID,
         message_thread_id=topic.message_thread_id,
         text=msg_text,
@@ -606,19 +587,20 @@ async def request_deal_approval_from_sb(update: Update, context: ContextTypes.DE
     
     employee = await db_manager.get_employee_by_id(employee_id)
     if not employee:
-        await query.edit_message_text("Ошибка: сотрудник не найден.")
+        await edit_query_text(context, query, "Ошибка: сотрудник не найден.")
         return ConversationHandler.END
         
-    await query.edit_message_text("Запрос на согласование из-за конфликта сделок отправлен в СБ.")
+    await edit_query_text(context, query, "Запрос на согласование из-за конфликта сделок отправлен в СБ.")
         
     topic_name = f"Сделка: Согласование ухода {employee['full_name']} {datetime.now().strftime('%d.%m %H:%M')}"
-    topic = await context.bot.create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name)
+    topic = await get_dispatcher(context).create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name, priority=PRIORITY_APPROVAL)
     
     keyboard = [[
         InlineKeyboardButton("✅ Согласовать", callback_data=f"approve_sb_deal_{employee_id}_{original_reason_key}"),
         InlineKeyboardButton("❌ Отклонить", callback_data=f"reject_sb_deal_{employee_id}")
     ]]
-    await context.bot.send_message(
+    await get_dispatcher(context).send_message(
+        priority=PRIORITY_APPROVAL,
         chat_id=config.SECURITY_CHAT_ID,
         message_thread_id=topic.message_thread_id,
         text=f"Требуется согласование ухода сотрудника из-за конфликта сделок.\n\n"
@@ -635,10 +617,10 @@ async def generate_report_placeholder(update: Update, context: ContextTypes.DEFA
     employee = await db_manager.get_employee_by_telegram_id(update.effective_user.id)
 
     if not employee or employee['role'].lower() not in ['security', 'admin']:
-        await update.message.reply_text(f"У вас нет прав для выполнения этого действия. Роль:{employee['role'].lower()}")
+        await reply_text(context, update.message, f"У вас нет прав для выполнения этого действия. Роль:{employee['role'].lower()}")
         return 
 
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Функция генерации отчетов находится в разработке.\n\n"
         "В будущем здесь можно будет выбрать сотрудника и период для получения детального отчета по отработанному времени."
     )
@@ -649,20 +631,24 @@ async def operator_clock_in(update: Update, context: ContextTypes.DEFAULT_TYPE)
     redis_client = context.bot_data.get('redis_op_client')
 
     if not redis_client:
-        await update.message.reply_text("❌ Ошибка: Сервис Redis недоступен. Не удалось выйти на линию.")
+        await reply_text(context, update.message, "❌ Ошибка: Сервис Redis недоступен. Не удалось выйти на линию.")
         return ConversationHandler.END
 
     try:
         employee = await db_manager.get_employee_by_telegram_id(update.effective_user.id)
         role = employee.get('role', 'employee')
 
-        if redis_client.sadd(REDIS_OPERATORS_ONLINE_SET, user_id):
-            await update.message.reply_text("✅ Вы успешно вышли на линию. Ожидайте задачи.", reply_markup=get_main_keyboard(role))
+        if await redis_client.sadd(REDIS_OPERATORS_ONLINE_SET, user_id):
+            await reply_text(context, update.message, "✅ Вы успешно вышли на линию. Ожидайте задачи.", reply_markup=get_main_keyboard(role))
         else:
-            await update.message.reply_text("ℹ️ Вы уже находитесь на линии.", reply_markup=get_main_keyboard(role))
-    except Exception as e:
+            await reply_text(context, update.message, "ℹ️ Вы уже находитесь на линии.", reply_markup=get_main_keyboard(role))
+    except RedisError as e:
+        redis_pool.note_error(e)
         logger.error(f"Redis error in operator_clock_in for user {user_id}: {e}")
-        await update.message.reply_text("❌ Ошибка Redis. Не удалось выйти на линию.")
+        await reply_text(context, update.message, "❌ Ошибка Redis. Не удалось выйти на линию.")
+    except Exception as e:
+        logger.error(f"Error in operator_clock_in for user {user_id}: {e}")
+        await reply_text(context, update.message, "❌ Ошибка. Не удалось выйти на линию.")
         
     return ConversationHandler.END
 
@@ -673,45 +659,38 @@ async def operator_clock_out(update: Update, context: ContextTypes.DEFAULT_TYPE)
     redis_client = context.bot_data.get('redis_op_client')
 
     if not redis_client:
-        await update.message.reply_text("❌ Ошибка: Сервис Redis недоступен. Не удалось уйти с линии.")
+        await reply_text(context, update.message, "❌ Ошибка: Сервис Redis недоступен. Не удалось уйти с линии.")
         return ConversationHandler.END
 
     try:
-        # Проверяем, есть ли у оператора активная задача
-        task_key = f"{REDIS_OPERATOR_TASK_PREFIX}{user_id}"
-        task_info_json = redis_client.get(task_key)
-
-        if task_info_json:
-            try:
-                task_info = json.loads(task_info_json)
-                status = task_info.get('status')
-                deal_id = task_info.get('deal_id')
-
-                if status == 'paused':
-                    message_text = f"🚫 Вы не можете уйти с линии. Ваша задача #{deal_id} находится на паузе. Сначала возобновите и завершите ее."
-                else:
-                    message_text = f"🚫 Вы не можете уйти с линии, у вас активная задача #{deal_id}."
-                
-                await update.message.reply_text(message_text)
-                return ConversationHandler.END
-            except (json.JSONDecodeError, TypeError):
-                await update.message.reply_text("🚫 Не удалось проверить ваш статус из-за ошибки данных в задаче. Завершите задачу и повторите.")
-                return ConversationHandler.END
-        
-        # Если активной задачи нет, убираем с линии
-        # SREM возвращает 1, если элемент был удален, и 0, если его не было.
+        # Проверка задачи и уход с линии — один атомарный скрипт в Redis
+        code, deal_id = await redis_pool.operator_clock_out(user_id)
+
+        if code == redis_pool.CLOCK_OUT_PAUSED_TASK:
+            await reply_text(context, update.message, f"🚫 Вы не можете уйти с линии. Ваша задача #{deal_id} находится на паузе. Сначала возобновите и завершите ее.")
+            return ConversationHandler.END
+        if code == redis_pool.CLOCK_OUT_ACTIVE_TASK:
+            await reply_text(context, update.message, f"🚫 Вы не можете уйти с линии, у вас активная задача #{deal_id}.")
+            return ConversationHandler.END
+        if code == redis_pool.CLOCK_OUT_BAD_TASK:
+            await reply_text(context, update.message, "🚫 Не удалось проверить ваш статус из-за ошибки данных в задаче. Завершите задачу и повторите.")
+            return ConversationHandler.END
 
         employee = await db_manager.get_employee_by_telegram_id(update.effective_user.id)
         role = employee.get('role', 'employee')
         
-        if redis_client.srem(REDIS_OPERATORS_ONLINE_SET, user_id):
-            await update.message.reply_text("☑️ Вы ушли с линии.", reply_markup=get_main_keyboard(role))
+        if code == redis_pool.CLOCK_OUT_REMOVED:
+            await reply_text(context, update.message, "☑️ Вы ушли с линии.", reply_markup=get_main_keyboard(role))
         else:
-            await update.message.reply_text("ℹ️ Вас не было на линии.", reply_markup=get_main_keyboard(role))
+            await reply_text(context, update.message, "ℹ️ Вас не было на линии.", reply_markup=get_main_keyboard(role))
 
-    except Exception as e:
+    except RedisError as e:
+        redis_pool.note_error(e)
         logger.error(f"Redis error in operator_clock_out for user {user_id}: {e}")
-        await update.message.reply_text("❌ Ошибка Redis. Не удалось уйти с линии.")
+        await reply_text(context, update.message, "❌ Ошибка Redis. Не удалось уйти с линии.")
+    except Exception as e:
+        logger.error(f"Error in operator_clock_out for user {user_id}: {e}")
+        await reply_text(context, update.message, "❌ Ошибка. Не удалось уйти с линии.")
         
     return ConversationHandler.END
 
@@ -722,7 +701,7 @@ async def show_my_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
     employee = await db_manager.get_employee_by_telegram_id(user_id)
     
     if not employee:
-        await update.message.reply_text("Ваша карточка не найдена.")
+        await reply_text(context, update.message, "Ваша карточка не найдена.")
         return
 
     
@@ -756,4 +735,4 @@ async def show_my_card(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for rel in relatives:
             text += f"\n- {rel['relationship_type']}: {rel['last_name']} {rel['first_name']} ({safe(rel.get('phone_number'))})"
 
-    await update.message.reply_text(text, parse_mode='Markdown')
\ No newline at end of file
+    await reply_text(context, update.message, text, parse_mode='Markdown')
\ No newline at end of file
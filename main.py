@@ -9,10 +9,13 @@ from telegram.ext import (
     ContextTypes,
     CallbackQueryHandler,
 )
-from config import BOT_TOKEN, REDIS_HOST, REDIS_PORT
+from config import BOT_TOKEN
 import db_manager
-from scheduler import start_scheduler
-import redis
+import migrations
+import alert_digest
+from scheduler import start_scheduler, stop_scheduler
+from telegram_dispatcher import TelegramDispatcher, reply_text
+import redis_pool
 from handlers import user_handlers, admin_handlers, auth_handlers
 from utils import get_main_keyboard, BTN_MY_CARD
 
@@ -31,21 +34,29 @@ BTN_REPORT = "📅 Мой график"
 BTN_ADMIN = "🔐 Админка"
 
 async def post_init(application: Application):
-    try:
-        redis_op_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
-        redis_op_client.ping()
-        application.bot_data['redis_op_client'] = redis_op_client
-        logger.info("Redis connection (db 0) established successfully.")
-    except redis.exceptions.ConnectionError as e:
-        logger.error(f"FATAL: Could not connect to Redis: {e}")
-        application.bot_data['redis_op_client'] = None
+    # Асинхронный клиент Redis (db 0) на общем пуле: не блокирует цикл событий и сам переподключается
+    application.bot_data['redis_op_client'] = await redis_pool.init_redis()
+
+    # Все исходящие сообщения идут через диспетчер с учетом лимитов Telegram
+    dispatcher = TelegramDispatcher(application.bot)
+    dispatcher.start()
+    application.bot_data['dispatcher'] = dispatcher
 
     await db_manager.init_pool()
-    await db_manager.reset_all_topic_ids()
+    await migrations.run_migrations()
+    await db_manager.start_write_behind()
     start_scheduler(application)
 
+async def post_stop(application: Application):
+    # Бот еще не закрыт — успеваем дослать то, что уже стоит в очереди диспетчера
+    await stop_scheduler()
+    await alert_digest.flush_all(application)
+    await application.bot_data['dispatcher'].stop()
+
 async def post_shutdown(application: Application):
+    await db_manager.stop_write_behind()
     await db_manager.close_pool()
+    await redis_pool.close_redis()
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -54,7 +65,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     reply_markup = get_main_keyboard(role)
 
-    await update.message.reply_text(
+    await reply_text(context, update.message,
         "Добро пожаловать в систему учета рабочего времени!\n"
         "Используйте кнопки меню для управления статусом.",
         reply_markup=reply_markup
@@ -163,6 +174,7 @@ def main() -> None:
     application.add_handler(MessageHandler(filters.Regex(f"^{BTN_REPORT}$"), user_handlers.generate_report_placeholder))
 
     application.post_init = post_init
+    application.post_stop = post_stop
     application.post_shutdown = post_shutdown
 
     logger.info("Bot is starting...")
@@ -0,0 +1,123 @@
+import logging
+from typing import Awaitable, Callable, List, Tuple
+
+import db_manager
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = "schema_migrations"
+
+
+async def _ensure_index(table: str, index_name: str, columns: str):
+    """
+    Создает индекс, если его еще нет.
+    В MySQL нет CREATE INDEX IF NOT EXISTS, поэтому проверяем information_schema.
+    """
+    query = """
+        SELECT 1 FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        LIMIT 1
+    """
+    if await db_manager.fetch_one(query, (table, index_name)):
+        logger.info(f"Index {index_name} on {table} already exists, skipping.")
+        return
+    await db_manager.execute(f"CREATE INDEX {index_name} ON {table} ({columns})")
+    logger.info(f"Created index {index_name} on {table} ({columns}).")
+
+
+async def _column_exists(table: str, column: str) -> bool:
+    query = """
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        LIMIT 1
+    """
+    return await db_manager.fetch_one(query, (table, column)) is not None
+
+
+# --- Migrations ---
+async def _m001_time_log_indexes():
+    await _ensure_index("time_log", "idx_time_log_employee_ts", "employee_id, timestamp")
+    await _ensure_index("time_log", "idx_time_log_employee_event_ts", "employee_id, event_type, timestamp")
+
+
+async def _m002_crypto_deals_index():
+    await _ensure_index("CryptoDeals", "idx_deals_employee_status_meeting", "employee_id, status, datetime_meeting")
+
+
+async def _m003_employee_requests_index():
+    await _ensure_index("employee_requests", "idx_requests_employee_type_status", "employee_id, request_type, status, id")
+
+
+async def _m004_schedule_override_ranges():
+    # Исключение в графике теперь диапазон [work_date, end_date]; старые строки — диапазоны из одного дня
+    if not await _column_exists("schedule_overrides", "end_date"):
+        await db_manager.execute("ALTER TABLE schedule_overrides ADD COLUMN end_date DATE NULL AFTER work_date")
+    await db_manager.execute("UPDATE schedule_overrides SET end_date = work_date WHERE end_date IS NULL")
+    await db_manager.execute("ALTER TABLE schedule_overrides MODIFY end_date DATE NOT NULL")
+    await _ensure_index("schedule_overrides", "idx_overrides_employee_end", "employee_id, end_date")
+
+
+async def _m005_compact_schedule_overrides():
+    result = await db_manager.compact_schedule_overrides()
+    logger.info(f"Compacted schedule overrides: {result}")
+
+
+async def _m006_schedule_override_segments():
+    # Рабочие куски разорванной смены ('09:00-11:00,12:00-18:00'); NULL — обычная смена start_time..end_time
+    if not await _column_exists("schedule_overrides", "segments"):
+        await db_manager.execute("ALTER TABLE schedule_overrides ADD COLUMN segments VARCHAR(255) NULL AFTER end_time")
+
+
+async def _m007_security_alerts():
+    # Каждое уведомление СБ (опоздание, превышение перерыва) — отдельной строкой, даже если в чат ушла сводка
+    await db_manager.execute("""
+        CREATE TABLE IF NOT EXISTS security_alerts (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            employee_id INT NOT NULL,
+            kind VARCHAR(32) NOT NULL,
+            group_key VARCHAR(255) NULL,
+            details VARCHAR(255) NULL,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            INDEX idx_security_alerts_employee_created (employee_id, created_at),
+            INDEX idx_security_alerts_created (created_at)
+        )
+    """)
+
+
+# Версия, описание, функция. Новые миграции добавляются только в конец списка.
+MIGRATIONS: List[Tuple[int, str, Callable[[], Awaitable[None]]]] = [
+    (1, "time_log indexes for per-day lookups", _m001_time_log_indexes),
+    (2, "CryptoDeals index for schedule conflict checks", _m002_crypto_deals_index),
+    (3, "employee_requests index for pending request lookup", _m003_employee_requests_index),
+    (4, "schedule_overrides date ranges (end_date)", _m004_schedule_override_ranges),
+    (5, "merge adjacent identical per-day schedule overrides", _m005_compact_schedule_overrides),
+    (6, "schedule_overrides segments for split shifts", _m006_schedule_override_segments),
+    (7, "security_alerts log of individual alerts", _m007_security_alerts),
+]
+
+
+async def run_migrations():
+    """
+    Применяет недостающие миграции по порядку и записывает их версии в schema_migrations.
+    Каждая миграция идемпотентна, поэтому повторный запуск после сбоя безопасен.
+    """
+    await db_manager.execute(f"""
+        CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    rows = await db_manager.fetch_all(f"SELECT version FROM {MIGRATIONS_TABLE}")
+    applied = {row['version'] for row in rows}
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info(f"Applying migration {version}: {description}")
+        await migrate()
+        await db_manager.execute(
+            f"INSERT INTO {MIGRATIONS_TABLE} (version, description) VALUES (%s, %s)",
+            (version, description)
+        )
+    logger.info("Database schema is up to date.")
@@ -0,0 +1,144 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+
+import redis.asyncio as aioredis
+from redis.backoff import ExponentialBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from redis.asyncio.retry import Retry
+
+from config import (
+    REDIS_HOST, REDIS_PORT, REDIS_POOL_MAX_SIZE, REDIS_SOCKET_TIMEOUT_SEC, REDIS_CONNECT_TIMEOUT_SEC,
+    REDIS_RETRY_ATTEMPTS, REDIS_HEALTH_CHECK_INTERVAL_SEC, REDIS_OPERATORS_ONLINE_SET, REDIS_OPERATOR_TASK_PREFIX,
+)
+
+logger = logging.getLogger(__name__)
+
+# Единственный асинхронный клиент Redis (db 0) поверх общего пула соединений
+client: Optional[aioredis.Redis] = None
+_pool: Optional["_CountingConnectionPool"] = None
+_clock_out_script = None
+
+# Результат ухода оператора с линии (operator_clock_out)
+CLOCK_OUT_REMOVED = 0
+CLOCK_OUT_ACTIVE_TASK = 1
+CLOCK_OUT_PAUSED_TASK = 2
+CLOCK_OUT_NOT_ONLINE = 3
+CLOCK_OUT_BAD_TASK = -1
+
+# KEYS[1] — задача оператора, KEYS[2] — множество операторов на линии, ARGV[1] — ID оператора.
+# Проверка задачи и SREM выполняются атомарно: задачу нельзя назначить "между" ними.
+_OPERATOR_CLOCK_OUT_LUA = """
+local raw = redis.call('GET', KEYS[1])
+if raw and raw ~= '' then
+    local ok, task = pcall(cjson.decode, raw)
+    if not ok or type(task) ~= 'table' then
+        return {-1, ''}
+    end
+    local deal_id = task['deal_id']
+    if type(deal_id) == 'number' then
+        deal_id = string.format('%.0f', deal_id)
+    elseif type(deal_id) ~= 'string' then
+        deal_id = ''
+    end
+    if task['status'] == 'paused' then
+        return {2, deal_id}
+    end
+    return {1, deal_id}
+end
+if redis.call('SREM', KEYS[2], ARGV[1]) == 1 then
+    return {0, ''}
+end
+return {3, ''}
+"""
+
+_stats = {
+    'in_use': 0,
+    'peak_in_use': 0,
+    'acquired': 0,
+    'errors': 0,
+    'last_error': None,
+    'last_error_at': None,
+}
+
+
+class _CountingConnectionPool(aioredis.ConnectionPool):
+    """Пул, который сам считает выданные соединения — без чтения внутренних полей redis-py."""
+
+    async def get_connection(self, *args, **kwargs):
+        connection = await super().get_connection(*args, **kwargs)
+        _stats['in_use'] += 1
+        _stats['acquired'] += 1
+        _stats['peak_in_use'] = max(_stats['peak_in_use'], _stats['in_use'])
+        return connection
+
+    async def release(self, connection):
+        try:
+            await super().release(connection)
+        finally:
+            _stats['in_use'] -= 1
+
+
+async def init_redis() -> aioredis.Redis:
+    """
+    Создает общий пул и клиент Redis. Таймауты не дают зависшему Redis заблокировать бота,
+    а обрывы соединения и таймауты повторяются с экспоненциальной задержкой.
+    Если Redis сейчас недоступен, клиент все равно создается — пул переподключится при следующей команде.
+    """
+    global client, _pool, _clock_out_script
+    _pool = _CountingConnectionPool(
+        host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True,
+        max_connections=REDIS_POOL_MAX_SIZE,
+        socket_timeout=REDIS_SOCKET_TIMEOUT_SEC,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT_SEC,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL_SEC,
+        retry=Retry(ExponentialBackoff(cap=1.0, base=0.05), REDIS_RETRY_ATTEMPTS),
+        retry_on_error=[RedisConnectionError, RedisTimeoutError],
+    )
+    client = aioredis.Redis(connection_pool=_pool)
+    # EVALSHA по кэшированному SHA; после перезапуска Redis скрипт перезагрузится сам (NOSCRIPT -> EVAL)
+    _clock_out_script = client.register_script(_OPERATOR_CLOCK_OUT_LUA)
+    try:
+        await client.ping()
+        logger.info(f"Redis connection pool created ({REDIS_HOST}:{REDIS_PORT}, max={REDIS_POOL_MAX_SIZE}).")
+    except Exception as e:
+        note_error(e)
+        logger.error(f"Redis is not reachable at startup, will keep retrying on demand: {e}")
+    return client
+
+
+async def close_redis():
+    global client, _pool, _clock_out_script
+    if client is not None:
+        await client.aclose()
+    if _pool is not None:
+        await _pool.disconnect()
+    client = None
+    _pool = None
+    _clock_out_script = None
+    logger.info("Redis connection pool closed.")
+
+
+def note_error(error: BaseException):
+    """Учитывает ошибку Redis (вызывается из мест, где ошибка перехвачена и обработана)."""
+    _stats['errors'] += 1
+    _stats['last_error'] = repr(error)
+    _stats['last_error_at'] = datetime.now().isoformat(timespec='seconds')
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """Состояние пула Redis: занятые соединения (сейчас и пик), число выдач и последние ошибки."""
+    if _pool is None:
+        return {}
+    return {'maxsize': _pool.max_connections, **_stats}
+
+
+async def operator_clock_out(user_id: int) -> Tuple[int, Optional[str]]:
+    """
+    Убирает оператора с линии одним атомарным вызовом, если у него нет задачи.
+    Возвращает (код CLOCK_OUT_*, ID сделки для активной/приостановленной задачи).
+    """
+    code, deal_id = await _clock_out_script(
+        keys=[f"{REDIS_OPERATOR_TASK_PREFIX}{user_id}", REDIS_OPERATORS_ONLINE_SET], args=[user_id]
+    )
+    return int(code), deal_id or None
@@ -0,0 +1,266 @@
+import re
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_PATTERN = '5/2'
+
+_NM_RE = re.compile(r"(\d+)/(\d+)")
+
+
+class Rotation:
+    """
+    Ротация графика: маска рабочих дней цикла (True — рабочий) и способ привязки.
+    weekly=True — цикл из 7 дней, привязанный к дням недели (bits[0] — понедельник);
+    иначе цикл отсчитывается от даты начала графика сотрудника.
+    """
+
+    __slots__ = ("bits", "weekly")
+
+    def __init__(self, bits: Sequence[bool], weekly: bool = False):
+        self.bits = np.asarray(bits, dtype=bool)
+        self.weekly = weekly
+        if not len(self.bits) or (weekly and len(self.bits) != 7):
+            raise ValueError(f"Invalid rotation mask: {list(bits)} (weekly={weekly})")
+
+    @property
+    def period(self) -> int:
+        return len(self.bits)
+
+
+_custom_patterns: Dict[str, Rotation] = {}
+
+
+def register_pattern(name: str, rotation: Rotation):
+    """Регистрирует именованный график (например, особый сменный цикл) в дополнение к встроенным."""
+    _custom_patterns[name.strip()] = rotation
+    parse_pattern.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def parse_pattern(pattern: Optional[str]) -> Rotation:
+    """
+    Разбирает строку графика:
+      - зарегистрированные через register_pattern имена;
+      - 'N/M' — N рабочих, M выходных. При N+M == 7 цикл недельный (выходные — последние дни недели:
+        '5/2' — СБ и ВС, '6/1' — ВС, '7/0' — без выходных), иначе цикл идет от даты начала графика ('2/2');
+      - 'mask:1100…' — произвольный цикл от даты начала графика (1 — рабочий день, 0 — выходной);
+      - 'week:1111100' — произвольная маска по дням недели, начиная с понедельника.
+    Неизвестный или пустой график считается '5/2', как и раньше.
+    """
+    name = (pattern or DEFAULT_PATTERN).strip()
+
+    if name in _custom_patterns:
+        return _custom_patterns[name]
+
+    for prefix, weekly in (('mask:', False), ('week:', True)):
+        if name.startswith(prefix):
+            bits = name[len(prefix):].strip()
+            if bits and set(bits) <= {'0', '1'} and (not weekly or len(bits) == 7):
+                return Rotation([c == '1' for c in bits], weekly=weekly)
+            return parse_pattern(DEFAULT_PATTERN)
+
+    match = _NM_RE.fullmatch(name)
+    if match:
+        work, off = int(match.group(1)), int(match.group(2))
+        if work + off == 7:
+            return Rotation([True] * work + [False] * off, weekly=True)
+        if work + off > 0:
+            return Rotation([True] * work + [False] * off)
+
+    return parse_pattern(DEFAULT_PATTERN)
+
+
+def work_masks(patterns: Sequence[Optional[str]], anchors: Sequence[date], start_date: date, end_date: date) -> np.ndarray:
+    """
+    Маски рабочих дней по базовому графику (без исключений) для многих сотрудников сразу.
+    Возвращает массив bool формы (число сотрудников, число дней периода).
+    Сотрудники группируются по графику, и каждая группа считается одной векторной операцией.
+    """
+    n_days = max((end_date - start_date).days + 1, 0)
+    result = np.zeros((len(patterns), n_days), dtype=bool)
+    if not n_days or not len(patterns):
+        return result
+
+    offsets = np.arange(n_days)
+    groups: Dict[int, List[int]] = {}
+    rotations: Dict[int, Rotation] = {}
+    for row, pattern in enumerate(patterns):
+        rotation = parse_pattern(pattern)
+        groups.setdefault(id(rotation), []).append(row)
+        rotations[id(rotation)] = rotation
+
+    for key, rows in groups.items():
+        rotation = rotations[key]
+        if rotation.weekly:
+            result[rows] = rotation.bits[(start_date.weekday() + offsets) % 7]
+        else:
+            shifts = np.array([(start_date - anchors[row]).days for row in rows])
+            result[rows] = rotation.bits[(shifts[:, None] + offsets[None, :]) % rotation.period]
+    return result
+
+
+def override_index(n_rows: int, start_date: date, end_date: date, rows: Sequence[int],
+                   range_starts: Sequence[date], range_ends: Sequence[date]) -> np.ndarray:
+    """
+    Для каждого сотрудника и дня — номер исключения (позиция в переданных списках), покрывающего этот день,
+    или -1, если исключения нет. Диапазоны обрезаются по периоду; при пересечении побеждает более поздний.
+    Заполнение идет без цикла по дням: все покрытые ячейки вычисляются через np.repeat.
+    """
+    n_days = max((end_date - start_date).days + 1, 0)
+    result = np.full((n_rows, n_days), -1, dtype=np.int64)
+    if not len(rows) or not n_days:
+        return result
+
+    raw_first = np.array([(d - start_date).days for d in range_starts])
+    raw_last = np.array([(d - start_date).days for d in range_ends])
+    # Диапазоны, не задевающие период, отбрасываем; остальные обрезаем по его границам
+    inside = (raw_last >= 0) & (raw_first < n_days) & (raw_first <= raw_last)
+    ids = np.flatnonzero(inside)
+    if not len(ids):
+        return result
+    first = raw_first[inside].clip(0, n_days - 1)
+    lengths = raw_last[inside].clip(0, n_days - 1) - first + 1
+
+    total = lengths.sum()
+    row_idx = np.repeat(np.asarray(rows)[ids], lengths)
+    # Позиция внутри диапазона: 0, 1, 2, ... для каждого диапазона подряд
+    within = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    col_idx = np.repeat(first, lengths) + within
+    result[row_idx, col_idx] = np.repeat(ids, lengths)
+    return result
+
+
+# --- Интервалы времени внутри дня (в минутах от полуночи) ---
+Interval = Tuple[int, int]
+
+MINUTES_IN_DAY = 24 * 60
+
+
+class DayTime(int):
+    """
+    Время суток в минутах от полуночи — единое представление времени графика после чтения из БД.
+    Это обычный int (сравнение и арифметика — целочисленные), но печатается как 'HH:MM',
+    поэтому его можно сразу подставлять в f-строки, CSV и параметры запросов (уходит в БД строкой 'HH:MM').
+    00:00 — тоже заданное время, поэтому DayTime всегда истинно; "времени нет" — это None.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, minutes: int):
+        return super().__new__(cls, minutes % MINUTES_IN_DAY)
+
+    @classmethod
+    def parse(cls, value: Any) -> Optional["DayTime"]:
+        """timedelta из БД, time, 'HH:MM[:SS]' или число минут -> DayTime; пустое значение -> None."""
+        if value is None or isinstance(value, cls):
+            return value
+        minutes = to_minutes(value)
+        return cls(minutes) if minutes is not None else None
+
+    @property
+    def hour(self) -> int:
+        return int(self) // 60
+
+    @property
+    def minute(self) -> int:
+        return int(self) % 60
+
+    def on(self, moment: datetime) -> datetime:
+        """Это время в тот же день и в той же таймзоне, что и moment."""
+        return moment.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __str__(self) -> str:
+        return f"{self.hour:02d}:{self.minute:02d}"
+
+    def __repr__(self) -> str:
+        return f"DayTime({self})"
+
+    def __format__(self, spec: str) -> str:
+        return format(str(self), spec)
+
+
+def to_minutes(value: Any) -> Optional[int]:
+    """Время из БД (timedelta), из кода (time, DayTime) или строкой 'HH:MM[:SS]' -> минуты от полуночи."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, int):
+        return int(value)
+    if isinstance(value, timedelta):
+        return int(value.total_seconds()) // 60
+    if isinstance(value, time):
+        return value.hour * 60 + value.minute
+    parts = str(value).strip().split(':')
+    return int(parts[0]) * 60 + int(parts[1])
+
+
+def format_minutes(minutes: int) -> str:
+    minutes %= MINUTES_IN_DAY
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def subtract_intervals(base: Sequence[Interval], cuts: Sequence[Interval]) -> List[Interval]:
+    """
+    Вычитает из набора интервалов [start, end) другой набор. Результат отсортирован,
+    пустые куски отброшены; вырез посередине дает два интервала (разорванная смена).
+    """
+    result = sorted(base)
+    for cut_start, cut_end in sorted(cuts):
+        pieces = []
+        for start, end in result:
+            if cut_end <= start or cut_start >= end:
+                pieces.append((start, end))
+                continue
+            if start < cut_start:
+                pieces.append((start, cut_start))
+            if cut_end < end:
+                pieces.append((cut_end, end))
+        result = pieces
+    return result
+
+
+def day_interval(start: Any, end: Any) -> Optional[Interval]:
+    """Интервал смены/отсутствия; если конец не позже начала, интервал переходит через полночь."""
+    start_min, end_min = to_minutes(start), to_minutes(end)
+    if start_min is None or end_min is None:
+        return None
+    if end_min <= start_min:
+        end_min += MINUTES_IN_DAY
+    return start_min, end_min
+
+
+def subtract_absence(work: Sequence[Interval], absence: Interval) -> List[Interval]:
+    """
+    Вычитает отсутствие из смены. У смены через полночь (конец > 24:00) отсутствие из утренних часов,
+    лежащее раньше начала смены (02:00-04:00 при смене 20:00-08:00), относится ко второй половине
+    смены — переносим его на сутки вперед.
+    """
+    shift_start, shift_end = work[0][0], work[-1][1]
+    start, end = absence
+    if shift_end > MINUTES_IN_DAY and start < shift_start and start + MINUTES_IN_DAY < shift_end:
+        absence = (start + MINUTES_IN_DAY, end + MINUTES_IN_DAY)
+    return subtract_intervals(work, [absence])
+
+
+def format_segments(segments: Sequence[Interval]) -> str:
+    """[(540, 660), (720, 1080)] -> '09:00-11:00,12:00-18:00'."""
+    return ",".join(f"{format_minutes(start)}-{format_minutes(end)}" for start, end in segments)
+
+
+def parse_segments(value: Optional[str]) -> List[Interval]:
+    """Обратное к format_segments (куски после полуночи снова получают +24:00)."""
+    if not value:
+        return []
+    segments = []
+    for part in value.split(','):
+        interval = day_interval(*part.split('-'))
+        if interval:
+            if segments and interval[0] < segments[-1][1]:
+                interval = (interval[0] + MINUTES_IN_DAY, interval[1] + MINUTES_IN_DAY)
+            segments.append(interval)
+    return segments
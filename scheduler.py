@@ -1,5 +1,9 @@
+import asyncio
+import json
 import logging
-from datetime import datetime, time, timedelta
+from datetime import date, datetime, time, timedelta, timezone
+from functools import partial
+from typing import Any, Dict, List, Optional
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from telegram.ext import Application, ContextTypes
 from telegram.error import BadRequest
@@ -7,7 +11,11 @@ from telegram.helpers import escape_markdown
 import db_manager
 import config
 import pytz
-from utils import get_timezone_for_city
+from utils import group_by_utc_offset, get_timezone_for_city
+from deadline_scheduler import DeadlineScheduler
+from telegram_dispatcher import get_dispatcher, PRIORITY_ALERT
+from topic_registry import get_or_create_topic, close_stale_topics
+from alert_digest import add_alert, digest_group
 
 logger = logging.getLogger(__name__)
 
@@ -15,88 +23,179 @@ logger = logging.getLogger(__name__)
 # Вы можете заменить на 'Asia/Tashkent' или другой город в UTC+5, если нужно
 TARGET_TIMEZONE = pytz.timezone('Asia/Yekaterinburg')
 
-async def check_lateness_job(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Running lateness check job (Multi-timezone)...")
-    
-    # 1. Получаем сотрудников (добавили поле city в выборку!)
-    employees = await db_manager.fetch_all("""
-        SELECT id, full_name, city, position, default_start_time, status, 
-               schedule_pattern, schedule_start_date, hire_date, last_lateness_alert_date
-        FROM employees 
-        WHERE termination_date IS NULL 
-          AND status = 'offline'
-          AND (last_lateness_alert_date IS NULL OR last_lateness_alert_date != CURDATE())
-    """)
-    
-    for emp in employees:
-        try:
-            # 2. Определяем ЛОКАЛЬНОЕ время сотрудника
-            tz = get_timezone_for_city(emp.get('city'))
-            emp_now = datetime.now(tz)
-            today_date = emp_now.date()
-            
-            # 3. Получаем график на ЕГО текущий день
-            schedule_info_list = await db_manager.get_employee_schedule_for_period(emp['id'], today_date, today_date)
-            
-            if not schedule_info_list:
+# --- Опоздания: таймер на каждого сотрудника вместо периодического опроса ---
+# Ключи таймеров: ('lateness', employee_id) — дедлайн "начало смены + льготный период";
+# ('lateness_midnight', utc_offset) — локальная полночь пояса, когда таймеры ставятся на новый день.
+deadlines = DeadlineScheduler(max_concurrency=config.ALERT_DISPATCH_CONCURRENCY)
+
+# Статус и дату последнего уведомления не фильтруем в SQL: в полночь восточных поясов CURDATE() сервера
+# еще вчерашний, а кто-то еще на линии до ночного сброса. Сравниваем с локальной датой пояса ниже,
+# а статус перепроверяется в момент срабатывания таймера.
+_LATENESS_CANDIDATES_QUERY = """
+    SELECT id, full_name, city, position, status, last_lateness_alert_date
+    FROM employees 
+    WHERE termination_date IS NULL
+"""
+
+async def arm_lateness_deadlines(application: Application, employee_ids: Optional[List[int]] = None,
+                                 utc_offset: Optional[timedelta] = None):
+    """
+    Ставит таймеры опозданий на текущий локальный день: всем сотрудникам, только указанным
+    или только поясу с заданным смещением от UTC. Таймер срабатывает ровно в "начало + льготный период"
+    (если этот момент уже прошел — сразу), снимается при входе на смену и ставится заново при уходе с нее.
+    """
+    query, args = _LATENESS_CANDIDATES_QUERY, ()
+    if employee_ids is not None:
+        if not employee_ids:
+            return
+        for employee_id in employee_ids:
+            deadlines.cancel(('lateness', employee_id))
+        query += f" AND id IN ({', '.join(['%s'] * len(employee_ids))})"
+        args = tuple(employee_ids)
+    employees = await db_manager.fetch_all(query, args)
+    if not employees:
+        return
+
+    buckets = group_by_utc_offset(employees, db_manager.get_employee_timezone)
+    if utc_offset is not None:
+        buckets = [bucket for bucket in buckets if bucket[0].utcoffset() == utc_offset]
+    if not buckets:
+        return
+
+    # Графики всех сразу: локальные даты отличаются максимум на день, берем общий диапазон
+    first_date = min(bucket_now.date() for bucket_now, _ in buckets)
+    last_date = max(bucket_now.date() for bucket_now, _ in buckets)
+    schedules = await db_manager.get_schedules_for_employees(
+        [emp['id'] for _, group in buckets for emp in group], first_date, last_date
+    )
+    grace_period = timedelta(minutes=config.LATENESS_GRACE_PERIOD_MIN)
+
+    armed = 0
+    for emp_now, group in buckets:
+        # День графика, соответствующий локальной дате группы
+        local_day = emp_now.date()
+        day_index = (local_day - first_date).days
+        for emp in group:
+            # Уже получал уведомление в этот локальный день
+            if emp.get('last_lateness_alert_date') == local_day:
+                deadlines.cancel(('lateness', emp['id']))
                 continue
-                
-            today_schedule = schedule_info_list[0]
-            
-            # Если выходной/отгул - пропускаем
-            if today_schedule['status'] in ['Выходной', 'Отгул/Больничный']:
+            schedule = schedules.get(emp['id'], [])
+            today_schedule = schedule[day_index] if day_index < len(schedule) else None
+            # Выходной/отгул или время начала не задано — опаздывать некуда
+            if not today_schedule or today_schedule['status'] in ['Выходной', 'Отгул/Больничный']:
+                deadlines.cancel(('lateness', emp['id']))
                 continue
-                
-            start_time_val = today_schedule['start_time']
-            if not start_time_val:
+            start_time = today_schedule['start_time']
+            if start_time is None:
+                deadlines.cancel(('lateness', emp['id']))
                 continue
 
-            # Приведение start_time к datetime.time
-            start_time = None
-            if isinstance(start_time_val, timedelta):
-                total_seconds = int(start_time_val.total_seconds())
-                hours = total_seconds // 3600
-                minutes = (total_seconds % 3600) // 60
-                start_time = time(hour=hours, minute=minutes)
-            elif isinstance(start_time_val, str):
-                try:
-                    start_time = datetime.strptime(start_time_val, '%H:%M:%S').time()
-                except ValueError:
-                    start_time = datetime.strptime(start_time_val, '%H:%M').time()
-            elif isinstance(start_time_val, time):
-                start_time = start_time_val
-
-            if not start_time:
-                continue
+            deadlines.schedule(
+                ('lateness', emp['id']), start_time.on(emp_now) + grace_period,
+                partial(_lateness_deadline_reached, application, emp['id'], start_time, local_day)
+            )
+            armed += 1
+    logger.info(f"Lateness deadlines armed: {armed} (employees={'all' if employee_ids is None else employee_ids}, offset={utc_offset})")
 
-            # 4. Сравниваем время
-            # Создаем planned_start_dt в ТОМ ЖЕ часовом поясе, что и emp_now
-            planned_start_dt = emp_now.replace(hour=start_time.hour, minute=start_time.minute, second=0, microsecond=0)
-            
-            grace_period = timedelta(minutes=config.LATENESS_GRACE_PERIOD_MIN)
-            
-            # Если текущее время сотрудника больше чем план + опоздание
-            if emp_now > planned_start_dt + grace_period:
-                await send_lateness_alert(context, emp, start_time)
-                
-        except Exception as e:
-            logger.error(f"Error checking lateness for {emp.get('full_name')} ({emp.get('city')}): {e}")
+async def _lateness_deadline_reached(application: Application, employee_id: int, start_time, local_day: date):
+    """Дедлайн наступил и вход на смену его не снял — перепроверяем по свежим данным и шлем уведомление."""
+    emp = await db_manager.get_employee_by_id(employee_id)
+    # Статус проверяем здесь, а не при постановке таймера: в полночь сотрудник мог еще быть на линии
+    if not emp or emp.get('termination_date') or emp['status'] != 'offline':
+        return
+    if emp.get('last_lateness_alert_date') == local_day:
+        return
+    # Уже отмечался в этот день (вышел и ушел до дедлайна или таймер поставлен после перезапуска)
+    if await db_manager.has_clocked_in_today(employee_id):
+        return
+    await send_lateness_alert(application, emp, start_time, local_day)
 
-async def send_lateness_alert(context, emp, start_time):
-    try:
-        now_str = datetime.now(TARGET_TIMEZONE).strftime('%d.%m.%Y')
-        topic_name = f"Опоздание: {emp['full_name']} {now_str}"
-        
-        thread_id = None
-        try:
-            topic = await context.bot.create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name)
-            thread_id = topic.message_thread_id
-        except Exception as e:
-            logger.error(f"Could not create topic: {e}")
+def _local_midnight_offsets() -> List[timedelta]:
+    """Смещения от UTC всех поясов из справочника городов (и пояса по умолчанию)."""
+    zones = {get_timezone_for_city(city) for city in config.CITY_TIMEZONES} | {get_timezone_for_city(None)}
+    now_utc = datetime.now(timezone.utc)
+    return sorted({now_utc.astimezone(tz).utcoffset() for tz in zones})
+
+def _arm_local_midnight(application: Application, utc_offset: timedelta):
+    """Таймер на ближайшую полночь пояса: ставит таймеры опозданий на новый день и переставляет себя."""
+    local_now = datetime.now(timezone(utc_offset))
+    next_midnight = datetime.combine(local_now.date() + timedelta(days=1), time.min, tzinfo=local_now.tzinfo)
+
+    async def on_midnight():
+        _arm_local_midnight(application, utc_offset)
+        await arm_lateness_deadlines(application, utc_offset=utc_offset)
 
+    deadlines.schedule(('lateness_midnight', utc_offset), next_midnight, on_midnight)
+
+_lateness_rearm_pending: set = set()
+_lateness_rearm_task: Optional[asyncio.Task] = None
+# Задача start_deadline_timers (см. start_scheduler); отменяется в stop_scheduler
+_startup_task: Optional[asyncio.Task] = None
+
+async def _rearm_pending_lateness(application: Application):
+    global _lateness_rearm_task
+    # Даем накопиться пачке событий (ночной сброс выводит с линии всех разом) — один запрос на всех
+    await asyncio.sleep(0)
+    employee_ids = list(_lateness_rearm_pending)
+    _lateness_rearm_pending.clear()
+    _lateness_rearm_task = None
+    await arm_lateness_deadlines(application, employee_ids)
+
+def _request_lateness_rearm(application: Application, employee_id: int):
+    global _lateness_rearm_task
+    _lateness_rearm_pending.add(employee_id)
+    if _lateness_rearm_task is None or _lateness_rearm_task.done():
+        _lateness_rearm_task = asyncio.create_task(_rearm_pending_lateness(application))
+
+async def _on_status_changed(application: Application, employee_id: int, status: str):
+    # Вышел на смену (или ушел на перерыв/обед) — опоздания сегодня уже не будет;
+    # ушел с линии — таймер на текущий (или уже наступивший новый) локальный день ставится заново
+    if status != 'offline':
+        deadlines.cancel(('lateness', employee_id))
+    else:
+        _request_lateness_rearm(application, employee_id)
+    # Ушел на перерыв/обед — ставим таймер лимита; любой другой статус его снимает
+    if status in _BREAK_LIMITS:
+        await start_break_timer(application, employee_id, status, datetime.now(timezone.utc).timestamp())
+    else:
+        await cancel_break_timer(application, employee_id)
+
+def _on_schedule_changed(application: Application, employee_id: int):
+    # Исключение или параметры графика поменялись — пересчитываем дедлайн этого сотрудника
+    return arm_lateness_deadlines(application, [employee_id])
+
+async def start_deadline_timers(application: Application):
+    """
+    Запуск при старте бота: подписки на изменения, полуночные таймеры поясов,
+    таймеры опозданий на сегодня и восстановление таймеров перерывов.
+    """
+    db_manager.subscribe('status_changed', partial(_on_status_changed, application))
+    db_manager.subscribe('schedule_changed', partial(_on_schedule_changed, application))
+    deadlines.start()
+    for utc_offset in _local_midnight_offsets():
+        _arm_local_midnight(application, utc_offset)
+    await arm_lateness_deadlines(application)
+    await restore_break_timers(application)
+
+async def send_lateness_alert(context, emp, start_time, local_day: date):
+    try:
         full_name_escaped = escape_markdown(emp['full_name'], version=2)
         position_escaped = escape_markdown(emp.get('position') or 'Не указана', version=2)
-        time_str = escape_markdown(start_time.strftime('%H:%M'), version=2)
+        time_str = escape_markdown(str(start_time), version=2)
+        group = digest_group(emp)
+        await db_manager.record_security_alert(emp['id'], 'lateness', f"planned_start={start_time}", group)
+
+        if config.ALERT_DIGEST_ENABLED:
+            # Сводка по городу/должности: при массовом опоздании — одно сообщение вместо десятков тем
+            add_alert(context, 'lateness', group, f"• *{full_name_escaped}* \\({position_escaped}\\), план {time_str}")
+            await db_manager.update_lateness_alert_date(emp['id'], local_day)
+            logger.warning(f"Lateness alert queued to digest for {emp['full_name']}")
+            return
+
+        now_str = datetime.now(TARGET_TIMEZONE).strftime('%d.%m.%Y')
+        topic_name = f"Опоздание: {emp['full_name']} {now_str}"
+        thread_id = await get_or_create_topic(context, emp['id'], 'lateness', topic_name, priority=PRIORITY_ALERT)
 
         message = (
             f"⚠️ *ОПОЗДАНИЕ\\!*\n\n"
@@ -105,127 +204,214 @@ async def send_lateness_alert(context, emp, start_time):
             f"Плановое начало: {time_str}"
         )
 
-        await context.bot.send_message(
+        await get_dispatcher(context).send_message(
+            priority=PRIORITY_ALERT,
             chat_id=config.SECURITY_CHAT_ID,
             text=message,
             message_thread_id=thread_id,
             parse_mode='MarkdownV2'
         )
         
-        await db_manager.update_lateness_alert_date(emp['id'])
+        await db_manager.update_lateness_alert_date(emp['id'], local_day)
         logger.warning(f"Lateness alert sent for {emp['full_name']}")
         
     except BadRequest as e:
         logger.error(f"Failed to send lateness alert for {emp['full_name']}: {e}")
 
-async def check_overdue_breaks_job(context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Running overdue breaks check job...")
-    employees = await db_manager.get_employees_on_break()
-    
-    # Текущее время в UTC+5
-    now = datetime.now(TARGET_TIMEZONE)
+# --- Превышение перерыва/обеда: таймер на момент окончания лимита ---
+# Состояние таймера: {'status', 'started_at', 'reminders', 'next_at'} (времена — UTC timestamp).
+# Хранится в памяти и дублируется в Redis (REDIS_BREAK_TIMERS_KEY), чтобы пережить перезапуск.
+_BREAK_LIMITS = {
+    'on_break': (config.BREAK_DURATION_MIN, "перерыв"),
+    'on_lunch': (config.LUNCH_DURATION_MIN, "обед"),
+}
+_break_timers: Dict[int, Dict[str, Any]] = {}
+
+async def _save_break_timer(application: Application, employee_id: int):
+    redis_client = application.bot_data.get('redis_op_client')
+    if not redis_client:
+        return
+    try:
+        state = _break_timers.get(employee_id)
+        if state is None:
+            await redis_client.hdel(config.REDIS_BREAK_TIMERS_KEY, employee_id)
+        else:
+            await redis_client.hset(config.REDIS_BREAK_TIMERS_KEY, employee_id, json.dumps(state))
+    except Exception as e:
+        logger.error(f"Could not persist break timer for employee {employee_id}: {e}")
+
+async def _arm_break_timer(application: Application, employee_id: int, state: Dict[str, Any]):
+    _break_timers[employee_id] = state
+    if state['next_at'] is not None:
+        deadlines.schedule(
+            ('overdue', employee_id), datetime.fromtimestamp(state['next_at'], timezone.utc),
+            partial(_break_deadline_reached, application, employee_id)
+        )
+    await _save_break_timer(application, employee_id)
+
+async def start_break_timer(application: Application, employee_id: int, status: str, started_at: float):
+    limit, _ = _BREAK_LIMITS[status]
+    await _arm_break_timer(application, employee_id, {
+        'status': status, 'started_at': started_at, 'reminders': 0, 'next_at': started_at + limit * 60,
+    })
 
+async def cancel_break_timer(application: Application, employee_id: int):
+    deadlines.cancel(('overdue', employee_id))
+    if _break_timers.pop(employee_id, None) is not None:
+        await _save_break_timer(application, employee_id)
+
+async def _break_deadline_reached(application: Application, employee_id: int):
+    """Лимит (или очередной интервал напоминаний) истек: уведомляем и ставим следующее напоминание."""
+    state = _break_timers.get(employee_id)
+    emp = await db_manager.get_employee_by_id(employee_id)
+    if not state or not emp or emp['status'] != state['status']:
+        await cancel_break_timer(application, employee_id)
+        return
+
+    await send_overdue_break_alert(application, emp, state)
+
+    state['reminders'] += 1
+    backoff = config.OVERDUE_REMINDER_BACKOFF_MIN
+    if backoff:
+        step = backoff[min(state['reminders'] - 1, len(backoff) - 1)]
+        state['next_at'] = datetime.now(timezone.utc).timestamp() + step * 60
+    else:
+        state['next_at'] = None
+    await _arm_break_timer(application, employee_id, state)
+
+async def restore_break_timers(application: Application):
+    """
+    Восстанавливает таймеры после перезапуска: берет состояние из Redis для тех, кто все еще
+    на перерыве/обеде, остальным ставит таймер от status_change_timestamp. Лишние записи удаляет.
+    """
+    stored: Dict[int, Dict[str, Any]] = {}
+    redis_client = application.bot_data.get('redis_op_client')
+    if redis_client:
+        try:
+            for employee_id, raw in (await redis_client.hgetall(config.REDIS_BREAK_TIMERS_KEY)).items():
+                stored[int(employee_id)] = json.loads(raw)
+        except Exception as e:
+            logger.error(f"Could not load break timers from Redis: {e}")
+
+    employees = await db_manager.get_employees_on_break()
+    now_ts = datetime.now(timezone.utc).timestamp()
     for emp in employees:
-        if not emp['status_change_timestamp']:
+        state = stored.pop(emp['id'], None)
+        if state is not None and state.get('status') == emp['status']:
+            await _arm_break_timer(application, emp['id'], state)
             continue
+        # Уже в UTC: status_change_timestamp пишется во времени БД, а не хоста бота
+        changed_at = emp['status_changed_at']
+        await start_break_timer(application, emp['id'], emp['status'], changed_at.timestamp() if changed_at else now_ts)
+
+    for employee_id in stored:
+        await _save_break_timer(application, employee_id)
+    logger.info(f"Break timers restored: {len(employees)} active, {len(stored)} stale removed.")
+
+async def send_overdue_break_alert(context, emp: Dict[str, Any], state: Dict[str, Any]):
+    limit, status_name = _BREAK_LIMITS[state['status']]
+    overdue_min = int((datetime.now(timezone.utc).timestamp() - state['started_at']) // 60) - limit
+
+    try:
+        try:
+            await get_dispatcher(context).send_message(
+                priority=PRIORITY_ALERT,
+                chat_id=emp['personal_telegram_id'],
+                text=f"❗️Внимание! Ваш {status_name} превысил {limit} минут. Пожалуйста, вернитесь к работе."
+            )
+        except Exception:
+            pass
+
+        full_name_escaped = escape_markdown(emp['full_name'], version=2)
+        group = digest_group(emp)
+        await db_manager.record_security_alert(
+            emp['id'], 'overdue_break', f"{state['status']} +{overdue_min} min, reminder {state['reminders'] + 1}", group
+        )
+
+        if config.ALERT_DIGEST_ENABLED:
+            reminder_note = f", напоминание №{state['reminders'] + 1}" if state['reminders'] else ""
+            add_alert(context, 'overdue_break', group,
+                      f"• *{full_name_escaped}*: {status_name} \\+{overdue_min} мин{reminder_note}")
+            return
+
+        # Все превышения перерывов/обедов сотрудника за день — в одной теме
+        now_str_fmt = datetime.now(TARGET_TIMEZONE).strftime('%d.%m %H:%M') # Используем время UTC+5 для красоты
+        topic_name = f"Превышение {status_name}а: {emp['full_name']} {now_str_fmt}"
+        message_thread_id = await get_or_create_topic(context, emp['id'], 'overdue_break', topic_name, priority=PRIORITY_ALERT)
+
+        reminder_line = f"\nНапоминание №{state['reminders'] + 1}" if state['reminders'] else ""
         
-        # Важно: timestamp из БД обычно наивный (без часового пояса).
-        # Если БД в UTC, нужно приводить к UTC+5. 
-        # Предположим, что БД хранит локальное время сервера.
-        # Для корректного вычитания сделаем now наивным или timestamp aware.
-        # Самый надежный способ - привести оба к UTC или оба к локальному без info.
-        
-        # Получаем время изменения статуса (оно из БД, скорее всего naive)
-        status_time = emp['status_change_timestamp']
-        
-        # Если status_time наивное, считаем что оно было записано в том же часовом поясе, что и сервер
-        # Для корректного сравнения приведем now к naive (уберем инфо о зоне), но оставим само время UTC+5
-        # ВНИМАНИЕ: Это зависит от того, как настроена БД. Если в БД время по Москве, а тут +5, будет сдвиг.
-        # Лучше всего работать с aware objects.
-        
-        # Простой вариант: считаем разницу в секундах, игнорируя зоны, если серверное время совпадает.
-        # Но раз мы меняем зону, лучше сделать так:
-        
-        # Превращаем время из БД (которое скорее всего системное) в aware, если оно naive
-        if status_time.tzinfo is None:
-             # Предполагаем, что в БД пишется время сервера. 
-             # Если сервер в UTC, то status_time - это UTC.
-             # Если сервер в MSK, то MSK.
-             # Давайте считать разницу относительно datetime.now() без зоны, так надежнее,
-             # так как `status_change_timestamp` ставится SQL функцией NOW().
-             pass
-
-        # Чтобы не путаться с зонами БД:
-        # Просто берем текущее время сервера (без zones) и сравниваем с БД.
-        # Разница во времени (delta) будет одинаковой в любой зоне.
-        now_naive = datetime.now() 
-        time_since_change = now_naive - status_time
-        
-        limit, status_name = (config.BREAK_DURATION_MIN, "перерыв") if emp['status'] == 'on_break' else (config.LUNCH_DURATION_MIN, "обед")
-        topic_id = emp.get('current_alert_topic_id')
+        message = (
+            f"❗️ *Превышение лимита времени\\!*\n\n"
+            f"Сотрудник: *{full_name_escaped}*\n"
+            f"Статус: {status_name}\n"
+            f"Превышение на: {overdue_min} мин\\."
+            f"{reminder_line}"
+        )
+
+        await get_dispatcher(context).send_message(
+            priority=PRIORITY_ALERT,
+            chat_id=config.SECURITY_CHAT_ID,
+            text=message,
+            message_thread_id=message_thread_id,
+            parse_mode='MarkdownV2'
+        )
         
-        if time_since_change > timedelta(minutes=limit):
-            try:
-                message_thread_id = topic_id
-                if not topic_id:
-                    now_str_fmt = now.strftime('%d.%m %H:%M') # Используем время UTC+5 для красоты
-                    topic_name = f"Превышение {status_name}а: {emp['full_name']} {now_str_fmt}"
-                    try:
-                        topic = await context.bot.create_forum_topic(chat_id=config.SECURITY_CHAT_ID, name=topic_name)
-                        message_thread_id = topic.message_thread_id
-                        await db_manager.update_employee_topic_id(emp['id'], message_thread_id)
-                    except Exception as e:
-                        logger.error(f"Topic error: {e}")
-                        message_thread_id = None
-
-                try:
-                    await context.bot.send_message(
-                        chat_id=emp['personal_telegram_id'],
-                        text=f"❗️Внимание! Ваш {status_name} превысил {limit} минут. Пожалуйста, вернитесь к работе."
-                    )
-                except Exception:
-                    pass
-
-                full_name_escaped = escape_markdown(emp['full_name'], version=2)
-                overdue_min = (time_since_change.seconds // 60) - limit
-                
-                message = (
-                    f"❗️ *Превышение лимита времени\\!*\n\n"
-                    f"Сотрудник: *{full_name_escaped}*\n"
-                    f"Статус: {status_name}\n"
-                    f"Превышение на: {overdue_min} мин\\."
-                )
-
-                await context.bot.send_message(
-                    chat_id=config.SECURITY_CHAT_ID,
-                    text=message,
-                    message_thread_id=message_thread_id,
-                    parse_mode='MarkdownV2'
-                )
-                
-            except Exception as e:
-                logger.error(f"Failed to send overdue break alert for {emp['full_name']}: {e}")
+    except Exception as e:
+        logger.error(f"Failed to send overdue break alert for {emp['full_name']}: {e}")
 
 
 async def auto_clock_out_job(context: ContextTypes.DEFAULT_TYPE):
     logger.info("Running auto clock-out job...")
-    active_employees = await db_manager.get_active_employees_for_reset()
-    for emp in active_employees:
-        await db_manager.update_employee_status(emp['id'], 'offline')
-        await db_manager.log_time_event(emp['id'], 'clock_out', 'Автоматически в 00:00')
-        logger.info(f"Auto-clocked out employee ID {emp['id']}")
+    summary = await db_manager.auto_clock_out_all('Автоматически в 00:00')
+    for emp in summary['employees']:
+        logger.info(f"Auto-clocked out employee ID {emp['id']} ({emp['full_name']}, was {emp['status']})")
+    logger.info(f"Auto clock-out finished: {summary['count']} employees reset.")
+
+async def close_stale_topics_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ночью закрывает темы уведомлений за прошедшие дни."""
+    result = await close_stale_topics(context)
+    logger.info(f"Stale alert topics closed: {result}")
+
+async def compact_schedule_overrides_job(context: ContextTypes.DEFAULT_TYPE):
+    """Ночью склеивает соседние одинаковые исключения в графике (например, отпуск, внесенный по дням)."""
+    result = await db_manager.compact_schedule_overrides()
+    logger.info(f"Schedule overrides compacted: {result}")
 
 def start_scheduler(application: Application):
     """Запускает все фоновые задачи в UTC+5."""
     
     # ВАЖНО: Указываем таймзону планировщика
-    scheduler = AsyncIOScheduler(timezone=TARGET_TIMEZONE)
+    # Один экземпляр задачи за раз; пропущенные запуски схлопываются в один, а не догоняют друг друга
+    scheduler = AsyncIOScheduler(
+        timezone=TARGET_TIMEZONE,
+        job_defaults={'max_instances': 1, 'coalesce': True, 'misfire_grace_time': 300},
+    )
     
-    scheduler.add_job(check_lateness_job, 'interval', minutes=5, args=[application])
-    scheduler.add_job(check_overdue_breaks_job, 'interval', minutes=1, args=[application])
     
     # Сброс в 00:00 именно по Екатеринбургу (UTC+5)
     scheduler.add_job(auto_clock_out_job, 'cron', hour=0, minute=0, args=[application])
+    scheduler.add_job(compact_schedule_overrides_job, 'cron', hour=3, minute=30, args=[application])
+    scheduler.add_job(close_stale_topics_job, 'cron', hour=4, minute=0, args=[application])
     
     scheduler.start()
-    logger.info(f"Scheduler started with timezone: {TARGET_TIMEZONE}")
\ No newline at end of file
+    logger.info(f"Scheduler started with timezone: {TARGET_TIMEZONE}")
+
+    # Опоздания и превышения перерывов отслеживаются таймерами на каждого сотрудника (вместо опроса)
+    global _startup_task
+    _startup_task = asyncio.create_task(start_deadline_timers(application))
+    _startup_task.add_done_callback(_log_startup_result)
+
+def _log_startup_result(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Deadline timers failed to start: {task.exception()!r}")
+
+async def stop_scheduler():
+    # Запуск таймеров мог еще не закончиться (долгие запросы к БД при старте) — прерываем его
+    global _startup_task
+    if _startup_task is not None:
+        if not _startup_task.done():
+            _startup_task.cancel()
+        await asyncio.gather(_startup_task, return_exceptions=True)
+        _startup_task = None
+    await deadlines.stop()
\ No newline at end of file
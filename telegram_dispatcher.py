@@ -0,0 +1,342 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from datetime import timedelta
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+from telegram.error import RetryAfter
+
+from config import (
+    TG_GLOBAL_RATE_PER_SEC, TG_PRIVATE_CHAT_RATE_PER_SEC, TG_GROUP_CHAT_RATE_PER_MIN,
+    TG_TOPIC_CREATE_RATE_PER_MIN, TG_DISPATCH_WORKERS, TG_DISPATCH_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Приоритетные полосы: меньше — раньше. Ответы по согласованиям не должны стоять за пачкой уведомлений.
+PRIORITY_APPROVAL = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_ALERT = 2
+
+_LANE_NAMES = {PRIORITY_APPROVAL: 'approval', PRIORITY_DEFAULT: 'default', PRIORITY_ALERT: 'alert'}
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, запас до capacity.
+    wait_time() только смотрит, сколько ждать до свободного токена, take() списывает его —
+    токен берется в момент реальной отправки, а не заранее при постановке в очередь.
+    """
+
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        now = monotonic()
+        self._refill(now)
+        wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self._refill(monotonic())
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Telegram ответил 429 — ничего не отправляем через это ведро seconds секунд."""
+        self.blocked_until = max(self.blocked_until, monotonic() + seconds)
+
+
+class _Job:
+    __slots__ = ("method", "args", "kwargs", "chat_id", "priority", "seq", "future", "enqueued_at", "attempts")
+
+    def __init__(self, method: str, args: tuple, kwargs: Dict[str, Any], priority: int, seq: int):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.chat_id = kwargs.get('chat_id', args[0] if args else None)
+        self.priority = priority
+        self.seq = seq
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = monotonic()
+        self.attempts = 0
+
+
+class _ChatLane:
+    """
+    Очередь одного чата: запросы по приоритету, ведро лимита чата и состояние —
+    idle (нечего слать), ready (стоит в общей очереди готовых), waiting (ждет токен), sending.
+    """
+
+    __slots__ = ("chat_id", "bucket", "jobs", "state", "ready_token")
+
+    def __init__(self, chat_id: Any, bucket: TokenBucket):
+        self.chat_id = chat_id
+        self.bucket = bucket
+        self.jobs: List[Tuple[int, int, _Job]] = []
+        self.state = 'idle'
+        self.ready_token = 0
+
+
+class TelegramDispatcher:
+    """
+    Единая точка исходящих запросов к Telegram с учетом лимитов:
+    общий (~30 сообщений/с), на чат (личный ~1/с, группа ~20/мин) и на создание тем форума.
+    У каждого чата своя очередь с приоритетами, а воркеры берут чаты, у которых есть что слать.
+    Токены списываются только в момент отправки, поэтому запрос с высоким приоритетом
+    (ответ по согласованию) обгоняет уже стоящие в том же чате уведомления. Чат, которому надо
+    подождать лимит, откладывается без занятия воркера — остальные чаты не простаивают.
+    При 429 (RetryAfter) чат и общее ведро ставятся на паузу на указанное время, и запрос повторяется, а не теряется.
+    Вызов ждет результата, поэтому его можно использовать как обычный bot.send_message(...).
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        # Чаты, готовые к отправке: (приоритет головного запроса, токен, очередь чата)
+        self._ready: "asyncio.PriorityQueue" = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._workers = []
+        self._waiting = 0
+        self._pending = 0
+        # Запросы, вынутые из очереди чата и еще не завершенные: если воркера отменят посреди
+        # отправки, stop() завершит их ошибкой
+        self._in_flight = set()
+
+        self._global = TokenBucket(TG_GLOBAL_RATE_PER_SEC, TG_GLOBAL_RATE_PER_SEC)
+        self._topics = TokenBucket(TG_TOPIC_CREATE_RATE_PER_MIN / 60, 1)
+        self._chats: Dict[Any, _ChatLane] = {}
+
+        self._depth = {priority: 0 for priority in _LANE_NAMES}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.max_wait_sec = 0.0
+        self._total_wait_sec = 0.0
+
+    # --- Жизненный цикл ---
+    def start(self):
+        for i in range(TG_DISPATCH_WORKERS):
+            self._workers.append(asyncio.create_task(self._worker(), name=f"tg-dispatch-{i}"))
+        logger.info(f"Telegram dispatcher started with {TG_DISPATCH_WORKERS} workers.")
+
+    async def stop(self, timeout: float = 10.0):
+        """
+        Дожидается отправки уже поставленных в очередь запросов (не дольше timeout секунд)
+        и останавливает воркеров. Запросы, которые так и не ушли, завершаются ошибкой,
+        чтобы ожидающие их корутины не зависли навсегда.
+        """
+        if self._workers:
+            deadline = monotonic() + timeout
+            while self._pending and monotonic() < deadline:
+                await asyncio.sleep(0.1)
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        stopped = RuntimeError("Telegram dispatcher stopped")
+        unsent = list(self._in_flight)
+        for lane in self._chats.values():
+            unsent.extend(job for _, _, job in lane.jobs)
+            lane.jobs.clear()
+            lane.state = 'idle'
+        self._in_flight.clear()
+        if unsent:
+            logger.warning(f"Telegram dispatcher stopped with {len(unsent)} unsent requests.")
+        for job in unsent:
+            self._finish(job, error=stopped)
+
+    # --- Отправка ---
+    async def call(self, method: str, *args, priority: int = PRIORITY_DEFAULT, **kwargs) -> Any:
+        """Ставит вызов bot.<method>(*args, **kwargs) в очередь и возвращает его результат."""
+        job = _Job(method, args, kwargs, priority, next(self._seq))
+        self._submit(job)
+        return await job.future
+
+    async def send_message(self, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        return await self.call('send_message', *args, priority=priority, **kwargs)
+
+    async def send_photo(self, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        return await self.call('send_photo', *args, priority=priority, **kwargs)
+
+    async def send_document(self, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        return await self.call('send_document', *args, priority=priority, **kwargs)
+
+    async def edit_message_text(self, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        return await self.call('edit_message_text', *args, priority=priority, **kwargs)
+
+    async def create_forum_topic(self, *args, priority: int = PRIORITY_DEFAULT, **kwargs):
+        return await self.call('create_forum_topic', *args, priority=priority, **kwargs)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': {_LANE_NAMES[priority]: depth for priority, depth in self._depth.items()},
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'rate_limited': self.rate_limited,
+            'avg_wait_sec': round(self._total_wait_sec / self.sent, 3) if self.sent else 0.0,
+            'max_wait_sec': round(self.max_wait_sec, 3),
+            'waiting_chats': self._waiting,
+            'tracked_chats': len(self._chats),
+        }
+
+    # --- Внутреннее ---
+    def _submit(self, job: _Job):
+        self._depth[job.priority] = self._depth.get(job.priority, 0) + 1
+        self._pending += 1
+        lane = self._lane(job.chat_id)
+        head_priority = lane.jobs[0][0] if lane.jobs else None
+        heapq.heappush(lane.jobs, (job.priority, job.seq, job))
+        # Чат ждет токен или сейчас отправляет — новый запрос он возьмет следующим по приоритету.
+        # Если чат уже в очереди готовых, переставляем его, только когда запрос важнее головного.
+        if lane.state == 'idle' or (lane.state == 'ready' and job.priority < head_priority):
+            self._make_ready(lane)
+
+    def _make_ready(self, lane: _ChatLane):
+        # Повторная постановка (пришел запрос важнее) делает прежнюю запись в очереди устаревшей
+        lane.state = 'ready'
+        lane.ready_token = next(self._seq)
+        self._ready.put_nowait((lane.jobs[0][0], lane.ready_token, lane))
+
+    def _wake(self, lane: _ChatLane):
+        self._waiting -= 1
+        if lane.jobs:  # после stop() очередь чата уже очищена
+            self._make_ready(lane)
+
+    def _lane(self, chat_id: Any) -> _ChatLane:
+        lane = self._chats.get(chat_id)
+        if lane is None:
+            # Отрицательный ID — группа/супергруппа, у них лимит заметно строже
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(TG_GROUP_CHAT_RATE_PER_MIN / 60, 3)
+            else:
+                bucket = TokenBucket(TG_PRIVATE_CHAT_RATE_PER_SEC, 1)
+            lane = self._chats[chat_id] = _ChatLane(chat_id, bucket)
+        return lane
+
+    async def _worker(self):
+        while True:
+            _, token, lane = await self._ready.get()
+            if lane.state != 'ready' or token != lane.ready_token:
+                continue  # устаревшая запись
+            await self._service(lane)
+
+    async def _service(self, lane: _ChatLane):
+        _, _, job = lane.jobs[0]
+        buckets = [self._global, lane.bucket]
+        if job.method == 'create_forum_topic':
+            buckets.append(self._topics)
+        wait = max(bucket.wait_time() for bucket in buckets)
+        if wait > 0:
+            lane.state = 'waiting'
+            self._waiting += 1
+            asyncio.get_running_loop().call_later(wait, self._wake, lane)
+            return
+        for bucket in buckets:
+            bucket.take()
+        heapq.heappop(lane.jobs)
+        lane.state = 'sending'
+        self._in_flight.add(job)
+
+        try:
+            await self._send(lane, job)
+        finally:
+            lane.state = 'idle'
+            if lane.jobs:
+                self._make_ready(lane)
+
+    async def _send(self, lane: _ChatLane, job: _Job):
+        job.attempts += 1
+        try:
+            result = await getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except RetryAfter as e:
+            self.rate_limited += 1
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            # 429 может прийти и за общий лимит бота, поэтому на паузу ставим и чат, и общее ведро
+            lane.bucket.block(delay)
+            self._global.block(delay)
+            if job.attempts <= TG_DISPATCH_MAX_RETRIES:
+                self.retries += 1
+                logger.warning(f"Telegram {job.method} to {job.chat_id} rate limited, retry in {delay:.1f}s (attempt {job.attempts}).")
+                self._rewind_files(job)
+                self._in_flight.discard(job)
+                # Возвращаем на прежнее место в очереди чата
+                heapq.heappush(lane.jobs, (job.priority, job.seq, job))
+                return
+            self._finish(job, error=e)
+            return
+        except Exception as e:
+            self._finish(job, error=e)
+            return
+        self._finish(job, result=result)
+
+    def _finish(self, job: _Job, result: Any = None, error: Optional[BaseException] = None):
+        self._in_flight.discard(job)
+        self._depth[job.priority] -= 1
+        self._pending -= 1
+        waited = monotonic() - job.enqueued_at
+        if error is not None:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+            return
+        self.sent += 1
+        self._total_wait_sec += waited
+        self.max_wait_sec = max(self.max_wait_sec, waited)
+        if not job.future.done():
+            job.future.set_result(result)
+
+    @staticmethod
+    def _rewind_files(job: _Job):
+        # Файл (фото, CSV) уже прочитан неудачной попыткой — перематываем для повтора
+        for value in list(job.args) + list(job.kwargs.values()):
+            if hasattr(value, 'seek'):
+                try:
+                    value.seek(0)
+                except Exception:
+                    pass
+
+
+def get_dispatcher(context) -> TelegramDispatcher:
+    """Диспетчер из bot_data (context — CallbackContext хендлера или Application в задачах планировщика)."""
+    return context.bot_data['dispatcher']
+
+
+def _reply_kwargs(message) -> Dict[str, Any]:
+    # Как message.reply_*: ответ в тот же чат и, в форуме, в ту же тему
+    kwargs = {'chat_id': message.chat_id}
+    if getattr(message, 'is_topic_message', False) and message.message_thread_id is not None:
+        kwargs['message_thread_id'] = message.message_thread_id
+    return kwargs
+
+
+async def reply_text(context, message, text: str, priority: int = PRIORITY_DEFAULT, **kwargs):
+    """message.reply_text(...) через диспетчер — ответ пользователю учитывает лимиты Telegram."""
+    return await get_dispatcher(context).send_message(text=text, priority=priority, **_reply_kwargs(message), **kwargs)
+
+
+async def reply_photo(context, message, photo, priority: int = PRIORITY_DEFAULT, **kwargs):
+    """message.reply_photo(...) через диспетчер."""
+    return await get_dispatcher(context).send_photo(photo=photo, priority=priority, **_reply_kwargs(message), **kwargs)
+
+
+async def edit_query_text(context, query, text: str, priority: int = PRIORITY_DEFAULT, **kwargs):
+    """query.edit_message_text(...) через диспетчер: правит сообщение, к которому привязана кнопка."""
+    if query.inline_message_id:
+        target = {'inline_message_id': query.inline_message_id}
+    else:
+        target = {'chat_id': query.message.chat_id, 'message_id': query.message.message_id}
+    return await get_dispatcher(context).edit_message_text(text=text, priority=priority, **target, **kwargs)
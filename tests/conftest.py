@@ -0,0 +1,5 @@
+import os
+
+# config.py читает обязательные переменные при импорте — для тестов хватает заглушек
+os.environ.setdefault("SECURITY_CHAT_ID", "-1001")
+os.environ.setdefault("BOT_TOKEN", "test")
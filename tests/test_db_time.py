@@ -0,0 +1,24 @@
+import asyncio
+from datetime import datetime, timezone
+
+import db_manager
+
+
+def test_db_time_to_utc_applies_db_offset():
+    # БД в UTC+2: 12:00 по ее часам — это 10:00 UTC, независимо от пояса хоста
+    result = db_manager.db_time_to_utc(datetime(2025, 3, 1, 12, 0), 2 * 3600)
+    assert result == datetime(2025, 3, 1, 10, 0, tzinfo=timezone.utc)
+    assert db_manager.db_time_to_utc(None, 3600) is None
+
+
+def test_employees_on_break_carry_utc_status_time(monkeypatch):
+    async def fake_fetch_all(query, args=(), read_only=False):
+        return [{
+            'id': 1, 'full_name': 'A', 'personal_telegram_id': 10, 'status': 'on_break',
+            'status_change_timestamp': datetime(2025, 3, 1, 9, 30), 'db_utc_offset_sec': 5 * 3600,
+        }]
+
+    monkeypatch.setattr(db_manager, "fetch_all", fake_fetch_all)
+    rows = asyncio.run(db_manager.get_employees_on_break())
+    assert rows[0]['status_changed_at'] == datetime(2025, 3, 1, 4, 30, tzinfo=timezone.utc)
+    assert 'db_utc_offset_sec' not in rows[0]
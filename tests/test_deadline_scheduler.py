@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from deadline_scheduler import DeadlineScheduler
+
+
+def _soon(seconds: float) -> datetime:
+    return datetime.now(timezone.utc) + timedelta(seconds=seconds)
+
+
+def test_cancel_then_rearm_fires_only_new_timer():
+    fired = []
+
+    def callback(name):
+        async def run():
+            fired.append(name)
+        return run
+
+    async def scenario():
+        deadlines = DeadlineScheduler()
+        deadlines.start()
+        token = deadlines.schedule(("lateness", 1), _soon(0.05), callback("old"))
+        assert deadlines.cancel(("lateness", 1), token)
+        # Устаревший токен второй раз ничего не отменяет
+        assert not deadlines.cancel(("lateness", 1), token)
+
+        deadlines.schedule(("lateness", 1), _soon(0.1), callback("new"))
+        await asyncio.sleep(0.3)
+        await deadlines.stop()
+        return deadlines.stats()
+
+    stats = asyncio.run(scenario())
+    assert fired == ["new"]
+    assert stats["fired"] == 1 and stats["cancelled"] == 1 and stats["active"] == 0
+
+
+def test_reschedule_replaces_previous_timer():
+    fired = []
+
+    async def scenario():
+        deadlines = DeadlineScheduler()
+        deadlines.start()
+
+        async def first():
+            fired.append("first")
+
+        async def second():
+            fired.append("second")
+
+        first_token = deadlines.schedule("key", _soon(0.05), first)
+        deadlines.schedule("key", _soon(0.1), second)
+        # Токен замененного таймера больше не действует
+        assert not deadlines.cancel("key", first_token)
+        await asyncio.sleep(0.3)
+        await deadlines.stop()
+
+    asyncio.run(scenario())
+    assert fired == ["second"]
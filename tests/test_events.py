@@ -0,0 +1,31 @@
+import asyncio
+import logging
+
+import db_manager
+
+
+def test_async_listener_is_tracked_and_failure_logged(monkeypatch, caplog):
+    monkeypatch.setattr(db_manager, "_listeners", {})
+    done = []
+
+    async def ok_listener(employee_id):
+        await asyncio.sleep(0)
+        done.append(employee_id)
+
+    async def failing_listener(employee_id):
+        raise RuntimeError("boom")
+
+    db_manager.subscribe('status_changed', ok_listener)
+    db_manager.subscribe('status_changed', failing_listener)
+
+    async def scenario():
+        db_manager._emit('status_changed', employee_id=7)
+        assert len(db_manager._listener_tasks) == 2
+        await asyncio.gather(*db_manager._listener_tasks, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    with caplog.at_level(logging.ERROR, logger=db_manager.logger.name):
+        asyncio.run(scenario())
+    assert done == [7]
+    assert not db_manager._listener_tasks
+    assert "failing_listener" in caplog.text and "boom" in caplog.text
@@ -0,0 +1,33 @@
+import schedule_engine
+from schedule_engine import day_interval, format_segments, parse_segments, subtract_absence
+
+
+def test_absence_after_midnight_cuts_overnight_shift():
+    shift = [day_interval("20:00", "08:00")]
+    remaining = subtract_absence(shift, day_interval("02:00", "04:00"))
+    assert remaining == [(20 * 60, 26 * 60), (28 * 60, 32 * 60)]
+    assert format_segments(remaining) == "20:00-02:00,04:00-08:00"
+
+
+def test_absence_before_overnight_shift_start_is_ignored():
+    shift = [day_interval("20:00", "08:00")]
+    assert subtract_absence(shift, day_interval("10:00", "12:00")) == shift
+
+
+def test_absence_overlapping_overnight_shift_start():
+    shift = [day_interval("20:00", "08:00")]
+    assert subtract_absence(shift, day_interval("19:00", "21:00")) == [(21 * 60, 32 * 60)]
+
+
+def test_absence_in_day_shift():
+    shift = [day_interval("09:00", "18:00")]
+    assert subtract_absence(shift, day_interval("11:00", "12:00")) == [(9 * 60, 11 * 60), (12 * 60, 18 * 60)]
+
+
+def test_overnight_segments_round_trip():
+    segments = parse_segments("20:00-02:00,04:00-08:00")
+    assert segments == [(20 * 60, 26 * 60), (28 * 60, 32 * 60)]
+    assert subtract_absence(segments, day_interval("05:00", "06:00")) == [
+        (20 * 60, 26 * 60), (28 * 60, 29 * 60), (30 * 60, 32 * 60),
+    ]
+    assert schedule_engine.format_segments(segments) == "20:00-02:00,04:00-08:00"
@@ -0,0 +1,94 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
+
+import pytest
+
+import db_manager
+
+
+class FakeOverrides:
+    """Таблица schedule_overrides в памяти: понимает ровно те запросы, что шлет db_manager."""
+
+    def __init__(self, rows=()):
+        self.rows = [dict(row) for row in rows]
+        self._result = []
+
+    async def fetchall(self):
+        return [dict(row) for row in self._result]
+
+    async def execute(self, cursor, query, args=()):
+        sql = " ".join(query.split())
+        if sql.startswith("SELECT"):
+            employee_id = args[0]
+            rows = [r for r in self.rows if r['employee_id'] == employee_id]
+            if len(args) == 3:
+                rows = [r for r in rows if r['work_date'] <= args[1] and r['end_date'] >= args[2]]
+            self._result = sorted(rows, key=lambda r: r['work_date'])
+        elif sql.startswith("DELETE"):
+            employee_id, *dates = args
+            self.rows = [r for r in self.rows if not (r['employee_id'] == employee_id and r['work_date'] in dates)]
+        else:
+            raise AssertionError(sql)
+        return 0
+
+    async def executemany(self, cursor, query, args_list):
+        sql = " ".join(query.split())
+        for args in args_list:
+            if sql.startswith("INSERT"):
+                keys = ('employee_id', 'work_date', 'end_date', 'is_day_off', 'start_time', 'end_time', 'comment', 'segments')
+                self.rows.append(dict(zip(keys, args)))
+            elif sql.startswith("UPDATE"):
+                new_end, employee_id, work_date = args
+                for r in self.rows:
+                    if r['employee_id'] == employee_id and r['work_date'] == work_date:
+                        r['end_date'] = new_end
+            else:
+                raise AssertionError(sql)
+        return len(args_list)
+
+    def ranges(self):
+        return sorted((r['work_date'].day, r['end_date'].day, r['is_day_off']) for r in self.rows)
+
+
+def _row(start_day, end_day, is_day_off=True, employee_id=1):
+    return {
+        'employee_id': employee_id, 'work_date': date(2024, 5, start_day), 'end_date': date(2024, 5, end_day),
+        'is_day_off': is_day_off, 'start_time': None if is_day_off else '10:00',
+        'end_time': None if is_day_off else '19:00', 'comment': None, 'segments': None,
+    }
+
+
+@pytest.fixture
+def table(monkeypatch):
+    fake = FakeOverrides()
+
+    @asynccontextmanager
+    async def transaction():
+        yield fake
+
+    monkeypatch.setattr(db_manager, "_transaction", transaction)
+    monkeypatch.setattr(db_manager, "_execute_in", fake.execute)
+    monkeypatch.setattr(db_manager, "_executemany_in", fake.executemany)
+    monkeypatch.setattr(db_manager, "_listeners", {})
+    return fake
+
+
+def test_period_override_splits_existing_range(table):
+    table.rows = [_row(1, 10)]
+    asyncio.run(db_manager.set_schedule_override_for_period(1, "2024-05-04", "2024-05-05", False, "10:00", "19:00"))
+    assert table.ranges() == [(1, 3, True), (4, 5, False), (6, 10, True)]
+
+
+def test_period_override_merges_with_adjacent_equal_ranges(table):
+    table.rows = [_row(1, 3), _row(6, 8), _row(9, 9, employee_id=2)]
+    asyncio.run(db_manager.set_schedule_override_for_period(1, "2024-05-04", "2024-05-05", True))
+    assert table.ranges() == [(1, 8, True), (9, 9, True)]
+    assert [r['employee_id'] for r in table.rows if r['work_date'].day == 9] == [2]
+
+
+def test_compact_glues_per_day_rows_into_ranges(table):
+    table.rows = [_row(day, day) for day in (1, 2, 3)] + [_row(4, 4, is_day_off=False), _row(6, 6)]
+    result = asyncio.run(db_manager.compact_schedule_overrides(1))
+    assert table.ranges() == [(1, 3, True), (4, 4, False), (6, 6, True)]
+    assert result == {'employees': 1, 'ranges_extended': 1, 'rows_removed': 2}
@@ -0,0 +1,90 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+from telegram.error import RetryAfter
+
+import telegram_dispatcher
+from telegram_dispatcher import TelegramDispatcher, PRIORITY_ALERT, PRIORITY_APPROVAL
+
+
+class FakeBot:
+    """Записывает отправленные тексты; первый запрос держит, пока тест не отпустит release."""
+
+    def __init__(self, hold_first=False, rate_limit_times=0):
+        self.sent = []
+        self.attempts = 0
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+        self.hold_first = hold_first
+        self.rate_limit_times = rate_limit_times
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.attempts += 1
+        self.started.set()
+        if self.hold_first and self.attempts == 1:
+            await self.release.wait()
+        if self.rate_limit_times:
+            self.rate_limit_times -= 1
+            raise RetryAfter(timedelta(milliseconds=50))
+        self.sent.append(text)
+        return text
+
+
+@pytest.fixture(autouse=True)
+def fast_limits(monkeypatch):
+    monkeypatch.setattr(telegram_dispatcher, "TG_PRIVATE_CHAT_RATE_PER_SEC", 1000)
+    monkeypatch.setattr(telegram_dispatcher, "TG_GLOBAL_RATE_PER_SEC", 1000)
+
+
+def test_approval_overtakes_queued_alerts_in_same_chat():
+    async def scenario():
+        bot = FakeBot(hold_first=True)
+        dispatcher = TelegramDispatcher(bot)
+        dispatcher.start()
+        first = asyncio.ensure_future(dispatcher.send_message(chat_id=1, text="alert-0", priority=PRIORITY_ALERT))
+        await bot.started.wait()
+        rest = [
+            asyncio.ensure_future(dispatcher.send_message(chat_id=1, text=f"alert-{i}", priority=PRIORITY_ALERT))
+            for i in (1, 2)
+        ]
+        await asyncio.sleep(0)
+        approval = asyncio.ensure_future(dispatcher.send_message(chat_id=1, text="approval", priority=PRIORITY_APPROVAL))
+        await asyncio.sleep(0)
+        bot.release.set()
+        await asyncio.gather(first, approval, *rest)
+        await dispatcher.stop()
+        return bot.sent
+
+    assert asyncio.run(scenario()) == ["alert-0", "approval", "alert-1", "alert-2"]
+
+
+def test_retry_after_requeues_and_pauses_global_bucket():
+    async def scenario():
+        bot = FakeBot(rate_limit_times=1)
+        dispatcher = TelegramDispatcher(bot)
+        dispatcher.start()
+        result = await dispatcher.send_message(chat_id=1, text="hello")
+        await dispatcher.stop()
+        return bot, dispatcher, result
+
+    bot, dispatcher, result = asyncio.run(scenario())
+    assert result == "hello"
+    assert bot.attempts == 2
+    assert dispatcher.stats()["retries"] == 1 and dispatcher.stats()["rate_limited"] == 1
+    assert dispatcher._global.blocked_until > 0
+
+
+def test_stop_fails_requests_that_did_not_go_out():
+    async def scenario():
+        bot = FakeBot(hold_first=True)
+        dispatcher = TelegramDispatcher(bot)
+        dispatcher.start()
+        futures = [asyncio.ensure_future(dispatcher.send_message(chat_id=1, text=str(i))) for i in range(2)]
+        await bot.started.wait()
+        await dispatcher.stop(timeout=0.1)
+        return await asyncio.gather(*futures, return_exceptions=True), dispatcher
+
+    results, dispatcher = asyncio.run(scenario())
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert dispatcher._pending == 0 and dispatcher.stats()["failed"] == 2
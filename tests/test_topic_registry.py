@@ -0,0 +1,54 @@
+import asyncio
+from types import SimpleNamespace
+
+import topic_registry
+
+
+class FakeRedis:
+    def __init__(self, values=None, fail_get=False):
+        self.values = dict(values or {})
+        self.fail_get = fail_get
+
+    async def get(self, key):
+        if self.fail_get:
+            raise ConnectionError("redis down")
+        return self.values.get(key)
+
+
+class FakeDispatcher:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created = 0
+
+    async def create_forum_topic(self, chat_id, name, priority):
+        self.created += 1
+        if self.fail:
+            raise RuntimeError("Telegram is down")
+        return SimpleNamespace(message_thread_id=100 + self.created)
+
+
+def _context(dispatcher, redis_client=None):
+    return SimpleNamespace(bot_data={'dispatcher': dispatcher, 'redis_op_client': redis_client})
+
+
+def test_lock_is_released_when_topic_creation_fails():
+    dispatcher = FakeDispatcher(fail=True)
+    context = _context(dispatcher, FakeRedis(fail_get=True))
+
+    async def scenario():
+        results = await asyncio.gather(*(topic_registry.get_or_create_topic(context, 7, 'lateness', "t") for _ in range(3)))
+        assert topic_registry._locks == {}
+        return results
+
+    assert asyncio.run(scenario()) == [None, None, None]
+    assert dispatcher.created == 3
+
+
+def test_registry_hit_reuses_topic_and_releases_lock():
+    dispatcher = FakeDispatcher()
+    key = topic_registry._registry_key(7, 'lateness', topic_registry.datetime.now(topic_registry.TARGET_TIMEZONE).strftime('%Y-%m-%d'))
+    context = _context(dispatcher, FakeRedis({key: "42"}))
+
+    assert asyncio.run(topic_registry.get_or_create_topic(context, 7, 'lateness', "t")) == 42
+    assert dispatcher.created == 0
+    assert topic_registry._locks == {}
@@ -0,0 +1,51 @@
+import asyncio
+import json
+
+from write_behind import WriteBehindBuffer, has_spilled_records
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_spilled_records_are_replayed_and_files_removed(tmp_path):
+    spill = tmp_path / "wb.jsonl"
+    spill.write_text(json.dumps({'table': 'employee_audit_log', 'values': [1]}) + "\n", encoding="utf-8")
+    assert has_spilled_records(str(spill))
+
+    written = []
+
+    async def flush(records):
+        written.extend(records)
+
+    async def scenario():
+        buffer = WriteBehindBuffer(flush, str(spill))
+        await buffer.start()
+        await buffer.stop()
+
+    _run(scenario())
+    assert written == [{'table': 'employee_audit_log', 'values': [1]}]
+    assert not has_spilled_records(str(spill))
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_replay_keeps_records_on_disk(tmp_path):
+    spill = tmp_path / "wb.jsonl"
+    spill.write_text(json.dumps({'table': 'employee_audit_log', 'values': [2]}) + "\n", encoding="utf-8")
+
+    async def flush(records):
+        raise RuntimeError("db down")
+
+    async def scenario():
+        buffer = WriteBehindBuffer(flush, str(spill))
+        await buffer.start()
+        await buffer.stop()
+
+    _run(scenario())
+    assert has_spilled_records(str(spill))
+
+
+def test_empty_spill_file_is_not_pending(tmp_path):
+    spill = tmp_path / "wb.jsonl"
+    spill.write_text("", encoding="utf-8")
+    assert not has_spilled_records(str(spill))
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+
+import pytz
+
+import config
+from telegram_dispatcher import get_dispatcher, PRIORITY_DEFAULT
+
+logger = logging.getLogger(__name__)
+
+# День уведомлений считаем по часовому поясу бота (как и названия тем)
+TARGET_TIMEZONE = pytz.timezone('Asia/Yekaterinburg')
+
+# Защита от гонки: два одновременных уведомления по одному ключу не должны создать две темы.
+# Ключ -> [замок, сколько корутин его держат или ждут]; запись удаляется, когда ждущих не осталось.
+_locks: Dict[str, List] = {}
+
+
+@asynccontextmanager
+async def _key_lock(key: str):
+    entry = _locks.get(key)
+    if entry is None:
+        entry = _locks[key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _locks[key]
+
+
+def _registry_key(owner: Union[int, str], kind: str, day: str) -> str:
+    return f"{config.REDIS_TOPIC_REGISTRY_PREFIX}{owner}:{day}:{kind}"
+
+
+async def get_or_create_topic(context, owner: Union[int, str], kind: str, title: str,
+                              priority: int = PRIORITY_DEFAULT) -> Optional[int]:
+    """
+    Тема форума в чате СБ для уведомлений одного вида (kind) за текущий день.
+    owner — ID сотрудника или другой владелец темы (например, город для сводки опозданий).
+    Если тема уже создавалась сегодня — возвращает ее message_thread_id из Redis, иначе создает.
+    Без Redis работает как раньше: каждый раз новая тема. None — тему создать не удалось.
+    """
+    redis_client = context.bot_data.get('redis_op_client')
+    now = datetime.now(TARGET_TIMEZONE)
+    key = _registry_key(owner, kind, now.strftime('%Y-%m-%d'))
+
+    async with _key_lock(key):
+        if redis_client:
+            try:
+                thread_id = await redis_client.get(key)
+                if thread_id:
+                    return int(thread_id)
+            except Exception as e:
+                logger.error(f"Topic registry lookup failed for {key}: {e}")
+
+        try:
+            topic = await get_dispatcher(context).create_forum_topic(
+                chat_id=config.SECURITY_CHAT_ID, name=title, priority=priority
+            )
+        except Exception as e:
+            logger.error(f"Could not create topic '{title}': {e}")
+            return None
+        thread_id = topic.message_thread_id
+
+        if redis_client:
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                pipe.set(key, thread_id, ex=config.TOPIC_REGISTRY_TTL_SEC)
+                # Индекс всех созданных тем (score — время создания) для ночного закрытия
+                pipe.zadd(config.REDIS_TOPIC_INDEX_KEY, {f"{thread_id}|{key}": now.timestamp()})
+                await pipe.execute()
+            except Exception as e:
+                logger.error(f"Topic registry store failed for {key}: {e}")
+        return thread_id
+
+
+async def close_stale_topics(context) -> Dict[str, int]:
+    """
+    Закрывает темы, созданные до начала текущего дня, и удаляет их из реестра.
+    Новые уведомления по тем же сотрудникам уйдут уже в новые темы текущего дня.
+    """
+    redis_client = context.bot_data.get('redis_op_client')
+    if not redis_client:
+        return {'closed': 0, 'failed': 0}
+
+    day_start = datetime.now(TARGET_TIMEZONE).replace(hour=0, minute=0, second=0, microsecond=0)
+    members = await redis_client.zrangebyscore(config.REDIS_TOPIC_INDEX_KEY, 0, day_start.timestamp())
+
+    async def close(member: str) -> bool:
+        thread_id, key = member.split('|', 1)
+        try:
+            await get_dispatcher(context).call(
+                'close_forum_topic', chat_id=config.SECURITY_CHAT_ID, message_thread_id=int(thread_id)
+            )
+            return True
+        except Exception as e:
+            # Тему могли уже закрыть или удалить вручную — из реестра она уходит в любом случае
+            logger.warning(f"Could not close topic {thread_id}: {e}")
+            return False
+        finally:
+            try:
+                await redis_client.delete(key)
+                await redis_client.zrem(config.REDIS_TOPIC_INDEX_KEY, member)
+            except Exception as e:
+                logger.error(f"Topic registry cleanup failed for {key}: {e}")
+
+    results = await asyncio.gather(*(close(member) for member in members))
+    closed = sum(results)
+    return {'closed': closed, 'failed': len(results) - closed}
@@ -8,34 +8,56 @@ import db_manager as db_manager
 import matplotlib
 import matplotlib.pyplot as plt
 import io
-import pytz
+from datetime import datetime, timedelta, timezone, tzinfo
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Tuple
+from zoneinfo import ZoneInfo
 from config import CITY_TIMEZONES, DEFAULT_TIMEZONE
+from telegram_dispatcher import reply_text
 import random
 import httpx 
 import logging
+import csv
+import tempfile
 
 matplotlib.use('Agg')
 logger = logging.getLogger(__name__)
 BTN_MY_CARD = "👤 Моя карточка"
 
-def get_timezone_for_city(city_name: str) -> pytz.timezone:
+@lru_cache(maxsize=512)
+def get_timezone_for_city(city_name: str) -> tzinfo:
     """
-    Возвращает объект timezone на основе названия города.
+    Возвращает объект timezone (zoneinfo) на основе названия города.
     Если город не найден, возвращает дефолтный (Москва).
+    Результат запоминается: для одного и того же города всегда возвращается один и тот же объект.
     """
     if not city_name:
-        return pytz.timezone(DEFAULT_TIMEZONE)
+        return ZoneInfo(DEFAULT_TIMEZONE)
     
     clean_city = city_name.strip().title()
     
-    # Ищем прямое совпадение
-    tz_str = CITY_TIMEZONES.get(clean_city)
-    
-    if not tz_str:
-        # Попытка найти дефолт, если города нет в списке
-        return pytz.timezone(DEFAULT_TIMEZONE)
-    
-    return pytz.timezone(tz_str)
+    # Ищем прямое совпадение; если города нет в списке — дефолт
+    return ZoneInfo(CITY_TIMEZONES.get(clean_city) or DEFAULT_TIMEZONE)
+
+def group_by_utc_offset(items: Iterable[Dict[str, Any]], tz_of) -> List[Tuple[datetime, List[Dict[str, Any]]]]:
+    """
+    Раскладывает записи (обычно сотрудников) по текущему смещению от UTC их часового пояса.
+    tz_of(item) -> tzinfo. Возвращает список (локальное "сейчас" группы, записи группы):
+    время считается один раз на группу, а не на каждого сотрудника.
+    """
+    now_utc = datetime.now(timezone.utc)
+    local_now_by_tz: Dict[tzinfo, datetime] = {}
+    buckets: Dict[timedelta, Tuple[datetime, List[Dict[str, Any]]]] = {}
+    for item in items:
+        tz = tz_of(item)
+        local_now = local_now_by_tz.get(tz)
+        if local_now is None:
+            local_now = local_now_by_tz[tz] = now_utc.astimezone(tz)
+        offset = local_now.utcoffset()
+        if offset not in buckets:
+            buckets[offset] = (local_now, [])
+        buckets[offset][1].append(item)
+    return list(buckets.values())
 
 def generate_table_image(headers: list, data: list, title: str = "") -> io.BytesIO:
     """
@@ -124,6 +146,41 @@ def get_main_keyboard(role: str) -> ReplyKeyboardMarkup:
     
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+class SpooledCsvWriter:
+    """
+    Пишет CSV построчно во временный файл: пока он небольшой — в памяти, дальше — на диске.
+    Каждая строка сразу кодируется в utf-8-sig (BOM для Excel), поэтому весь текст CSV
+    никогда не собирается целиком ни в строке, ни в байтах.
+    """
+
+    def __init__(self, delimiter: str = ';', max_memory_bytes: int = 1024 * 1024):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes, mode='w+b')
+        self.file.write('\ufeff'.encode('utf-8'))
+        self._line = io.StringIO()
+        self._writer = csv.writer(self._line, delimiter=delimiter)
+        self.rows_written = 0
+
+    def writerow(self, row: list):
+        self._writer.writerow(row)
+        self.file.write(self._line.getvalue().encode('utf-8'))
+        self._line.seek(0)
+        self._line.truncate()
+        self.rows_written += 1
+
+    def getfile(self):
+        """Возвращает файл, перемотанный в начало, для отправки."""
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 def generate_totp_qr_code(uri: str) -> io.BytesIO:
     """Генерирует QR-код в виде байтового потока."""
     img = qrcode.make(uri)
@@ -144,7 +201,7 @@ def security_required(func):
         role = employee.get('role', '').lower() if employee else 'unknown'
         
         if role not in {'security', 'admin'}:
-            await update.message.reply_text(f"У вас нет прав для выполнения этой команды. Роль: {role}")
+            await reply_text(context, update.message, f"У вас нет прав для выполнения этой команды. Роль: {role}")
             return
 
         return await func(update, context, *args, **kwargs)
@@ -0,0 +1,183 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+Record = Dict[str, Any]
+
+
+def _spilled_files(spill_path: str) -> List[str]:
+    return sorted(glob.glob(f"{glob.escape(spill_path)}.*.flushing"), key=os.path.getmtime)
+
+
+def has_spilled_records(spill_path: str) -> bool:
+    """Остались ли на диске записи прошлого запуска (основной файл или сегменты в процессе сброса)."""
+    if os.path.exists(spill_path) and os.path.getsize(spill_path) > 0:
+        return True
+    return any(os.path.getsize(path) > 0 for path in _spilled_files(spill_path))
+
+
+def _fsync_path(path: str):
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+class WriteBehindBuffer:
+    """
+    Буфер отложенной записи для append-only событий (аудит изменений).
+
+    Записи копятся в памяти и сбрасываются пачкой функцией flush_func — по размеру пачки
+    или по таймеру. Каждая запись сначала дописывается в файл на диске (JSON Lines),
+    поэтому при падении процесса она будет повторно отправлена при следующем старте.
+    fsync выполняется один раз на пачку и вне цикла событий: при падении самой ОС
+    могут потеряться записи последнего интервала сброса, при падении процесса — нет.
+    Гарантия — "хотя бы один раз": если процесс упал между COMMIT и удалением файла,
+    последняя пачка будет записана повторно.
+    """
+
+    def __init__(self, flush_func: Callable[[List[Record]], Awaitable[None]], spill_path: str,
+                 max_batch: int = 200, flush_interval: float = 1.0):
+        self._flush_func = flush_func
+        self._spill_path = spill_path
+        self._max_batch = max_batch
+        self._flush_interval = flush_interval
+
+        self._pending: List[Record] = []
+        # Файлы-сегменты, чьи записи сейчас лежат в self._pending и еще не записаны в БД
+        self._segments: List[str] = []
+        self._segment_seq = 0
+        self._spill_file = None
+
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+        self.flushed = 0
+        self.flush_errors = 0
+
+    # --- Жизненный цикл ---
+    async def start(self):
+        """Поднимает записи, оставшиеся на диске после прошлого запуска, и запускает фоновый сброс."""
+        self._recover_spilled()
+        self._spill_file = open(self._spill_path, "a", encoding="utf-8")
+        self._task = asyncio.create_task(self._run())
+        if self._pending:
+            logger.warning(f"Write-behind: replaying {len(self._pending)} records left from previous run.")
+            await self.flush()
+
+    async def stop(self):
+        """Останавливает фоновый сброс и записывает все, что осталось в буфере."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._spill_file:
+            self._spill_file.close()
+            self._spill_file = None
+            # Пустой файл не оставляем, чтобы следующий старт не принимал его за несброшенные записи
+            if not self._pending and os.path.exists(self._spill_path) and os.path.getsize(self._spill_path) == 0:
+                os.remove(self._spill_path)
+
+    # --- Запись ---
+    def enqueue(self, record: Record):
+        """Добавляет запись в буфер (сразу передавая ее в файл на диске)."""
+        self._spill_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._spill_file.flush()
+        self._pending.append(record)
+        if len(self._pending) >= self._max_batch:
+            self._wakeup.set()
+
+    def has_pending(self, predicate: Optional[Callable[[Record], bool]] = None) -> bool:
+        if predicate is None:
+            return bool(self._pending)
+        return any(predicate(record) for record in self._pending)
+
+    async def flush(self):
+        """Записывает накопленные записи в БД. При ошибке они остаются в буфере и на диске."""
+        async with self._lock:
+            if not self._pending:
+                return
+
+            batch, self._pending = self._pending, []
+            # Ротация — сразу, без await: новые записи должны попасть уже в следующий файл
+            segment = self._rotate_spill_file()
+            segments, self._segments = self._segments + [segment], []
+            await asyncio.get_running_loop().run_in_executor(None, _fsync_path, segment)
+
+            try:
+                for i in range(0, len(batch), self._max_batch):
+                    await self._flush_func(batch[i:i + self._max_batch])
+            except Exception as e:
+                # Возвращаем пачку в начало очереди, файлы оставляем до следующей попытки.
+                # Если часть пачки уже записана, при повторе она продублируется (at-least-once).
+                self._pending = batch + self._pending
+                self._segments = segments + self._segments
+                self.flush_errors += 1
+                logger.error(f"Write-behind flush of {len(batch)} records failed: {e}")
+                return
+
+            for path in segments:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.flushed += len(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'pending': len(self._pending),
+            'flushed': self.flushed,
+            'flush_errors': self.flush_errors,
+            'spilled_segments': len(self._segments),
+        }
+
+    # --- Внутреннее ---
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    def _segment_path(self) -> str:
+        self._segment_seq += 1
+        return f"{self._spill_path}.{os.getpid()}.{self._segment_seq}.flushing"
+
+    def _rotate_spill_file(self) -> str:
+        """Закрывает текущий файл, переименовывает его в сегмент и открывает новый."""
+        segment = self._segment_path()
+        self._spill_file.close()
+        os.replace(self._spill_path, segment)
+        self._spill_file = open(self._spill_path, "a", encoding="utf-8")
+        return segment
+
+    def _recover_spilled(self):
+        """Забирает в буфер записи из файлов, не успевших попасть в БД до остановки."""
+        if os.path.exists(self._spill_path):
+            os.replace(self._spill_path, self._segment_path())
+
+        for path in _spilled_files(self._spill_path):
+            if os.path.getsize(path) == 0:
+                os.remove(path)
+                continue
+            with open(path, encoding="utf-8") as f:
+                for line_no, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self._pending.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Обрезанная последняя строка после аварийного завершения
+                        logger.warning(f"Write-behind: skipping corrupt line {line_no} in {path}")
+            self._segments.append(path)